@@ -17,12 +17,22 @@ from anki.utils import intTime, hexifyID
 # - lrn queue: integer timestamp
 
 class Card(object):
+    # cards are held in bulk by the browser and batch operations; lastIvl
+    # is set by the scheduler while answering
+    __slots__ = ("deck", "id", "fid", "gid", "ord", "crt", "mod", "type",
+                 "queue", "due", "ivl", "factor", "reps", "lapses", "grade",
+                 "cycles", "edue", "data", "timerStarted", "lastIvl", "_qa",
+                 "_rd", "_orig", "_origAt", "__weakref__")
 
     def __init__(self, deck, id=None):
         self.deck = deck
         self.timerStarted = None
         self._qa = None
         self._rd = None
+        # (gid, queue, due) as in the DB, or None if not yet added, and the
+        # scheduler's serial when it was taken
+        self._orig = None
+        self._origAt = 0
         if id:
             self.id = id
             self.load()
@@ -42,7 +52,8 @@ class Card(object):
             self.edue = 0
             self.data = ""
 
-    def load(self):
+    def load(self, row=None):
+        "Load from the DB, or from ROW if provided."
         (self.id,
          self.fid,
          self.gid,
@@ -59,37 +70,51 @@ class Card(object):
          self.grade,
          self.cycles,
          self.edue,
-         self.data) = self.deck.db.first(
+         self.data) = row or self.deck.db.first(
              "select * from cards where id = ?", self.id)
         self._qa = None
         self._rd = None
+        self._orig = (self.gid, self.queue, self.due)
+        self._origAt = self.deck.sched._serial
 
     def flush(self):
         self.mod = intTime()
+        self._uncount()
+        # reviews are totalled by group, so move them if the group changed
+        moved = self._orig and self._orig[0] != self.gid
+        if moved:
+            self.deck._updateDaily("r.cid = %d" % self.id, -1)
         self.deck.db.execute(
             """
 insert or replace into cards values
-(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            self.id,
-            self.fid,
-            self.gid,
-            self.ord,
-            self.crt,
-            self.mod,
-            self.type,
-            self.queue,
-            self.due,
-            self.ivl,
-            self.factor,
-            self.reps,
-            self.lapses,
-            self.grade,
-            self.cycles,
-            self.edue,
-            self.data)
+(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", *self.row())
+        if moved:
+            self.deck._updateDaily("r.cid = %d" % self.id)
+        self._count()
+
+    def row(self):
+        "The card's columns, in the order load() takes them."
+        return (self.id,
+                self.fid,
+                self.gid,
+                self.ord,
+                self.crt,
+                self.mod,
+                self.type,
+                self.queue,
+                self.due,
+                self.ivl,
+                self.factor,
+                self.reps,
+                self.lapses,
+                self.grade,
+                self.cycles,
+                self.edue,
+                self.data)
 
     def flushSched(self):
         self.mod = intTime()
+        self._uncount()
         self.deck.db.execute(
             """update cards set
 mod=?, type=?, queue=?, due=?, ivl=?, factor=?, reps=?,
@@ -97,6 +122,23 @@ lapses=?, grade=?, cycles=?, edue=? where id = ?""",
             self.mod, self.type, self.queue, self.due, self.ivl,
             self.factor, self.reps, self.lapses,
             self.grade, self.cycles, self.edue, self.id)
+        self._count()
+
+    def _uncount(self):
+        """Remove the card as last loaded or flushed from the counter cache.
+If it has been changed elsewhere since, it's reread from the DB first."""
+        if self._orig and self.deck.sched._stale(self.id, self._origAt):
+            self._orig = self.deck.db.first(
+                "select gid, queue, due from cards where id = ?", self.id)
+        if self._orig:
+            self.deck.sched._adjCnts([(self.id, self.fid) + self._orig], -1)
+
+    def _count(self):
+        "Add the flushed card to the scheduler's counter cache."
+        self.deck.sched._adjCnts(
+            [(self.id, self.fid, self.gid, self.queue, self.due)], 1)
+        self._orig = (self.gid, self.queue, self.due)
+        self._origAt = self.deck.sched._touch([self.id])
 
     def q(self, classes="q", reload=False):
         return self._withClass(self._getQA(reload)['q'], classes)
@@ -111,7 +153,7 @@ lapses=?, grade=?, cycles=?, edue=? where id = ?""",
             f = self.fact(); m = self.model()
             data = [self.id, f.id, m.id, self.gid, self.ord, f.stringTags(),
                     f.joinedFields()]
-            self._qa = self.deck._renderQA(self.model(), gname, data)
+            self._qa = self.deck._renderQA(m, gname, data)
         return self._qa
 
     def _withClass(self, txt, extra):
@@ -2,6 +2,7 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
+from heapq import nsmallest
 from anki.utils import ids2str, intTime
 from anki.sched import Scheduler
 
@@ -31,6 +32,10 @@ class CramScheduler(Scheduler):
         self._resetRev()
 
     def answerCard(self, card, ease):
+        self._answerCard(card, ease)
+        card.flushSched()
+
+    def _answerCard(self, card, ease):
         if card.queue == 2:
             card.queue = 1
             card.edue = card.due
@@ -46,7 +51,6 @@ class CramScheduler(Scheduler):
                 # mark card as due today so that it doesn't get rescheduled
                 card.due = card.edue = self.today
         card.mod = intTime()
-        card.flushSched()
 
     def countIdx(self, card):
         if card.queue == 2:
@@ -80,6 +84,10 @@ select id from cards where queue = 2 and due >= %d
         self.revQueue = []
         self.revCount = 0
 
+    def _upcoming(self, n):
+        return ([id for (due, id) in nsmallest(n, self.lrnQueue)] +
+                self.newQueue[-n:])
+
     def _timeForNewCard(self):
         return True
 
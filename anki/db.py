@@ -2,69 +2,300 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import os
+import os, time, re, collections, contextlib, threading, Queue
 try:
     from pysqlite2 import dbapi2 as sqlite
 except ImportError:
     from sqlite3 import dbapi2 as sqlite
 
 from anki.hooks import runHook
+from anki.utils import ids2str
+from anki.errors import AnkiError
+
+# latencies kept per statement for percentiles
+SAMPLES = 1000
+# id lists longer than this are passed to sqlite through a temp table
+IDLIMIT = 1000
 
 class DB(object):
-    def __init__(self, path, text=None):
-        self._db = sqlite.connect(path, timeout=0)
+    def __init__(self, path, text=None, cached=100, timeout=0, shared=False):
+        # cached is the number of prepared statements sqlite keeps around
+        self._db = sqlite.connect(path, timeout=timeout,
+                                  cached_statements=cached,
+                                  check_same_thread=not shared)
         if text:
             self._db.text_factory = text
         self._path = path
+        # if shared between threads, statements are run holding this
+        if shared:
+            self.lock = threading.RLock()
+        else:
+            self.lock = None
+        self._changes = 0
         self.echo = os.environ.get("DBECHO")
+        # created up front, as python commits before ddl
+        self._db.execute(
+            "create temp table _ids (grp integer not null, id integer not null)")
+        self._db.execute("create index temp._idsgrp on _ids (grp)")
+        self.tempIds = True
+        self._idGrp = 0
+        # groups in temp._ids, which are cleared on commit or rollback
+        self._idGrps = set()
+        # {normalized sql: [count, total secs, recent latencies]}
+        self.stats = None
+        # log statements taking longer than this many seconds
+        self.slowLimit = None
+        if os.environ.get("DBSLOW"):
+            self.slowLimit = float(os.environ.get("DBSLOW"))
+        self.slowLog = collections.deque(maxlen=100)
+        self._captures = []
+        self._timed = bool(self.slowLimit)
 
     def execute(self, sql, *a, **ka):
-        if self.echo:
-            print sql #, a, ka
-        if ka:
-            # execute("...where id = :id", id=5)
-            res = self._db.execute(sql, ka)
-        else:
-            # execute("...where id = ?", 5)
-            res = self._db.execute(sql, a)
-        return res
+        return self._run(sql, a, ka)
 
     def executemany(self, sql, l):
+        self._locked(self._executemany, sql, l)
+
+    def _executemany(self, sql, l):
         if self.echo:
             print sql #, l
+        if "temp._ids" in sql:
+            self._checkIds(sql)
+        if not self._timed:
+            self._db.executemany(sql, l)
+            return
+        t = time.time()
         self._db.executemany(sql, l)
+        self._record(sql, None, time.time() - t)
+
+    def _run(self, sql, a, ka, fetch=None):
+        "Execute SQL, passing the cursor through FETCH if provided."
+        return self._locked(self._execute, sql, a, ka, fetch)
+
+    def _execute(self, sql, a, ka, fetch):
+        if self.echo:
+            print sql #, a, ka
+        if "temp._ids" in sql:
+            self._checkIds(sql)
+        # execute("...where id = :id", id=5) or execute("...where id = ?", 5)
+        args = ka or a
+        if not self._timed:
+            res = self._db.execute(sql, args)
+            if fetch:
+                return fetch(res)
+            return res
+        t = time.time()
+        res = self._db.execute(sql, args)
+        if fetch:
+            res = fetch(res)
+        self._record(sql, args, time.time() - t)
+        return res
+
+    def _locked(self, func, *args):
+        if not self.lock:
+            return func(*args)
+        self.lock.acquire()
+        try:
+            return func(*args)
+        finally:
+            self.lock.release()
 
     def commit(self):
+        self._locked(self._commit)
+        self._changes = self._db.total_changes
+
+    def _commit(self):
+        if self._idGrps:
+            self._db.execute("delete from temp._ids")
+            self._idGrps = set()
         self._db.commit()
 
     def executescript(self, sql):
         if self.echo:
             print sql
-        self._db.executescript(sql)
+        self._locked(self._db.executescript, sql)
 
     def rollback(self):
-        self._db.rollback()
+        self._locked(self._db.rollback)
+        self._idGrps = set()
+        self._changes = self._db.total_changes
+
+    def ids2str(self, ids):
+        """Like utils.ids2str(), but lists over IDLIMIT are loaded into a temp
+table and a subquery on it is returned instead, so sqlite doesn't have to
+parse them. The rows are cleared on commit or rollback, after which using
+the subquery raises an error rather than matching nothing."""
+        if not hasattr(ids, '__len__'):
+            ids = list(ids)
+        if not self.tempIds or len(ids) <= IDLIMIT:
+            return ids2str(ids)
+        self._idGrp += 1
+        self.executemany("insert into temp._ids values (%d, ?)" % self._idGrp,
+                         [(id,) for id in ids])
+        self._idGrps.add(self._idGrp)
+        return "(select id from temp._ids where grp = %d)" % self._idGrp
+
+    def _checkIds(self, sql):
+        "Raise if SQL uses an id list that has been cleared."
+        for grp in _idsRe.findall(sql):
+            if int(grp) not in self._idGrps:
+                raise AnkiError("staleIds", grp=int(grp))
+
+    def pending(self):
+        """True if rows have been changed since the last commit or rollback,
+including temp id lists, so other connections wouldn't see them."""
+        return self._db.total_changes != self._changes
+
+    def totalChanges(self):
+        "Rows inserted, updated or deleted through this connection so far."
+        return self._db.total_changes
 
-    def scalar(self, *a, **kw):
-        res = self.execute(*a, **kw).fetchone()
+    def scalar(self, sql, *a, **kw):
+        res = self._run(sql, a, kw, lambda c: c.fetchone())
         if res:
             return res[0]
         return None
 
-    def all(self, *a, **kw):
-        return self.execute(*a, **kw).fetchall()
+    def all(self, sql, *a, **kw):
+        return self._run(sql, a, kw, lambda c: c.fetchall())
 
-    def first(self, *a, **kw):
-        c = self.execute(*a, **kw)
-        res = c.fetchone()
-        c.close()
-        return res
+    def first(self, sql, *a, **kw):
+        def fetch(c):
+            res = c.fetchone()
+            c.close()
+            return res
+        return self._run(sql, a, kw, fetch)
 
-    def list(self, *a, **kw):
-        return [x[0] for x in self.execute(*a, **kw)]
+    def list(self, sql, *a, **kw):
+        return self._run(sql, a, kw, lambda c: [x[0] for x in c])
 
     def close(self):
         self._db.close()
 
     def set_progress_handler(self, *args):
         self._db.set_progress_handler(*args)
+
+    # Instrumentation
+    ##########################################################################
+    # Timings cover executing a statement, and fetching its rows for
+    # scalar(), all(), first() and list(). Rows fetched later from a cursor
+    # returned by execute() aren't included.
+
+    def profile(self, on=True):
+        "Start collecting per-statement stats, or stop and discard them."
+        if on:
+            if self.stats is None:
+                self.stats = {}
+        else:
+            self.stats = None
+        self._updateTimed()
+
+    def setSlowLimit(self, secs):
+        "Log statements slower than SECS to slowLog. None to disable."
+        self.slowLimit = secs
+        self._updateTimed()
+
+    @contextlib.contextmanager
+    def capture(self):
+        "Yield a list which (sql, args, secs) are added to until block exits."
+        queries = []
+        self._captures.append(queries)
+        self._updateTimed()
+        try:
+            yield queries
+        finally:
+            self._captures.remove(queries)
+            self._updateTimed()
+
+    def queryStats(self):
+        """Return [(sql, count, total, p50, p90, p99)], highest total first.
+Percentiles are over the most recent samples."""
+        ret = []
+        for (sql, (cnt, total, lat)) in (self.stats or {}).items():
+            lat = sorted(lat)
+            pct = [lat[min(len(lat)-1, int(len(lat)*p))]
+                   for p in (0.5, 0.9, 0.99)]
+            ret.append([sql, cnt, total] + pct)
+        ret.sort(key=lambda r: -r[2])
+        return ret
+
+    def _updateTimed(self):
+        self._timed = bool(self.stats is not None or self.slowLimit
+                           or self._captures)
+
+    def _record(self, sql, args, taken):
+        if self.stats is not None:
+            key = normalizeSQL(sql)
+            if key not in self.stats:
+                self.stats[key] = [0, 0.0, collections.deque(maxlen=SAMPLES)]
+            s = self.stats[key]
+            s[0] += 1
+            s[1] += taken
+            s[2].append(taken)
+        if self.slowLimit and taken >= self.slowLimit:
+            self.slowLog.append((time.time(), sql, args, taken))
+            runHook("slowQuery", sql, args, taken)
+        for queries in self._captures:
+            queries.append((sql, args, taken))
+
+# Read-only connections
+##########################################################################
+
+class DBPool(object):
+    """Read-only connections to PATH, opened as needed up to SIZE, which can
+be used from any thread. The deck should be in WAL mode so readers don't
+block, or get blocked by, the writer."""
+
+    def __init__(self, path, size=4, timeout=5):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._free = Queue.Queue()
+        self._all = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def reader(self):
+        "Yield a connection, waiting for one to be free if SIZE are in use."
+        db = None
+        try:
+            db = self._free.get_nowait()
+        except Queue.Empty:
+            self._lock.acquire()
+            try:
+                if len(self._all) < self.size:
+                    db = DB(self.path, timeout=self.timeout, shared=True)
+                    db.execute("pragma query_only = 1")
+                    db.tempIds = False
+                    self._all.append(db)
+            finally:
+                self._lock.release()
+        if db is None:
+            db = self._free.get()
+        try:
+            yield db
+        finally:
+            # don't keep a read transaction open
+            db.rollback()
+            self._free.put(db)
+
+    def close(self):
+        "Close all connections. They must not be in use."
+        for db in self._all:
+            db.close()
+        self._all = []
+        self._free = Queue.Queue()
+
+# subqueries returned by DB.ids2str()
+_idsRe = re.compile(r"temp\._ids where grp = (\d+)")
+
+# string and number literals, and lists of them like ids2str() creates
+_literalRe = re.compile(r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_listRe = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+def normalizeSQL(sql):
+    "Strip literals and whitespace from SQL, so similar queries group together."
+    sql = _literalRe.sub("?", sql)
+    sql = _listRe.sub("(?)", sql)
+    return " ".join(sql.split())
@@ -2,12 +2,13 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import time, os, random, re, stat, simplejson, datetime, copy, shutil
+import time, os, random, re, stat, simplejson, datetime, shutil, \
+    contextlib, weakref
 from anki.lang import _, ngettext
 from anki.utils import parseTags, ids2str, hexifyID, \
      checksum, fieldChecksum, addTags, delTags, stripHTML, intTime, \
      splitFields
-from anki.hooks import runHook, runFilter
+from anki.hooks import runHook, runFilter, hasHook
 from anki.sched import Scheduler
 from anki.media import MediaRegistry
 from anki.consts import *
@@ -48,13 +49,42 @@ defaultConf = {
     'sortBackwards': False,
 }
 
+# Q/A rendering in worker processes. Each pool's initializer is given the
+# model data, group names and media folder and manifest to render with,
+# which are only kept in the worker. They're plain data, so workers can be
+# spawned as well as forked, and don't inherit the deck's connections.
+_workerState = None
+
+def _initRenderWorker(models, groups, mediaDir, mediaNames):
+    global _workerState
+    deck = _RenderDeck(mediaDir, mediaNames)
+    mods = {}
+    for (mid, state) in models.items():
+        m = anki.models.Model(deck)
+        (m.id, m.name, m.fields, m.templates, m.conf, m.css) = state
+        mods[mid] = m
+    _workerState = (deck, mods, groups)
+    # built latex images are recorded in the DB; leave missing ones to the
+    # parent
+    anki.latex.build = False
+
+def _renderChunk(rows):
+    (deck, mods, groups) = _workerState
+    return [deck._renderQA(mods[row[2]], groups[row[3]], row)
+            for row in rows]
+
 # this is initialized by storage.Deck
 class _Deck(object):
 
     def __init__(self, db):
         self.db = db
         self.path = db._path
+        # read-only connections, if opened in concurrent mode
+        self.pool = None
         self._lastSave = time.time()
+        self.revlogLimit = 100
+        self._revlog = []
+        self._revlogTime = 0
         self.clearUndo()
         self.load()
         if not self.crt:
@@ -64,6 +94,8 @@ class _Deck(object):
             d += datetime.timedelta(hours=4)
             self.crt = int(time.mktime(d.timetuple()))
         self.modelCache = {}
+        # loaded cards and facts; see useIdentityMap()
+        self._objs = None
         self.undoEnabled = False
         self.sessionStartReps = 0
         self.sessionStartTime = 0
@@ -99,6 +131,7 @@ qconf, conf, data from deck""")
 
     def flush(self, mod=None):
         "Flush state to DB, updating mod time."
+        self.flushRevlog()
         self.mod = intTime() if mod is None else mod
         self.db.execute(
             """update deck set
@@ -123,6 +156,9 @@ qconf=?, conf=?, data=?""",
             self.save()
 
     def lock(self):
+        if self.pool:
+            # concurrent mode only locks while changes are pending
+            return
         self.db.execute("update deck set mod=mod")
 
     def close(self, save=True):
@@ -133,6 +169,11 @@ qconf=?, conf=?, data=?""",
                 self.save()
             else:
                 self.rollback()
+            if self.pool:
+                self.sched.waitPrefetch()
+                self.pool.close()
+                # leave a single file behind
+                self.db.execute("pragma journal_mode = delete")
             self.db.close()
             self.db = None
 
@@ -140,12 +181,29 @@ qconf=?, conf=?, data=?""",
         "Reconnect to DB (after changing threads, etc). Doesn't reload."
         import anki.db
         if not self.db:
-            self.db = anki.db.DB(self.path)
+            if self.pool:
+                self.db = anki.db.DB(self.path, timeout=5, shared=True)
+                self.db.execute("pragma journal_mode = wal")
+            else:
+                self.db = anki.db.DB(self.path)
+
+    @contextlib.contextmanager
+    def reader(self):
+        """Yield a DB for reading. In concurrent mode this is a pooled
+connection, unless changes are pending which it wouldn't see."""
+        if self.pool and not self.db.pending():
+            with self.pool.reader() as db:
+                yield db
+        else:
+            yield self.db
 
     def rollback(self):
+        self._revlog = []
+        self._clearObjs()
         self.db.rollback()
         self.load()
         self.lock()
+        self.sched.invalidateCounts()
 
     def modSchema(self, check=True):
         "Mark schema modified. Call this first so user can abort if necessary."
@@ -183,10 +241,35 @@ qconf=?, conf=?, data=?""",
     ##########################################################################
 
     def getCard(self, id):
-        return anki.cards.Card(self, id)
+        c = self._cachedObj("c", id)
+        if not c:
+            c = self._addObj("c", anki.cards.Card(self, id))
+        return c
 
     def getFact(self, id):
-        return anki.facts.Fact(self, id=id)
+        f = self._cachedObj("f", id)
+        if not f:
+            f = self._addObj("f", anki.facts.Fact(self, id=id))
+        return f
+
+    def getCards(self, ids):
+        "Return cards for IDS in the same order, loaded with a single query."
+        def load(ids):
+            for row in self.db.execute(
+                "select * from cards where id in " + self.db.ids2str(ids)):
+                c = anki.cards.Card(self)
+                c.load(row)
+                yield c
+        return self._getObjs("c", ids, load)
+
+    def getFacts(self, ids):
+        "Return facts for IDS in the same order, loaded with a single query."
+        def load(ids):
+            for row in self.db.execute("""
+select id, mid, gid, crt, mod, tags, flds, data from facts
+where id in """ + self.db.ids2str(ids)):
+                yield anki.facts.Fact(self, id=row[0], row=row[1:])
+        return self._getObjs("f", ids, load)
 
     def getModel(self, mid, cache=True):
         "Memoizes; call .reset() to reset cache."
@@ -209,8 +292,51 @@ qconf=?, conf=?, data=?""",
     def reset(self):
         "Rebuild the queue and reload data after DB modified."
         self.modelCache = {}
+        self._clearObjs()
         self.sched.reset()
 
+    # Identity map
+    ##########################################################################
+    # When enabled, getCard(), getFact() and friends return the object already
+    # loaded for an id while something still references it, so changes made
+    # through one reference are seen by the others, and repeated access
+    # doesn't hit the DB. Objects aren't reloaded if the DB is changed behind
+    # their back, so the map is cleared on reset() and rollback().
+
+    def useIdentityMap(self, on=True):
+        if on:
+            if self._objs is None:
+                self._objs = weakref.WeakValueDictionary()
+        else:
+            self._objs = None
+
+    def _clearObjs(self):
+        if self._objs is not None:
+            self._objs.clear()
+
+    def _cachedObj(self, type, id):
+        if self._objs is not None:
+            return self._objs.get((type, id))
+
+    def _addObj(self, type, obj):
+        if self._objs is not None:
+            self._objs[(type, obj.id)] = obj
+        return obj
+
+    def _getObjs(self, type, ids, load):
+        found = {}
+        missing = []
+        for id in ids:
+            obj = self._cachedObj(type, id)
+            if obj:
+                found[id] = obj
+            else:
+                missing.append(id)
+        if missing:
+            for obj in load(missing):
+                found[obj.id] = self._addObj(type, obj)
+        return [found[id] for id in ids if id in found]
+
     # Deletion logging
     ##########################################################################
 
@@ -222,7 +348,7 @@ qconf=?, conf=?, data=?""",
         tbl = "cards" if type == DEL_CARD else "facts"
         ids = self.db.list(
             "select id from %s where crt < ? and id in %s" % (
-                tbl, ids2str(ids)), self.lastSync)
+                tbl, self.db.ids2str(ids)), self.lastSync)
         # log
         self.db.executemany("insert into graves values (%d, ?, %d)" % (
             intTime(), type), ([x] for x in ids))
@@ -239,39 +365,82 @@ qconf=?, conf=?, data=?""",
 
     def addFact(self, fact):
         "Add a fact to the deck. Return number of new cards."
+        return self.addFacts([fact])
+
+    def addFacts(self, facts):
+        """Add FACTS to the deck in bulk. Return number of new cards.
+Facts which would have no cards aren't added, and keep an id of None."""
         # check we have card models available
-        cms = self.findTemplates(fact)
-        if not cms:
+        todo = []
+        for fact in facts:
+            cms = self.findTemplates(fact)
+            if cms:
+                todo.append((fact, cms))
+        if not todo:
             return 0
-        # flush the fact
-        fact.id = self.nextID("fid")
-        fact.flush()
-        # randomize?
-        if self.randomNew():
-            due = random.randrange(1, fact.id)
-        else:
-            due = fact.id
-        # add cards
-        ncards = 0
-        for template in cms:
-            self._newCard(fact, template, due)
-            ncards += 1
-        return ncards
+        # allocate ids up front
+        fid = self.conf.get("nextFid", 1)
+        self.conf['nextFid'] = fid + len(todo)
+        cid = self.conf.get("nextCid", 1)
+        self.conf['nextCid'] = cid + sum(len(cms) for (f, cms) in todo)
+        now = intTime()
+        rand = self.randomNew()
+        gids = {}
+        frows = []; crows = []; sums = []; tags = []
+        for (fact, cms) in todo:
+            fact.id = fid
+            fid += 1
+            fact.mod = now
+            flds = fact.joinedFields()
+            frows.append((fact.id, fact.mid, fact.gid, fact.crt, now,
+                          fact.stringTags(), flds,
+                          fact.fields[fact.model().sortIdx()], fact.data))
+            sums.extend(fact._fieldChecksums())
+            tags.append((fact.id, frows[-1][5]))
+            # randomize?
+            if rand:
+                due = random.randrange(1, fact.id)
+            else:
+                due = fact.id
+            for template in cms:
+                gid = template['gid'] or fact.gid
+                if gid not in gids:
+                    gids[gid] = self.defaultGroup(gid)
+                # id, fid, gid, ord, crt, mod, type, queue, due, ivl, factor,
+                # reps, lapses, grade, cycles, edue, data
+                crows.append((cid, fact.id, gids[gid], template['ord'], now,
+                              now, 0, 0, due, 0, 0, 0, 0, 0, 0, 0, ""))
+                cid += 1
+        self.db.executemany("""
+insert or replace into facts values (?, ?, ?, ?, ?, ?, ?, ?, ?)""", frows)
+        self.db.executemany("insert into fsums values (?, ?, ?)", sums)
+        self.indexWords([(r[0], r[6]) for r in frows])
+        self.media.indexFacts([(r[0], r[6]) for r in frows])
+        self.registerTags(set(t for r in tags for t in parseTags(r[1])))
+        self.indexTags(tags)
+        self.db.executemany("""
+insert or replace into cards values
+(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", crows)
+        self.sched._count([r[0] for r in crows])
+        return len(crows)
 
     def delFacts(self, ids):
         self.delCards(self.db.list("select id from cards where fid in "+
-                                   ids2str(ids)))
+                                   self.db.ids2str(ids)))
 
     def _delFacts(self, ids):
         "Bulk delete facts by ID. Don't call this directly."
         if not ids:
             return
-        strids = ids2str(ids)
+        strids = self.db.ids2str(ids)
         # we need to log these independently of cards, as one side may have
         # more card templates
         self._logDels(ids, DEL_FACT)
         self.db.execute("delete from facts where id in %s" % strids)
         self.db.execute("delete from fsums where fid in %s" % strids)
+        self.db.execute("delete from fwords where fid in %s" % strids)
+        self.db.execute("delete from media_refs where fid in %s" % strids)
+        self.db.execute("delete from ftags where fid in %s" % strids)
 
     # Card creation
     ##########################################################################
@@ -280,22 +449,35 @@ qconf=?, conf=?, data=?""",
         "Return (active), non-empty templates."
         ok = []
         model = fact.model()
+        flds = fact.joinedFields()
+        # rendering builds latex images, which adding facts relies on
+        render = "[" in flds and anki.latex.stripLatex(flds) != flds
         for template in model.templates:
             if template['actv'] or not checkActive:
                 # [cid, fid, mid, gid, ord, tags, flds]
-                data = [1, 1, model.id, 1, template['ord'],
-                        "", fact.joinedFields()]
-                now = self._renderQA(model, "", data)
-                data[6] = "\x1f".join([""]*len(fact.fields))
-                empty = self._renderQA(model, "", data)
-                if now['q'] == empty['q']:
+                data = [1, 1, model.id, 1, template['ord'], "", flds]
+                if not self._nonEmpty(model, template, data, "q", render):
                     continue
                 if not template['emptyAns']:
-                    if now['a'] == empty['a']:
+                    if not self._nonEmpty(model, template, data, "a", render):
                         continue
                 ok.append(template)
         return ok
 
+    def _nonEmpty(self, model, template, data, type, render=False):
+        """True if side TYPE of DATA renders differently with fields blank.
+Decided from the template's required fields where possible."""
+        fmt = self._qaFormats(model, template)[type == "a"][1]
+        req = model.requirements(fmt)
+        if req is not None and not render and not hasHook("mungeFields"):
+            fields = self._qaFields(model, "", data)
+            ret = model.compiledTemplate(fmt).satisfies(req, fields)
+            if ret is not None:
+                return ret
+        now = self._renderQA(model, "", data)
+        blank = data[:6] + ["\x1f".join([""]*len(model.fields))]
+        return now[type] != self._renderQA(model, "", blank)[type]
+
     def genCards(self, fact, templates):
         "Generate cards for templates if cards not empty. Return cards."
         cards = []
@@ -361,16 +543,19 @@ qconf=?, conf=?, data=?""",
         "Bulk delete cards by ID."
         if not ids:
             return
-        sids = ids2str(ids)
+        sids = self.db.ids2str(ids)
         fids = self.db.list("select fid from cards where id in "+sids)
         # remove cards
+        self.sched._uncount(ids)
+        self.flushRevlog()
         self._logDels(ids, DEL_CARD)
+        self._updateDaily("r.cid in "+sids, -1)
         self.db.execute("delete from cards where id in "+sids)
         self.db.execute("delete from revlog where cid in "+sids)
         # then facts
         fids = self.db.list("""
 select id from facts where id in %s and id not in (select fid from cards)""" %
-                     ids2str(fids))
+                     self.db.ids2str(fids))
         self._delFacts(fids)
 
     # Models
@@ -418,10 +603,11 @@ select id from cards where fid in (select id from facts where mid = ?)""",
 
     def updateFieldCache(self, fids, csum=True):
         "Update field checksums and sort cache, after find&replace, etc."
-        sfids = ids2str(fids)
+        sfids = self.db.ids2str(fids)
         mods = self.models()
         r = []
         r2 = []
+        r3 = []
         for (fid, mid, flds) in self._fieldData(sfids):
             fields = splitFields(flds)
             model = mods[mid]
@@ -429,37 +615,121 @@ select id from cards where fid in (select id from facts where mid = ?)""",
                 for f in model.fields:
                     if f['uniq'] and fields[f['ord']]:
                         r.append((fid, mid, fieldChecksum(fields[f['ord']])))
+                r3.append((fid, flds))
             r2.append((stripHTML(fields[model.sortIdx()]), fid))
         if csum:
             self.db.execute("delete from fsums where fid in "+sfids)
             self.db.executemany("insert into fsums values (?,?,?)", r)
+            self.indexWords(r3)
+            self.media.indexFacts(r3)
         self.db.executemany("update facts set sfld = ? where id = ?", r2)
 
+    # Word index
+    ##########################################################################
+    # Maps lowercased words in field text (with and without HTML) to facts.
+    # Searches use it to narrow down which facts need to be checked.
+
+    def indexWords(self, facts):
+        "Update the word index for FACTS, a list of (fid, flds)."
+        if not facts:
+            return
+        self.db.execute("delete from fwords where fid in "+
+                        self.db.ids2str([f[0] for f in facts]))
+        d = []
+        for (fid, flds) in facts:
+            for w in anki.find.factWords(flds):
+                d.append({'w': w, 'fid': fid})
+        self.db.executemany(
+            "insert or ignore into words (word) values (:w)", d)
+        self.db.executemany("""
+insert into fwords select id, :fid from words where word = :w""", d)
+
     # Q/A generation
     ##########################################################################
 
     def renderQA(self, ids=None, type="card"):
         # gather metadata
         if type == "card":
-            where = "and c.id in " + ids2str(ids)
+            where = "and c.id in " + self.db.ids2str(ids)
         elif type == "fact":
-            where = "and f.id in " + ids2str(ids)
+            where = "and f.id in " + self.db.ids2str(ids)
         elif type == "model":
-            where = "and m.id in " + ids2str(ids)
+            where = "and m.id in " + self.db.ids2str(ids)
         elif type == "all":
             where = ""
         else:
             raise Exception()
+        return list(self.iterRenderQA(where))
+
+    def iterRenderQA(self, where="", chunk=1000, procs=0):
+        """Like renderQA(), but yields the results while fetching CHUNK cards
+at a time. With PROCS, chunks are rendered by that many worker processes,
+in which any mungeFields/mungeQA filters run too."""
         mods = self.models()
-        groups = dict(self.db.all("select id, name from groups"))
-        return [self._renderQA(mods[row[2]], groups[row[3]], row)
-                for row in self._qaData(where)]
+        with self.reader() as db:
+            groups = dict(db.all("select id, name from groups"))
+        if not procs:
+            for rows in self._qaChunks(where, chunk):
+                for row in rows:
+                    yield self._renderQA(mods[row[2]], groups[row[3]], row)
+            return
+        import multiprocessing, collections
+        models = dict((mid, (m.id, m.name, m.fields, m.templates, m.conf,
+                             m.css)) for (mid, m) in mods.items())
+        # latex lookups need the manifest, and workers can't use the DB
+        pool = multiprocessing.Pool(procs, _initRenderWorker, (
+            models, groups, self.media.dir(), self.media.names()))
+        try:
+            # keep a few chunks in flight, and return them in order
+            pending = collections.deque()
+            chunks = self._qaChunks(where, chunk)
+            while True:
+                if len(pending) < procs*2:
+                    rows = next(chunks, None)
+                    if rows:
+                        pending.append(
+                            (rows, pool.apply_async(_renderChunk, (rows,))))
+                        continue
+                if not pending:
+                    break
+                (rows, res) = pending.popleft()
+                for (row, d) in zip(rows, res.get()):
+                    if "[latex]" in d['q'] or "[latex]" in d['a']:
+                        # may need an image built; render here instead
+                        d = self._renderQA(mods[row[2]], groups[row[3]], row)
+                    yield d
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _qaChunks(self, where, chunk):
+        """Yield _qaData() rows in lists of up to CHUNK, in card id order. The
+cards are selected up front, so WHERE isn't rerun after the caller commits."""
+        with self.reader() as db:
+            cids = db.list("""
+select c.id from cards c, facts f where c.fid == f.id %s
+order by c.id""" % where)
+            for i in range(0, len(cids), chunk):
+                yield self._qaData("and c.id in %s order by c.id" % ids2str(
+                    cids[i:i+chunk]), db).fetchall()
 
     # fixme: don't need gid or data
     def _renderQA(self, model, gname, data):
         "Returns hash of id, question, answer."
         # data is [cid, fid, mid, gid, ord, tags, flds]
-        # unpack fields and create dict
+        fields = self._qaFields(model, gname, data)
+        template = model.templates[data[4]]
+        # render q & a
+        d = dict(id=data[0])
+        for (type, format) in self._qaFormats(model, template):
+            fields = runFilter("mungeFields", fields, model, gname, data, self)
+            html = model.compiledTemplate(format).render(fields)
+            d[type] = runFilter(
+                "mungeQA", html, type, fields, model, gname, data, self)
+        return d
+
+    def _qaFields(self, model, gname, data):
+        "Unpack fields and create dict."
         flist = splitFields(data[6])
         fields = {}
         for (name, (idx, conf)) in model.fieldMap().items():
@@ -472,28 +742,22 @@ select id from cards where fid in (select id from facts where mid = ?)""",
         fields['Tags'] = data[5]
         fields['Model'] = model.name
         fields['Group'] = gname
-        template = model.templates[data[4]]
-        fields['Template'] = template['name']
-        # render q & a
-        d = dict(id=data[0])
-        for (type, format) in (("q", template['qfmt']), ("a", template['afmt'])):
-            if type == "q":
-                format = format.replace("cloze:", "cq:")
-            else:
-                if model.conf['clozectx']:
-                    name = "cactx:"
-                else:
-                    name = "ca:"
-                format = format.replace("cloze:", name)
-            fields = runFilter("mungeFields", fields, model, gname, data, self)
-            html = anki.template.render(format, fields)
-            d[type] = runFilter(
-                "mungeQA", html, type, fields, model, gname, data, self)
-        return d
+        fields['Template'] = model.templates[data[4]]['name']
+        return fields
+
+    def _qaFormats(self, model, template):
+        "Return ((q, format), (a, format)) with cloze tags resolved."
+        qfmt = template['qfmt'].replace("cloze:", "cq:")
+        if model.conf['clozectx']:
+            name = "cactx:"
+        else:
+            name = "ca:"
+        afmt = template['afmt'].replace("cloze:", name)
+        return (("q", qfmt), ("a", afmt))
 
-    def _qaData(self, where=""):
+    def _qaData(self, where="", db=None):
         "Return [cid, fid, mid, gid, ord, tags, flds] db query"
-        return self.db.execute("""
+        return (db or self.db).execute("""
 select c.id, f.id, f.mid, c.gid, c.ord, f.tags, f.flds
 from cards c, facts f
 where c.fid == f.id
@@ -506,13 +770,17 @@ where c.fid == f.id
         return self.db.list("select name from tags order by name")
 
     def updateFactTags(self, fids=None):
-        "Add any missing tags to the tags list."
+        """Add any missing tags to the tags list, and update the tag map from
+the tags strings of FIDS, or all facts."""
         if fids:
-            lim = " where id in " + ids2str(fids)
+            lim = " where id in " + self.db.ids2str(fids)
         else:
             lim = ""
+            self.db.execute("delete from ftags")
+        facts = self.db.all("select id, tags from facts"+lim)
         self.registerTags(set(parseTags(
-            " ".join(self.db.list("select distinct tags from facts"+lim)))))
+            " ".join([f[1] for f in facts]))))
+        self.indexTags(facts)
 
     def registerTags(self, tags):
         r = []
@@ -522,6 +790,51 @@ where c.fid == f.id
 insert or ignore into tags (mod, name) values (%d, :t)""" % intTime(),
                             r)
 
+    def indexTags(self, facts):
+        """Update the fact->tag map for FACTS, a list of (fid, tags).
+Tags must already be registered."""
+        if not facts:
+            return
+        self.db.execute("delete from ftags where fid in "+
+                        self.db.ids2str([f[0] for f in facts]))
+        d = []
+        for (fid, tags) in facts:
+            for t in parseTags(tags):
+                d.append({'fid': fid, 't': t})
+        self.db.executemany("""
+insert or ignore into ftags select id, :fid from tags where name = :t""", d)
+
+    def _staleTagFids(self):
+        """Ids of facts whose tag map doesn't match their tags string, found
+without parsing every string. Orphaned map rows are removed first."""
+        self.db.execute(
+            "delete from ftags where fid not in (select id from facts)")
+        self.db.execute(
+            "delete from ftags where tid not in (select id from tags)")
+        # strings are ' a b ', so have one more space than tags
+        return self.db.list("""
+select id from facts f where
+(case when tags = '' then 0
+ else length(tags) - length(replace(tags, ' ', '')) - 1 end) !=
+(select count() from ftags where fid = f.id) or
+exists (select 1 from ftags ft, tags t where ft.fid = f.id and t.id = ft.tid
+and instr(lower(f.tags), ' ' || lower(t.name) || ' ') = 0)""")
+
+    def tagIds(self, tags):
+        "Return ids of the registered TAGS. Ignores case."
+        return self.db.list("select id from tags where name in (%s)" % (
+            ",".join("?"*len(tags))), *tags)
+
+    def tagFids(self, tag, children=False):
+        "Return fids tagged with TAG, and optionally TAG's children (a::b)."
+        lim = "name = :t"
+        if children:
+            lim += " or name like :c escape '\\'"
+        c = re.sub(r"([\\%_])", r"\\\1", tag) + "::%"
+        return self.db.list("""
+select distinct fid from ftags where tid in
+(select id from tags where %s)""" % lim, t=tag, c=c)
+
     def addTags(self, ids, tags, add=True):
         "Add tags in bulk. TAGS is space-separated."
         newTags = parseTags(tags)
@@ -529,28 +842,29 @@ insert or ignore into tags (mod, name) values (%d, :t)""" % intTime(),
             return
         # cache tag names
         self.registerTags(newTags)
-        # find facts missing the tags
+        tids = self.tagIds(newTags)
+        # find facts missing the tags, or with the tags to delete
         if add:
-            l = "tags not "
             fn = addTags
+            lim = """id not in (
+select fid from ftags where tid in %s group by fid having count() = %d)""" % (
+                self.db.ids2str(tids), len(tids))
         else:
-            l = "tags "
             fn = delTags
-        lim = " or ".join(
-            [l+"like :_%d" % c for c, t in enumerate(newTags)])
+            lim = "id in (select fid from ftags where tid in %s)" % (
+                self.db.ids2str(tids))
         res = self.db.all(
             "select id, tags from facts where id in %s and %s" % (
-                ids2str(ids), lim),
-            **dict([("_%d" % x, '%% %s %%' % y) for x, y in enumerate(newTags)]))
+                self.db.ids2str(ids), lim))
         # update tags
         fids = []
         def fix(row):
             fids.append(row[0])
             return {'id': row[0], 't': fn(tags, row[1]), 'n':intTime()}
+        d = [fix(row) for row in res]
         self.db.executemany("""
-update facts set tags = :t, mod = :n where id = :id""", [fix(row) for row in res])
-        # update q/a cache
-        self.registerTags(parseTags(tags))
+update facts set tags = :t, mod = :n where id = :id""", d)
+        self.indexTags([(r['id'], r['t']) for r in d])
 
     def delTags(self, ids, tags):
         self.addTags(ids, tags, False)
@@ -582,13 +896,18 @@ update facts set tags = :t, mod = :n where id = :id""", [fix(row) for row in res
 
     def delGroup(self, gid):
         self.modSchema()
-        self.db.execute("update cards set gid = 1 where gid = ?", gid)
+        self.setGroup(
+            self.db.list("select id from cards where gid = ?", gid), 1)
         self.db.execute("update facts set gid = 1 where gid = ?", gid)
         self.db.execute("delete from groups where id = ?", gid)
 
     def setGroup(self, cids, gid):
-        self.db.execute(
-            "update cards set gid = ? where id in "+ids2str(cids), gid)
+        sids = self.db.ids2str(cids)
+        self.sched._uncount(cids)
+        self._updateDaily("r.cid in "+sids, -1)
+        self.db.execute("update cards set gid = ? where id in "+sids, gid)
+        self._updateDaily("r.cid in "+sids)
+        self.sched._count(cids)
 
     # Group configuration
     ##########################################################################
@@ -606,32 +925,23 @@ update facts set tags = :t, mod = :n where id = :id""", [fix(row) for row in res
     ##########################################################################
 
     def selTagFids(self, yes, no):
-        l = []
         # find facts that match yes
-        lim = ""
-        args = []
+        lims = []
+        if yes:
+            lims.append("id in (select fid from ftags where tid in %s)" %
+                        self.db.ids2str(self.tagIds(yes)))
+        if no:
+            lims.append("id not in (select fid from ftags where tid in %s)" %
+                        self.db.ids2str(self.tagIds(no)))
         query = "select id from facts"
-        if not yes and not no:
-            pass
-        else:
-            if yes:
-                lim += " or ".join(["tags like ?" for t in yes])
-                args += ['%% %s %%' % t for t in yes]
-            if no:
-                lim2 = " and ".join(["tags not like ?" for t in no])
-                if lim:
-                    lim = "(%s) and %s" % (lim, lim2)
-                else:
-                    lim = lim2
-                args += ['%% %s %%' % t for t in no]
-            query += " where " + lim
-        return self.db.list(query, *args)
+        if lims:
+            query += " where " + " and ".join(lims)
+        return self.db.list(query)
 
     def setGroupForTags(self, yes, no, gid):
         fids = self.selTagFids(yes, no)
-        self.db.execute(
-            "update cards set gid = ? where fid in "+ids2str(fids),
-            gid)
+        self.setGroup(self.db.list(
+            "select id from cards where fid in "+self.db.ids2str(fids)), gid)
 
     # Finding cards
     ##########################################################################
@@ -650,12 +960,87 @@ update facts set tags = :t, mod = :n where id = :id""", [fix(row) for row in res
 
     def cardStats(self, card):
         from anki.stats import CardStats
+        self.flushRevlog()
         return CardStats(self, card).report()
 
     def stats(self):
         from anki.stats import DeckStats
+        self.flushRevlog()
         return DeckStats(self)
 
+    # Review log
+    ##########################################################################
+
+    # Entries are buffered in memory and written out in bulk when the deck is
+    # saved or the buffer fills. Each gets a unique, increasing millisecond
+    # timestamp, so inserts can't collide.
+
+    def logReview(self, cid, ease, ivl, lastIvl, factor, taken, type,
+                  now=None):
+        "Add an entry to the review log, answered at NOW or the current time."
+        if not self._revlogTime:
+            self._revlogTime = self.db.scalar(
+                "select max(time) from revlog") or 0
+        self._revlogTime = max(int((now or time.time())*1000),
+                               self._revlogTime+1)
+        self._revlog.append((self._revlogTime, cid, ease, ivl, lastIvl,
+                             factor, taken, type))
+        if len(self._revlog) >= self.revlogLimit:
+            self.flushRevlog()
+
+    def flushRevlog(self):
+        "Write buffered review log entries to the DB."
+        if not self._revlog:
+            return
+        self.db.executemany(
+            "insert into revlog values (?,?,?,?,?,?,?,?)", self._revlog)
+        self._updateDaily("r.time in " + self.db.ids2str(
+            [r[0] for r in self._revlog]))
+        self._revlog = []
+
+    # Daily review totals
+    ##########################################################################
+
+    # revlog_daily sums the review log by day, hour, group and type, so the
+    # graphs don't need to scan the whole log. Entries are filed under their
+    # card's current group, so they have to be moved along with the card.
+
+    def rebuildDaily(self):
+        "Recalculate the daily review totals from the review log."
+        self.flushRevlog()
+        self.db.execute("delete from revlog_daily")
+        self._updateDaily("1")
+
+    def _updateDaily(self, lim, sign=1):
+        """Add revlog entries matching LIM to the daily totals, or remove them
+if SIGN is -1. LIM may refer to revlog r and cards c."""
+        self.db.execute("""
+insert or replace into revlog_daily select
+n.day, n.gid, n.type, n.mature, n.hour,
+n.cnt*:s + ifnull(o.cnt, 0), n.secs*:s + ifnull(o.secs, 0),
+n.e1*:s + ifnull(o.ease1, 0), n.e2*:s + ifnull(o.ease2, 0),
+n.e3*:s + ifnull(o.ease3, 0), n.e4*:s + ifnull(o.ease4, 0)
+from (select
+(r.time/1000 - :crt + :off*86400)/86400 - :off as day,
+-- entries for missing cards are only included in whole deck stats
+ifnull(c.gid, 0) as gid,
+r.type as type,
+r.lastIvl >= 21 as mature,
+((r.time/1000 - :crt + :off*86400)/3600 + :hour) %% 24 as hour,
+count() as cnt, sum(r.taken/1000) as secs,
+sum(r.ease = 1) as e1, sum(r.ease = 2) as e2,
+sum(r.ease = 3) as e3, sum(r.ease = 4) as e4
+from revlog r left join cards c on c.id = r.cid where %s
+group by 1, 2, 3, 4, 5) n
+left join revlog_daily o on o.day = n.day and o.gid = n.gid and
+o.type = n.type and o.mature = n.mature and o.hour = n.hour""" % lim,
+                        s=sign, crt=self.crt,
+                        hour=datetime.datetime.fromtimestamp(self.crt).hour,
+                        # keeps division rounding down for entries before crt
+                        off=self.crt/86400+1)
+        if sign < 0:
+            self.db.execute("delete from revlog_daily where cnt = 0")
+
     # Timeboxing
     ##########################################################################
 
@@ -710,6 +1095,8 @@ update facts set tags = :t, mod = :n where id = :id""", [fix(row) for row in res
         if self.sched.name != "std":
             self.cleanup()
             self.sched = self._stdSched
+            # cards may have moved while cramming
+            self.sched.invalidateCounts()
             return True
 
     def cramGroups(self, order="mod desc", min=0, max=None):
@@ -742,19 +1129,30 @@ update facts set tags = :t, mod = :n where id = :id""", [fix(row) for row in res
             if self._undo[0] == 1:
                 old = self._undo[2]
             self.clearUndo()
-        self._undo = [1, _("Review"), old + [copy.copy(card)]]
+        # keep just the columns, not the loaded fact and model
+        self._undo = [1, _("Review"), old + [card.row()]]
 
     def _undoReview(self):
         data = self._undo[2]
-        c = data.pop()
+        c = anki.cards.Card(self)
+        c.load(data.pop())
         if not data:
             self.clearUndo()
+        # the DB has the card as answered, not as restored
+        c._orig = None
+        self.sched._uncount([c.id])
         # write old data
         c.flush()
         # and delete revlog entry
+        for i in reversed(range(len(self._revlog))):
+            if self._revlog[i][1] == c.id:
+                del self._revlog[i]
+                return
         last = self.db.scalar(
             "select time from revlog where cid = ? "
             "order by time desc limit 1", c.id)
+        if last:
+            self._updateDaily("r.time = %d" % last, -1)
         self.db.execute("delete from revlog where time = ?", last)
 
     def _markOp(self, name):
@@ -783,12 +1181,22 @@ update facts set tags = :t, mod = :n where id = :id""", [fix(row) for row in res
         ids = self.db.list("""
 select id from facts where id not in (select distinct fid from cards)""")
         self._delFacts(ids)
-        # tags
-        self.db.execute("delete from tags")
-        self.updateFactTags()
-        # field cache
+        # tags; the map is only rebuilt for facts it's wrong for
+        stale = self._staleTagFids()
+        if stale:
+            self.updateFactTags(stale)
+        self.db.execute(
+            "delete from tags where id not in (select tid from ftags)")
+        # field cache, word index and media references
+        self.db.execute("delete from fwords")
+        self.db.execute("delete from words")
+        self.db.execute("delete from media_refs")
         for m in self.models().values():
             self.updateFieldCache(m.fids())
+        # scheduler counts
+        self.sched.invalidateCounts()
+        # daily review totals
+        self.rebuildDaily()
         # and finally, optimize
         self.optimize()
         newSize = os.stat(self.path)[stat.ST_SIZE]
@@ -804,3 +1212,29 @@ select id from facts where id not in (select distinct fid from cards)""")
         self.db.execute("vacuum")
         self.db.execute("analyze")
         self.lock()
+
+# Rendering without a DB
+##########################################################################
+
+class _RenderDeck(_Deck):
+    "Enough of a deck for rendering Q/A in a worker process."
+
+    def __init__(self, mediaDir, mediaNames):
+        self.db = None
+        self.media = _RenderMedia(mediaDir, mediaNames)
+
+class _RenderMedia(object):
+    "Media lookups from a copy of the manifest."
+
+    def __init__(self, dir, names):
+        self._dir = dir
+        self._names = names
+
+    def dir(self, create=False):
+        return self._dir
+
+    def have(self, fname):
+        if fname in self._names:
+            return True
+        return bool(self._dir and
+                    os.path.exists(os.path.join(self._dir, fname)))
@@ -8,13 +8,15 @@ from anki.utils import fieldChecksum, intTime, \
     joinFields, splitFields, ids2str, parseTags, canonifyTags, hasTag
 
 class Fact(object):
+    __slots__ = ("deck", "id", "mid", "gid", "crt", "mod", "tags", "fields",
+                 "data", "_model", "_fmap", "__weakref__")
 
-    def __init__(self, deck, model=None, id=None):
-        assert not (model and id)
+    def __init__(self, deck, model=None, id=None, row=None):
+        assert not (model and id and not row)
         self.deck = deck
         if id:
             self.id = id
-            self.load()
+            self.load(row, model)
         else:
             self.id = None
             self._model = model
@@ -27,18 +29,19 @@ class Fact(object):
             self.data = ""
             self._fmap = self._model.fieldMap()
 
-    def load(self):
+    def load(self, row=None, model=None):
+        "Load from the DB, or from ROW and MODEL if provided."
         (self.mid,
          self.gid,
          self.crt,
          self.mod,
          self.tags,
          self.fields,
-         self.data) = self.deck.db.first("""
+         self.data) = row or self.deck.db.first("""
 select mid, gid, crt, mod, tags, flds, data from facts where id = ?""", self.id)
         self.fields = splitFields(self.fields)
         self.tags = parseTags(self.tags)
-        self._model = self.deck.getModel(self.mid)
+        self._model = model or self.deck.getModel(self.mid)
         self._fmap = self._model.fieldMap()
 
     def flush(self):
@@ -46,20 +49,28 @@ select mid, gid, crt, mod, tags, flds, data from facts where id = ?""", self.id)
         # facts table
         sfld = self.fields[self._model.sortIdx()]
         tags = self.stringTags()
+        flds = self.joinedFields()
         res = self.deck.db.execute("""
 insert or replace into facts values (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                             self.id, self.mid, self.gid, self.crt,
-                            self.mod, tags, self.joinedFields(),
-                            sfld, self.data)
+                            self.mod, tags, flds, sfld, self.data)
         self.id = res.lastrowid
         self.updateFieldChecksums()
-        self.deck.registerTags(self.tags)
+        self.deck.indexWords([(self.id, flds)])
+        self.deck.media.indexFacts([(self.id, flds)])
+        self.deck.registerTags(parseTags(tags))
+        self.deck.indexTags([(self.id, tags)])
 
     def joinedFields(self):
         return joinFields(self.fields)
 
     def updateFieldChecksums(self):
         self.deck.db.execute("delete from fsums where fid = ?", self.id)
+        self.deck.db.executemany("insert into fsums values (?, ?, ?)",
+                                 self._fieldChecksums())
+
+    def _fieldChecksums(self):
+        "Return fsums rows for the unique fields."
         d = []
         for (ord, conf) in self._fmap.values():
             if not conf['uniq']:
@@ -68,11 +79,15 @@ insert or replace into facts values (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
             if not val:
                 continue
             d.append((self.id, self.mid, fieldChecksum(val)))
-        self.deck.db.executemany("insert into fsums values (?, ?, ?)", d)
+        return d
 
     def cards(self):
-        return [self.deck.getCard(id) for id in self.deck.db.list(
-            "select id from cards where fid = ? order by ord", self.id)]
+        cards = self.deck.getCards(self.deck.db.list(
+            "select id from cards where fid = ? order by ord", self.id))
+        for c in cards:
+            if not c._rd:
+                c._rd = [self, self._model]
+        return cards
 
     def model(self):
         return self._model
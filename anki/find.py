@@ -29,6 +29,21 @@ def fieldNames(deck, downcase=True):
         return list(fields)
     return names
 
+def factWords(flds):
+    "Return the set of words in FLDS, both with and without HTML."
+    words = set()
+    for txt in (flds, stripHTML(flds)):
+        for w in re.findall(r"(?u)\w+", txt):
+            words.add(w.lower())
+    return words
+
+def searchWords(val):
+    "Words in search term VAL usable with the word index, or None."
+    # like wildcards and escapes may span word boundaries
+    if re.search(r"[%_\\]", val):
+        return None
+    return [w.lower() for w in re.findall(r"(?u)\w+", val)] or None
+
 # Find
 ##########################################################################
 
@@ -36,9 +51,18 @@ class Finder(object):
 
     def __init__(self, deck):
         self.deck = deck
+        self.db = None
 
     def findCards(self, query, full=False):
         "Return a list of card ids for QUERY."
+        with self.deck.reader() as db:
+            self.db = db
+            try:
+                return self._findCards(query, full)
+            finally:
+                self.db = None
+
+    def _findCards(self, query, full):
         self.query = query
         self.full = full
         self._findLimits()
@@ -46,7 +70,7 @@ class Finder(object):
             return []
         (q, args) = self._whereClause()
         query = self._orderedSelect(q)
-        res = self.deck.db.list(query, **args)
+        res = self.db.list(query, **args)
         if self.deck.conf['sortBackwards']:
             res.reverse()
         return res
@@ -117,7 +141,7 @@ order by %s""" % (lim, sort)
             elif type == SEARCH_TEMPLATE:
                 self._findTemplate(token, isNeg)
             elif type == SEARCH_FIELD:
-                self._findField(token, isNeg)
+                self._findField(token, isNeg, c)
             elif type == SEARCH_MODEL:
                 self._findModel(token, isNeg, c)
             elif type == SEARCH_GROUP:
@@ -127,17 +151,15 @@ order by %s""" % (lim, sort)
 
     def _findTag(self, val, neg, c):
         if val == "none":
-            self.lims['fact'].append("select id from facts where tags = ''")
+            self.lims['fact'].append("id %s in (select fid from ftags)" % (
+                "" if neg else "not"))
             return
         extra = "not" if neg else ""
         val = val.replace("*", "%")
-        if not val.startswith("%"):
-            val = "% " + val
-        if not val.endswith("%"):
-            val += " %"
         self.lims['args']["_tag_%d" % c] = val
-        self.lims['fact'].append(
-            "tags %s like :_tag_%d""" % (extra, c))
+        self.lims['fact'].append("""
+id %s in (select fid from ftags where tid in
+(select id from tags where name like :_tag_%d))""" % (extra, c))
 
     def _findCardState(self, val, neg):
         cond = None
@@ -162,22 +184,49 @@ order by %s""" % (lim, sort)
         else:
             self.lims['valid'] = False
 
+    def _wordLimit(self, val, c):
+        """Return (sql, args) limiting facts to those which may contain VAL,
+or None if the word index can't be used."""
+        words = searchWords(val)
+        if not words:
+            return None
+        lims = []
+        args = {}
+        for n, w in enumerate(words):
+            key = "_word_%d_%d" % (c, n)
+            lims.append("id in (select fid from fwords where wid in "
+                        "(select id from words where word like :%s))" % key)
+            args[key] = "%"+w+"%"
+        return " and ".join(lims), args
+
     def _findText(self, val, neg, c):
         val = val.replace("*", "%")
-        extra = "not" if neg else ""
+        # the word index only narrows the search; the match itself is
+        # checked against the field text as before
+        wlim = self._wordLimit(val, c)
         if not self.full:
             self.lims['args']["_text_%d"%c] = "%"+val+"%"
-            self.lims['fact'].append("flds %s like :_text_%d escape '\\'" % (
-                extra, c))
+            cond = "flds like :_text_%d escape '\\'" % c
+            if wlim:
+                cond = "(%s and %s)" % (wlim[0], cond)
+                self.lims['args'].update(wlim[1])
+            if neg:
+                cond = "not %s" % cond
+            self.lims['fact'].append(cond)
         else:
             # in the future we may want to apply this at the end to speed up
             # the case where there are other limits
             fids = []
-            for fid, flds in self.deck.db.execute(
-                "select id, flds from facts"):
+            if wlim:
+                sql = "select id, flds from facts where " + wlim[0]
+                args = wlim[1]
+            else:
+                sql = "select id, flds from facts"
+                args = {}
+            for fid, flds in self.db.execute(sql, **args):
                 if val in stripHTML(flds):
                     fids.append(fid)
-            self.lims['fact'].append("id in " + ids2str(fids))
+            self.lims['fact'].append("id in " + self.db.ids2str(fids))
 
     def _findFids(self, val):
         self.lims['fact'].append("id in (%s)" % val)
@@ -221,11 +270,12 @@ order by %s""" % (lim, sort)
             self.lims['card'].append("(" + " or ".join(lims) + ")")
         self.lims['valid'] = found
 
-    def _findField(self, token, isNeg):
+    def _findField(self, token, isNeg, c):
         field = value = ''
         parts = token.split(':', 1);
         field = parts[0].lower()
         value = "%" + parts[1].replace("*", "%") + "%"
+        wlim = self._wordLimit(parts[1].replace("*", "%"), c)
         # find models that have that field
         mods = {}
         for m in self.deck.models().values():
@@ -239,11 +289,15 @@ order by %s""" % (lim, sort)
         # gather fids
         regex = value.replace("%", ".*")
         fids = []
-        for (id,mid,flds) in self.deck.db.execute("""
+        lim = ""
+        args = {'_fld': "%" if self.full else value}
+        if wlim:
+            lim = "and " + wlim[0]
+            args.update(wlim[1])
+        for (id,mid,flds) in self.db.execute("""
 select id, mid, flds from facts
-where mid in %s and flds like ? escape '\\'""" % (
-                         ids2str(mods.keys())),
-                         "%" if self.full else value):
+where mid in %s and flds like :_fld escape '\\' %s""" % (
+                         ids2str(mods.keys()), lim), **args):
             flds = splitFields(flds)
             ord = mods[mid][1]
             str = flds[ord]
@@ -252,7 +306,8 @@ where mid in %s and flds like ? escape '\\'""" % (
             if re.search(regex, str):
                 fids.append(id)
         extra = "not" if isNeg else ""
-        self.lims['fact'].append("id %s in %s" % (extra, ids2str(fids)))
+        self.lims['fact'].append("id %s in %s" % (
+            extra, self.db.ids2str(fids)))
 
     # Most of this function was written by Marcus
     def _parseQuery(self):
@@ -390,7 +445,7 @@ def findReplace(deck, fids, src, dst, regex=False, field=None, fold=True):
         return re.sub(regex, dst, str)
     d = []
     for fid, mid, flds in deck.db.execute(
-        "select id, mid, flds from facts where id in "+ids2str(fids)):
+        "select id, mid, flds from facts where id in "+deck.db.ids2str(fids)):
         origFlds = flds
         # does it match?
         sflds = splitFields(flds)
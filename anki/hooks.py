@@ -32,6 +32,10 @@ def runFilter(hook, arg, *args):
             arg = func(arg, *args)
     return arg
 
+def hasHook(hook):
+    "True if any functions are on hook."
+    return bool(_hooks.get(hook, None))
+
 def addHook(hook, func):
     "Add a function to hook. Ignore if already on hook."
     if not _hooks.get(hook, None):
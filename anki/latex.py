@@ -2,8 +2,9 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import re, os, sys, shutil, cgi, subprocess
-from anki.utils import checksum, call, namedtmp, tmpdir, isMac, stripHTML
+import re, os, sys, shutil, cgi, subprocess, tempfile, multiprocessing, \
+    threading, contextlib
+from anki.utils import checksum, call, isMac, stripHTML, splitFields
 from anki.hooks import addHook
 from htmlentitydefs import entitydefs
 from anki.lang import _
@@ -11,11 +12,15 @@ from anki.lang import _
 latexCmd = ["latex", "-interaction=nonstopmode"]
 latexDviPngCmd = ["dvipng", "-D", "200", "-T", "tight"]
 build = True # if off, use existing media but don't create new
+# per-thread override of build; see noBuild()
+_local = threading.local()
 regexps = {
     "standard": re.compile(r"\[latex\](.+?)\[/latex\]", re.DOTALL | re.IGNORECASE),
     "expression": re.compile(r"\[\$\](.+?)\[/\$\]", re.DOTALL | re.IGNORECASE),
     "math": re.compile(r"\[\$\$\](.+?)\[/\$\$\]", re.DOTALL | re.IGNORECASE),
     }
+# opening tags of the above, for finding facts that may contain latex
+tags = ("[latex]", "[$]", "[$$]")
 
 # add standard tex install location to osx
 if isMac:
@@ -32,25 +37,28 @@ def stripLatex(text):
 
 def mungeQA(html, type, fields, model, gname, data, deck):
     "Convert TEXT with embedded latex tags to image links."
+    for (full, latex) in _snippets(html):
+        html = html.replace(full, _imgLink(deck, latex, model))
+    return html
+
+def _snippets(html):
+    "Yield (matched text, latex) for each latex tag in HTML."
     for match in regexps['standard'].finditer(html):
-        html = html.replace(match.group(), _imgLink(deck, match.group(1), model))
+        yield (match.group(), match.group(1))
     for match in regexps['expression'].finditer(html):
-        html = html.replace(match.group(), _imgLink(
-            deck, "$" + match.group(1) + "$", model))
+        yield (match.group(), "$" + match.group(1) + "$")
     for match in regexps['math'].finditer(html):
-        html = html.replace(match.group(), _imgLink(
-            deck,
-            "\\begin{displaymath}" + match.group(1) + "\\end{displaymath}", model))
-    return html
+        yield (match.group(),
+               "\\begin{displaymath}" + match.group(1) + "\\end{displaymath}")
 
 def _imgLink(deck, latex, model):
     "Return an img link for LATEX, creating if necesssary."
     txt = _latexFromHtml(deck, latex)
     fname = "latex-%s.png" % checksum(txt)
     link = '<img src="%s">' % fname
-    if os.path.exists(fname):
+    if deck.media.have(fname):
         return link
-    elif not build:
+    elif not build or getattr(_local, "noBuild", False):
         return "[latex]"+latex+"[/latex]"
     else:
         err = _buildImg(deck, txt, fname, model)
@@ -59,6 +67,16 @@ def _imgLink(deck, latex, model):
         else:
             return link
 
+@contextlib.contextmanager
+def noBuild():
+    "Don't build missing images in the current thread while in this block."
+    old = getattr(_local, "noBuild", False)
+    _local.noBuild = True
+    try:
+        yield
+    finally:
+        _local.noBuild = old
+
 def _latexFromHtml(deck, latex):
     "Convert entities, fix newlines, and convert to utf8."
     for match in re.compile("&([a-z]+);", re.IGNORECASE).finditer(latex):
@@ -69,40 +87,51 @@ def _latexFromHtml(deck, latex):
     latex = latex.encode("utf-8")
     return latex
 
+def _fullLatex(model, latex):
+    "Add the model's header and footer to LATEX."
+    return (model.conf["latexPre"] + "\n" +
+            latex + "\n" +
+            model.conf["latexPost"])
+
 def _buildImg(deck, latex, fname, model):
-    # add header/footer
-    latex = (model.conf["latexPre"] + "\n" +
-             latex + "\n" +
-             model.conf["latexPost"])
-    # write into a temp file
-    log = open(namedtmp("latex_log.txt"), "w")
-    texfile = file(namedtmp("tmp.tex"), "w")
-    texfile.write(latex)
-    texfile.close()
     # make sure we have a valid mediaDir
     mdir = deck.media.dir(create=True)
-    oldcwd = os.getcwd()
-    png = namedtmp("tmp.png")
+    err = _build(_fullLatex(model, latex), mdir, fname)
+    if not err:
+        deck.media.addManifest(fname)
+    return err
+
+def _build(latex, mdir, fname):
+    """Build LATEX into MDIR/FNAME, returning an error message on failure.
+Each build uses its own temp dir, so builds can run in parallel."""
+    dir = tempfile.mkdtemp(prefix="anki-latex-")
     try:
-        # generate dvi
-        os.chdir(tmpdir())
-        if call(latexCmd + ["tmp.tex"], stdout=log, stderr=log):
-            return _errMsg("latex")
-        # and png
-        if call(latexDviPngCmd + ["tmp.dvi", "-o", "tmp.png"],
-                stdout=log, stderr=log):
-            return _errMsg("dvipng")
-        # add to media
-        shutil.copy2(png,
-                     os.path.join(mdir, fname))
-        return
+        # write into a temp file
+        texfile = file(os.path.join(dir, "tmp.tex"), "w")
+        texfile.write(latex)
+        texfile.close()
+        log = open(os.path.join(dir, "latex_log.txt"), "w")
+        try:
+            # generate dvi
+            if call(latexCmd + ["tmp.tex"], stdout=log, stderr=log, cwd=dir):
+                return _errMsg("latex", dir)
+            # and png
+            if call(latexDviPngCmd + ["tmp.dvi", "-o", "tmp.png"],
+                    stdout=log, stderr=log, cwd=dir):
+                return _errMsg("dvipng", dir)
+        finally:
+            log.close()
+        # add to media; renamed into place so a partial file is never seen
+        tmp = os.path.join(mdir, ".%s.tmp" % fname)
+        shutil.copy2(os.path.join(dir, "tmp.png"), tmp)
+        os.rename(tmp, os.path.join(mdir, fname))
     finally:
-        os.chdir(oldcwd)
+        shutil.rmtree(dir, ignore_errors=True)
 
-def _errMsg(type):
+def _errMsg(type, dir):
     msg = (_("Error executing %s.") % type) + "<br>"
     try:
-        log = open(namedtmp("latex_log.txt")).read()
+        log = open(os.path.join(dir, "latex_log.txt")).read()
         if not log:
             raise Exception()
         msg += "<small><pre>" + cgi.escape(log) + "</pre></small>"
@@ -111,5 +140,51 @@ def _errMsg(type):
         pass
     return msg
 
+# Batch generation
+##########################################################################
+# Builds the images for all latex in the deck's fields up front, on several
+# processes, so rendering cards only has to look them up. Latex added by
+# templates is still built when the card is rendered.
+
+def buildAll(deck, procs=None):
+    """Build missing images for the latex in the deck's fields, using PROCS
+processes (default: one per CPU). Return {fname: error} for any that failed."""
+    todo = {}
+    mods = deck.models()
+    for (mid, flds) in deck.db.execute(
+        "select mid, flds from facts where " + " or ".join(
+            "flds like '%%%s%%'" % tag for tag in tags)):
+        for fld in splitFields(flds):
+            for (full, latex) in _snippets(fld):
+                txt = _latexFromHtml(deck, latex)
+                fname = "latex-%s.png" % checksum(txt)
+                if fname not in todo and not deck.media.have(fname):
+                    todo[fname] = _fullLatex(mods[mid], txt)
+    if not todo or not build:
+        return {}
+    mdir = deck.media.dir(create=True)
+    jobs = [(latex, mdir, fname) for (fname, latex) in todo.items()]
+    if procs is None:
+        procs = multiprocessing.cpu_count()
+    if procs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(procs, len(jobs)))
+        try:
+            res = pool.map(_buildJob, jobs)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        res = map(_buildJob, jobs)
+    errors = {}
+    for ((latex, mdir, fname), err) in zip(jobs, res):
+        if err:
+            errors[fname] = err
+        else:
+            deck.media.addManifest(fname)
+    return errors
+
+def _buildJob(args):
+    return _build(*args)
+
 # setup q/a filter
 addHook("mungeQA", mungeQA)
@@ -4,8 +4,9 @@
 
 import os, shutil, re, urllib, urllib2, time, unicodedata, \
     urllib, sys, shutil
-from anki.utils import checksum, intTime, namedtmp, isWin
+from anki.utils import fileChecksum, intTime, namedtmp, isWin, splitFields
 from anki.lang import _
+import anki.latex
 
 class MediaRegistry(object):
 
@@ -18,6 +19,8 @@ class MediaRegistry(object):
     def __init__(self, deck):
         self.deck = deck
         self._dir = None
+        # filenames in the manifest, loaded when needed
+        self._names = None
         self._updateDir()
 
     def dir(self, create=False):
@@ -62,17 +65,22 @@ class MediaRegistry(object):
 
     def addFile(self, opath):
         """Copy PATH to MEDIADIR, and return new filename.
-If the same name exists, compare checksums."""
+If a file with the same contents is already there, return its name instead."""
         mdir = self.dir(create=True)
+        csum = fileChecksum(opath)
+        existing = self._findChecksum(csum)
+        if existing:
+            return existing
         # remove any dangerous characters
         base = re.sub(r"[][<>:/\\&]", "", os.path.basename(opath))
         dst = os.path.join(mdir, base)
         # if it doesn't exist, copy it directly
         if not os.path.exists(dst):
             shutil.copy2(opath, dst)
+            self.addManifest(base, csum)
             return base
         # if it's identical, reuse
-        if self.filesIdentical(opath, dst):
+        if self._checksum(base) == csum:
             return base
         # otherwise, find a unique name
         (root, ext) = os.path.splitext(base)
@@ -90,12 +98,107 @@ If the same name exists, compare checksums."""
                 root = re.sub(reg, repl, root)
         # copy and return
         shutil.copy2(opath, path)
-        return os.path.basename(os.path.basename(path))
+        base = os.path.basename(path)
+        self.addManifest(base, csum)
+        return base
 
     def filesIdentical(self, path1, path2):
         "True if files are the same."
-        return (checksum(open(path1, "rb").read()) ==
-                checksum(open(path2, "rb").read()))
+        return fileChecksum(path1) == fileChecksum(path2)
+
+    # Manifest
+    ##########################################################################
+    # media_files records the size, mtime and checksum of each file in the
+    # media folder. A file whose size and mtime haven't changed is assumed
+    # to be unchanged, so it's only read when it's new or has been modified.
+
+    def scan(self):
+        """Update the manifest from the media folder.
+Return (added or changed, removed) filenames."""
+        mdir = self.dir()
+        if not mdir:
+            return ([], [])
+        if not isinstance(mdir, unicode):
+            # so the names are listed as unicode, as they're stored
+            mdir = mdir.decode(sys.getfilesystemencoding())
+        known = dict((r[0], r[1:]) for r in self.deck.db.execute(
+            "select fname, size, mtime from media_files"))
+        changed = []
+        for f in os.listdir(mdir):
+            path = os.path.join(mdir, f)
+            if not os.path.isfile(path):
+                # ignore directories
+                continue
+            st = os.stat(path)
+            if known.pop(f, None) != (st.st_size, int(st.st_mtime)):
+                changed.append(f)
+        self.deck.db.executemany(
+            "insert or replace into media_files values (?, ?, ?, ?)",
+            [self._manifestRow(f) for f in changed])
+        removed = known.keys()
+        self.deck.db.executemany(
+            "delete from media_files where fname = ?", [(f,) for f in removed])
+        self._names = None
+        return (changed, removed)
+
+    def names(self):
+        "The set of filenames in the manifest."
+        if self._names is None:
+            self._names = set(self.deck.db.list(
+                "select fname from media_files"))
+        return self._names
+
+    def have(self, fname):
+        """True if FNAME is in the media folder. Only files missing from the
+manifest are looked for on disk, and remembered if found until the next
+scan() adds them."""
+        names = self.names()
+        if fname in names:
+            return True
+        mdir = self.dir()
+        if mdir and os.path.exists(os.path.join(mdir, fname)):
+            names.add(fname)
+            return True
+        return False
+
+    def _manifestRow(self, fname, csum=None):
+        path = os.path.join(self.dir(), fname)
+        st = os.stat(path)
+        return (fname, st.st_size, int(st.st_mtime),
+                csum or fileChecksum(path))
+
+    def addManifest(self, fname, csum=None):
+        "Record FNAME, which has been added to the media folder."
+        self.deck.db.execute(
+            "insert or replace into media_files values (?, ?, ?, ?)",
+            *self._manifestRow(fname, csum))
+        if self._names is not None:
+            self._names.add(fname)
+
+    def _checksum(self, fname):
+        "Checksum of FNAME, rehashing it only if it has changed."
+        path = os.path.join(self.dir(), fname)
+        st = os.stat(path)
+        row = self.deck.db.first(
+            "select size, mtime, csum from media_files where fname = ?", fname)
+        if row and row[:2] == (st.st_size, int(st.st_mtime)):
+            return row[2]
+        row = self._manifestRow(fname)
+        self.deck.db.execute(
+            "insert or replace into media_files values (?, ?, ?, ?)", *row)
+        return row[3]
+
+    def _findChecksum(self, csum):
+        "Name of an unchanged file with checksum CSUM, or None."
+        for (fname, size, mtime) in self.deck.db.execute(
+            "select fname, size, mtime from media_files where csum = ?",
+            csum).fetchall():
+            try:
+                st = os.stat(os.path.join(self.dir(), fname))
+            except OSError:
+                continue
+            if (st.st_size, int(st.st_mtime)) == (size, mtime):
+                return fname
 
     # String manipulation
     ##########################################################################
@@ -131,6 +234,86 @@ If the same name exists, compare checksums."""
                 fname, urllib.quote(fname.encode("utf-8")))
         return re.sub(self.regexps[1], repl, string)
 
+    # Reference index
+    ##########################################################################
+    # media_refs records the local files each fact's fields refer to, and is
+    # updated along with the word index. Files used by the templates are found
+    # by scanning the models, so checking doesn't need to render any cards.
+    # Templates which name a file through a field are filled in from the
+    # facts of their model.
+
+    def indexFacts(self, facts):
+        "Update the reference index for FACTS, a list of (fid, flds)."
+        if not facts:
+            return
+        self.deck.db.execute("delete from media_refs where fid in "+
+                             self.deck.db.ids2str([f[0] for f in facts]))
+        d = []
+        for (fid, flds) in facts:
+            low = flds.lower()
+            if "[sound:" not in low and "<img" not in low:
+                continue
+            fnames = set()
+            for fld in splitFields(flds):
+                fnames.update(self.mediaFiles(fld))
+            d.extend((fid, f) for f in fnames)
+        self.deck.db.executemany("insert into media_refs values (?, ?)", d)
+
+    def rebuildRefs(self):
+        "Rebuild the reference index for the whole deck."
+        self.deck.db.execute("delete from media_refs")
+        self.indexFacts(self.deck.db.all("select id, flds from facts"))
+
+    def templateRefs(self):
+        """Return {mid: set of filenames} referenced by each model's templates.
+References to fields, like <img src="{{Front}}">, are left to fieldRefs()."""
+        refs = {}
+        for m in self.deck.models().values():
+            refs[m.id] = set(
+                f for f in self._templateFiles(m) if "{{" not in f)
+        return refs
+
+    def fieldRefs(self):
+        """Return the set of filenames templates refer to through fields, like
+<img src="{{Front}}"> or [sound:{{Audio}}], filled in from each fact."""
+        files = set()
+        for m in self.deck.models().values():
+            refs = [f for f in self._templateFiles(m) if "{{" in f]
+            if not refs:
+                continue
+            fmap = m.fieldMap()
+            for (flds,) in self.deck.db.execute(
+                "select flds from facts where mid = ?", m.id):
+                vals = splitFields(flds)
+                for ref in refs:
+                    fname = self._fillRef(ref, fmap, vals)
+                    if fname:
+                        files.add(fname)
+        return files
+
+    def _templateFiles(self, model):
+        files = set()
+        for t in model.templates:
+            for fmt in ('qfmt', 'afmt'):
+                files.update(self.mediaFiles(t[fmt]))
+        return files
+
+    def _fillRef(self, ref, fmap, vals):
+        """REF with its fields replaced by their values in VALS, or None if a
+field is unknown or empty, or the result isn't a local file."""
+        ok = [True]
+        def repl(match):
+            # {{text:Front}} uses the Front field
+            f = fmap.get(match.group(1).split(":")[-1].strip())
+            val = vals[f[0]].strip() if f else ""
+            if not val:
+                ok[0] = False
+            return val
+        fname = re.sub("{{([^}]+)}}", repl, ref)
+        if not ok[0] or re.match("(https?|ftp)://", fname.lower()):
+            return None
+        return fname
+
     # Rebuilding DB
     ##########################################################################
 
@@ -139,7 +322,9 @@ If the same name exists, compare checksums."""
         mdir = self.dir()
         if not mdir:
             return (0, 0)
-        # generate card q/a and look through all references
+        # latex images are named after their content, so aren't checked, but
+        # any missing are built
+        anki.latex.buildAll(self.deck)
         normrefs = {}
         def norm(s):
             if isinstance(s, unicode):
@@ -148,14 +333,11 @@ If the same name exists, compare checksums."""
         for f in self.allMedia():
             normrefs[norm(f)] = True
         # loop through directory and find unused & missing media
+        self.scan()
         unused = []
-        for file in os.listdir(mdir):
+        for file in self.deck.db.list("select fname from media_files"):
             if file.startswith("latex-"):
                 continue
-            path = os.path.join(mdir, file)
-            if not os.path.isfile(path):
-                # ignore directories
-                continue
             nfile = norm(file)
             if nfile not in normrefs:
                 unused.append(file)
@@ -166,16 +348,18 @@ If the same name exists, compare checksums."""
             for f in unused:
                 path = os.path.join(mdir, f)
                 os.unlink(path)
+            self.deck.db.executemany(
+                "delete from media_files where fname = ?", [(f,) for f in unused])
+            self._names = None
         nohave = normrefs.keys()
         return (nohave, unused)
 
     def allMedia(self):
-        "Return a set of all referenced filenames."
-        files = set()
-        for p in self.deck.renderQA(type="all"):
-            for type in ("q", "a"):
-                for f in self.mediaFiles(p[type]):
-                    files.add(f)
+        "Return a set of all referenced filenames, excluding latex images."
+        files = set(self.deck.db.list("select distinct fname from media_refs"))
+        for refs in self.templateRefs().values():
+            files.update(refs)
+        files.update(self.fieldRefs())
         return files
 
     # Download missing
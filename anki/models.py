@@ -5,6 +5,8 @@
 import simplejson
 from anki.utils import intTime, hexifyID, joinFields, splitFields, ids2str
 from anki.lang import _
+from anki.template import CompiledTemplate
+from anki.template.template import constants
 
 # Models
 ##########################################################################
@@ -57,11 +59,13 @@ defaultTemplate = {
 
 class Model(object):
 
-    def __init__(self, deck, id=None):
+    def __init__(self, deck, id=None, db=None):
         self.deck = deck
+        self._compiled = {}
+        self._reqs = {}
         if id:
             self.id = id
-            self.load()
+            self.load(db)
         else:
             self.id = None
             self.name = u""
@@ -72,21 +76,26 @@ class Model(object):
             self.fields = []
             self.templates = []
 
-    def load(self):
+    def load(self, db=None):
+        "Load from the deck's DB, or DB if provided."
         (self.crt,
          self.mod,
          self.name,
          self.fields,
          self.templates,
          self.conf,
-         self.css) = self.deck.db.first("""
+         self.css) = (db or self.deck.db).first("""
 select crt, mod, name, flds, tmpls, conf, css from models where id = ?""", self.id)
         self.fields = simplejson.loads(self.fields)
         self.templates = simplejson.loads(self.templates)
         self.conf = simplejson.loads(self.conf)
+        self._compiled = {}
+        self._reqs = {}
 
     def flush(self):
         self.mod = intTime()
+        self._compiled = {}
+        self._reqs = {}
         self.css = self.genCSS()
         ret = self.deck.db.execute("""
 insert or replace into models values (?, ?, ?, ?, ?, ?, ?, ?)""",
@@ -105,6 +114,21 @@ insert or replace into models values (?, ?, ?, ?, ?, ?, ?, ?)""",
         return self.deck.db.scalar(
             "select count() from facts where mid = ?", self.id)
 
+    def compiledTemplate(self, fmt):
+        "Return FMT parsed for rendering. Cached until the model is flushed."
+        if fmt not in self._compiled:
+            self._compiled[fmt] = CompiledTemplate(fmt)
+        return self._compiled[fmt]
+
+    def requirements(self, fmt):
+        "Return FMT's required fields analysis, or None. Cached like above."
+        names = tuple(f['name'] for f in self.fields)
+        key = (fmt, names)
+        if key not in self._reqs:
+            fields = set(names) - set(constants)
+            self._reqs[key] = self.compiledTemplate(fmt).requirements(fields)
+        return self._reqs[key]
+
     # Copying
     ##################################################
 
@@ -194,6 +218,9 @@ insert or replace into models values (?, ?, ?, ?, ?, ?, ?, ?)""",
             del fields[idx]
             return fields
         self._transformFields(delete)
+        # the field's media is no longer used
+        self.deck.media.indexFacts(self.deck.db.all(
+            "select id, flds from facts where mid = ?", self.id))
         if idx == self.sortIdx():
             # need to rebuild
             self.deck.updateFieldCache(self.fids(), csum=False)
@@ -308,7 +335,8 @@ select id from facts where mid = ?)""" % " ".join(map), self.id)
         d = []
         nfields = len(newModel.fields)
         for (fid, flds) in self.deck.db.execute(
-            "select id, flds from facts where id in "+ids2str(fids)):
+            "select id, flds from facts where id in "+
+            self.deck.db.ids2str(fids)):
             newflds = {}
             flds = splitFields(flds)
             for old, new in map.items():
@@ -326,7 +354,8 @@ select id from facts where mid = ?)""" % " ".join(map), self.id)
         d = []
         deleted = []
         for (cid, ord) in self.deck.db.execute(
-            "select id, ord from cards where fid in "+ids2str(fids)):
+            "select id, ord from cards where fid in "+
+            self.deck.db.ids2str(fids)):
             if map[ord] is not None:
                 d.append(dict(cid=cid, new=map[ord]))
             else:
@@ -2,14 +2,18 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import time, datetime, simplejson, random, itertools
+import time, datetime, simplejson, random, itertools, threading
 from operator import itemgetter
 from heapq import *
-#from anki.cards import Card
+from anki.cards import Card
+from anki.facts import Fact
+from anki.models import Model
+import anki.latex
 from anki.utils import parseTags, ids2str, intTime, fmtTimeSpan
 from anki.lang import _, ngettext
 from anki.consts import *
 from anki.hooks import runHook
+from anki.errors import AnkiError
 
 # revlog:
 # types: 0=lrn, 1=rev, 2=relrn, 3=cram
@@ -23,6 +27,22 @@ class Scheduler(object):
         self.queueLimit = 200
         self.reportLimit = 1000
         self.reps = 0
+        self._cnts = None
+        self._sibDues = {}
+        # see _touch()
+        self._serial = 0
+        self._validFrom = 0
+        self._touched = {}
+        self._replay = None
+        # cards to load ahead of time; see prefetch()
+        self.prefetchSize = 0
+        self._prefetched = {}
+        self._prefetchLock = threading.Lock()
+        self._prefetchThread = None
+        self._prefetchGen = 0
+        self._revNext = None
+        self._revGen = 0
+        self._answered = set()
         self._updateCutoff()
 
     def getCard(self):
@@ -30,11 +50,15 @@ class Scheduler(object):
         self._checkDay()
         id = self._getCardId()
         if id:
-            c = self.deck.getCard(id)
+            c = self._prefetchedCard(id) or self.deck.getCard(id)
             c.startTimer()
+            if self.prefetchSize and self.deck.pool:
+                self._startPrefetch()
             return c
 
     def reset(self):
+        self._clearPrefetch()
+        self._sibDues = {}
         self._resetConf()
         self._resetCounts()
         self._resetLrn()
@@ -42,9 +66,15 @@ class Scheduler(object):
         self._resetNew()
 
     def answerCard(self, card, ease):
-        assert ease >= 1 and ease <= 4
         self.deck.markReview(card)
+        self._answerCard(card, ease)
+        card.flushSched()
+
+    def _answerCard(self, card, ease):
+        assert ease >= 1 and ease <= 4
         self.reps += 1
+        if self.prefetchSize:
+            self._answered.add(card.id)
         card.reps += 1
         if card.queue == 0:
             # put it in the learn queue
@@ -58,7 +88,61 @@ class Scheduler(object):
         else:
             raise Exception("Invalid queue")
         card.mod = intTime()
-        card.flushSched()
+
+    def answerCards(self, batch):
+        """Answer a BATCH of (cid, ease, timeTaken, answeredAt) in bulk.
+Scheduling is the same as calling answerCard() on each in turn today.
+ANSWEREDAT is only used as the time of the answer in the log and for
+learning steps; review due dates are still counted from today. Raises
+AnkiError if any card doesn't exist. Clears undo."""
+        if not batch:
+            return
+        cids = list(set(b[0] for b in batch))
+        cards = {}
+        for row in self.deck.db.execute(
+            "select * from cards where id in "+self.deck.db.ids2str(cids)):
+            c = Card(self.deck)
+            c.load(row)
+            cards[c.id] = c
+        missing = [cid for cid in cids if cid not in cards]
+        if missing:
+            raise AnkiError("missingCards", ids=missing)
+        self.deck.clearUndo()
+        # siblings are only updated in memory until the end
+        self._loadSiblings(cids)
+        suspended = False
+        for (cid, ease, taken, at) in batch:
+            c = cards[cid]
+            self._adjCnts([(c.id, c.fid, c.gid, c.queue, c.due)], -1)
+            self._replay = (at, taken)
+            try:
+                self._answerCard(c, ease)
+            finally:
+                self._replay = None
+            self._adjCnts([(c.id, c.fid, c.gid, c.queue, c.due)], 1)
+            suspended = suspended or c.queue == -1
+        self.deck.db.executemany("""
+update cards set
+mod=?, type=?, queue=?, due=?, ivl=?, factor=?, reps=?, lapses=?, grade=?,
+cycles=?, edue=? where id = ?""", [
+            (c.mod, c.type, c.queue, c.due, c.ivl, c.factor, c.reps, c.lapses,
+             c.grade, c.cycles, c.edue, c.id) for c in cards.values()])
+        self._touch(cids)
+        self.deck.flushRevlog()
+        if suspended:
+            # leeches were suspended against the old card state
+            self.invalidateCounts()
+
+    def _now(self):
+        "The current time, or the time of the answer being replayed."
+        if self._replay:
+            return self._replay[0]
+        return time.time()
+
+    def _timeTaken(self, card):
+        if self._replay:
+            return self._replay[1]
+        return card.timeTaken()
 
     def counts(self):
         "Does not include fetched but unanswered."
@@ -82,6 +166,13 @@ order by due""" % self._groupLimit(),
         ret = [x[1] for x in sorted(daysd.items())]
         return ret
 
+    def simulate(self, days=30, newPerDay=None, seed=None):
+        """Project [(reviews, learning, minutes)] for each of the next DAYS.
+Requires numpy. See anki.simulate."""
+        from anki.simulate import Simulator
+        self.deck.flushRevlog()
+        return Simulator(self.deck).run(days, newPerDay, seed)
+
     def countIdx(self, card):
         return card.queue
 
@@ -95,6 +186,7 @@ order by due""" % self._groupLimit(),
         "Unbury and remove temporary suspends on close."
         self.deck.db.execute(
             "update cards set queue = type where queue between -3 and -2")
+        self.invalidateCounts()
 
     def etaStr(self):
         eta = self.eta()
@@ -104,12 +196,13 @@ order by due""" % self._groupLimit(),
 
     def eta(self):
         "A very rough estimate of time to review."
-        (cnt, sum) = self.deck.db.first("""
-select count(), sum(taken) from (select * from revlog
-order by time desc limit 10)""")
-        if not cnt:
+        # include unflushed entries
+        taken = [r[6] for r in self.deck._revlog[-10:]]
+        taken += self.deck.db.list("""
+select taken from revlog order by time desc limit %d""" % (10 - len(taken)))
+        if not taken:
             return 0
-        avg = sum / float(cnt)
+        avg = sum(taken) / float(len(taken))
         c = self.counts()
         # Here we just assume new/lrn will require 3x the number of reviews.
         # To improve on this we'll need to make grade count down so we can get
@@ -144,13 +237,8 @@ order by time desc limit 10)""")
 
     def groupCounts(self):
         "Returns [groupname, cards, due, new]"
-        gids = {}
-        for (gid, all, rev, new) in self.deck.db.execute("""
-select gid, count(),
-sum(case when queue = 2 and due <= ? then 1 else 0 end),
-sum(case when queue = 0 then 1 else 0 end)
-from cards group by gid""", self.today):
-            gids[gid] = [all, rev, new]
+        self._updateCutoff()
+        gids = self._groupCnts()
         return [[name, gid]+gids.get(gid, [0, 0, 0]) for (gid, name) in
                 self.deck.db.execute(
                     "select id, name from groups order by name")]
@@ -199,6 +287,104 @@ from cards group by gid""", self.today):
             tree.append((head, gid, all, rev, new, children))
         return tuple(tree)
 
+    # Counter cache
+    ##########################################################################
+
+    # For each group we keep [cards, due, new] in memory, and the due time of
+    # every learning card. They're adjusted as cards are changed, and rebuilt
+    # on day rollover or after invalidateCounts(). The sibling due dates used
+    # by _adjRevIvl() are kept up to date the same way. A flushed card is
+    # adjusted from its state in memory, so answering doesn't read it back,
+    # unless the card has been changed by another object or a bulk operation
+    # since it was loaded.
+
+    def invalidateCounts(self):
+        "Discard the counter cache after changing cards behind our back."
+        self._cnts = None
+        self._sibDues = {}
+        self._serial += 1
+        self._validFrom = self._serial
+        self._touched = {}
+
+    def _touch(self, ids):
+        """Note IDS have been written, and return the serial cards loaded from
+now on should record."""
+        self._serial += 1
+        for id in ids:
+            self._touched[id] = self._serial
+        return self._serial
+
+    def _stale(self, id, serial):
+        "True if card ID may have changed since SERIAL was recorded."
+        return (serial < self._validFrom or
+                self._touched.get(id, 0) > serial)
+
+    def _groupCnts(self):
+        if self._cnts is None or self._cntDay != self.today:
+            self._rebuildCnts()
+        return self._cnts
+
+    def _rebuildCnts(self):
+        self._cnts = {}
+        for (gid, all, rev, new) in self.deck.db.execute("""
+select gid, count(),
+sum(case when queue = 2 and due <= ? then 1 else 0 end),
+sum(case when queue = 0 then 1 else 0 end)
+from cards group by gid""", self.today):
+            self._cnts[gid] = [all, rev, new]
+        self._lrnCnts = dict(
+            (id, (gid, due)) for (id, gid, due) in self.deck.db.execute(
+                "select id, gid, due from cards where queue = 1"))
+        self._cntDay = self.today
+
+    def _sumCnts(self, idx):
+        "Sum of IDX in the counter cache for the selected groups."
+        cnts = self._groupCnts()
+        gids = self.deck.qconf['groups']
+        if not gids:
+            return sum(c[idx] for c in cnts.values())
+        return sum(cnts[gid][idx] for gid in gids if gid in cnts)
+
+    def _adjCnts(self, rows, delta):
+        "Add (DELTA=1) or remove (DELTA=-1) ROWS of (id, fid, gid, queue, due)."
+        for (id, fid, gid, queue, due) in rows:
+            sibs = self._sibDues.get(fid)
+            if sibs is not None:
+                if delta > 0 and queue == 2:
+                    sibs[id] = due
+                else:
+                    sibs.pop(id, None)
+            if self._cnts is None:
+                continue
+            c = self._cnts.setdefault(gid, [0, 0, 0])
+            c[0] += delta
+            if queue == 0:
+                c[2] += delta
+            elif queue == 1:
+                if delta > 0:
+                    self._lrnCnts[id] = (gid, due)
+                else:
+                    self._lrnCnts.pop(id, None)
+            elif queue == 2 and due <= self._cntDay:
+                c[1] += delta
+
+    def _cntRows(self, ids):
+        return self.deck.db.all(
+            "select id, fid, gid, queue, due from cards where id in "+
+            self.deck.db.ids2str(ids))
+
+    def _uncount(self, ids):
+        "Call before IDS are modified or deleted."
+        self._touch(ids)
+        if self._cnts is not None or self._sibDues:
+            self._adjCnts(self._cntRows(ids), -1)
+
+    def _count(self, ids):
+        "Call after IDS are modified or added."
+        self._touch(ids)
+        if self._cnts is not None or self._sibDues:
+            self._adjCnts(self._cntRows(ids), 1)
+
     # Getting the next card
     ##########################################################################
 
@@ -236,9 +422,7 @@ from cards group by gid""", self.today):
         if lim <= 0:
             self.newCount = 0
         else:
-            self.newCount = self.deck.db.scalar("""
-select count() from (select id from cards where
-queue = 0 %s limit %d)""" % (self._groupLimit(), lim))
+            self.newCount = min(lim, self._sumCnts(2))
 
     def _resetNew(self):
         lim = min(self.queueLimit, self.newCount)
@@ -247,6 +431,7 @@ select id, due from cards where
 queue = 0 %s order by due limit %d""" % (self._groupLimit(),
                                          lim))
         self.newQueue.reverse()
+        self._loadSiblings([c[0] for c in self.newQueue])
         self._updateNewCardRatio()
 
     def _getNewCard(self):
@@ -294,17 +479,21 @@ queue = 0 %s order by due limit %d""" % (self._groupLimit(),
     ##########################################################################
 
     def _resetLrnCount(self):
-        self.lrnCount = self.deck.db.scalar("""
-select count() from (select id from cards where
-queue = 1 %s and due < ? limit %d)""" % (
-            self._groupLimit(), self.reportLimit),
-            intTime() + self.deck.qconf['collapseTime'])
+        self._groupCnts()
+        cutoff = intTime() + self.deck.qconf['collapseTime']
+        gids = set(self.deck.qconf['groups'])
+        cnt = 0
+        for (gid, due) in self._lrnCnts.values():
+            if due < cutoff and (not gids or gid in gids):
+                cnt += 1
+        self.lrnCount = min(self.reportLimit, cnt)
 
     def _resetLrn(self):
         self.lrnQueue = self.deck.db.all("""
 select due, id from cards where
 queue = 1 %s and due < :lim order by due
 limit %d""" % (self._groupLimit(), self.reportLimit), lim=self.dayCutoff)
+        self._loadSiblings([c[1] for c in self.lrnQueue])
 
     def _getLrnCard(self, collapse=False):
         if self.lrnQueue:
@@ -337,10 +526,10 @@ limit %d""" % (self._groupLimit(), self.reportLimit), lim=self.dayCutoff)
             else:
                 card.grade = 0
             delay = self._delayForGrade(conf, card.grade)
-            if card.due < time.time():
+            if card.due < self._now():
                 # not collapsed; add some randomness
                 delay *= random.uniform(1, 1.25)
-            card.due = int(time.time() + delay)
+            card.due = int(self._now() + delay)
             heappush(self.lrnQueue, (card.due, card.id))
             # if it's due within the cutoff, increment count
             if delay <= self.deck.qconf['collapseTime']:
@@ -392,56 +581,59 @@ limit %d""" % (self._groupLimit(), self.reportLimit), lim=self.dayCutoff)
 
     def _logLrn(self, card, ease, conf, leaving, type):
         # limit time taken to global setting
-        taken = min(card.timeTaken(), self._cardConf(card)['maxTaken']*1000)
+        taken = min(self._timeTaken(card),
+                    self._cardConf(card)['maxTaken']*1000)
         lastIvl = -(self._delayForGrade(conf, max(0, card.grade-1)))
         ivl = card.ivl if leaving else -(self._delayForGrade(conf, card.grade))
-        def log():
-            self.deck.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, ease,
-                ivl, lastIvl,
-                card.factor, taken, type)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self.deck.logReview(card.id, ease, ivl, lastIvl, card.factor,
+                            taken, type, self._now())
 
     def removeFailed(self, ids=None):
         "Remove failed cards from the learning queue."
         extra = ""
         if ids:
-            extra = " and id in "+ids2str(ids)
+            extra = " and id in "+self.deck.db.ids2str(ids)
+        ids = self.deck.db.list(
+            "select id from cards where queue = 1 and type = 2"+extra)
+        self._uncount(ids)
         self.deck.db.execute("""
 update cards set
 due = edue, queue = 2, mod = %d
-where queue = 1 and type = 2
-%s
-""" % (intTime(), extra))
+where id in %s""" % (intTime(), self.deck.db.ids2str(ids)))
+        self._count(ids)
 
     # Reviews
     ##########################################################################
 
     def _resetRevCount(self):
-        self.revCount = self.deck.db.scalar("""
-select count() from (select id from cards where
-queue = 2 %s and due <= :lim limit %d)""" % (
-            self._groupLimit(), self.reportLimit),
-                                       lim=self.today)
+        self.revCount = min(self.reportLimit, self._sumCnts(1))
 
     def _resetRev(self):
-        self.revQueue = self.deck.db.list("""
+        with self._prefetchLock:
+            # discard any batch fetched for the old queue
+            self._revNext = None
+            self._revGen += 1
+        self.revQueue = self._revBatch(self.deck.db)
+        self._loadSiblings(self.revQueue)
+
+    def _revBatch(self, db, skip=()):
+        "The next queueLimit due cards not in SKIP, in the order they're shown."
+        if skip:
+            lim = " and id not in " + db.ids2str(skip)
+        else:
+            lim = ""
+        ids = db.list("""
 select id from cards where
-queue = 2 %s and due <= :lim order by %s limit %d""" % (
-            self._groupLimit(), self._revOrder(), self.queueLimit),
+queue = 2 %s and due <= :lim %s order by %s limit %d""" % (
+            self._groupLimit(), lim, self._revOrder(), self.queueLimit),
                                     lim=self.today)
         if self.deck.qconf['revOrder'] == REV_CARDS_RANDOM:
             r = random.Random()
             r.seed(self.today)
-            r.shuffle(self.revQueue)
+            r.shuffle(ids)
         else:
-            self.revQueue.reverse()
+            ids.reverse()
+        return ids
 
     def _getRevCard(self):
         if self._haveRevCards():
@@ -451,9 +643,24 @@ queue = 2 %s and due <= :lim order by %s limit %d""" % (
     def _haveRevCards(self):
         if self.revCount:
             if not self.revQueue:
-                self._resetRev()
+                self._nextRev()
             return self.revQueue
 
+    def _nextRev(self):
+        "Refill the empty review queue, using the prefetched batch if ready."
+        with self._prefetchLock:
+            ids = self._revNext
+            self._revNext = None
+        if ids:
+            # leave out any answered since the batch was fetched
+            ids = [id for id in ids if id not in self._answered]
+        if not ids:
+            self._resetRev()
+            return
+        self.revQueue = ids
+        # cheap, and needs the current due dates
+        self._loadSiblings(self.revQueue)
+
     def _revOrder(self):
         return ("ivl desc",
                 "ivl",
@@ -479,7 +686,7 @@ queue = 2 %s and due <= :lim order by %s limit %d""" % (
         # put back in the learn queue?
         if conf['relearn']:
             card.edue = card.due
-            card.due = int(self._delayForGrade(conf, 0) + time.time())
+            card.due = int(self._delayForGrade(conf, 0) + self._now())
             card.queue = 1
             self.lrnCount += 1
             heappush(self.lrnQueue, (card.due, card.id))
@@ -498,19 +705,10 @@ queue = 2 %s and due <= :lim order by %s limit %d""" % (
         card.due = self.today + card.ivl
 
     def _logRev(self, card, ease):
-        taken = min(card.timeTaken(), self._cardConf(card)['maxTaken']*1000)
-        def log():
-            self.deck.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, ease,
-                card.ivl, card.lastIvl, card.factor, taken,
-                1)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        taken = min(self._timeTaken(card),
+                    self._cardConf(card)['maxTaken']*1000)
+        self.deck.logReview(card.id, ease, card.ivl, card.lastIvl,
+                            card.factor, taken, 1, self._now())
 
     # Interval management
     ##########################################################################
@@ -543,9 +741,7 @@ queue = 2 %s and due <= :lim order by %s limit %d""" % (
         idealDue = self.today + idealIvl
         conf = self._cardConf(card)['rev']
         # find sibling positions
-        dues = self.deck.db.list(
-            "select due from cards where fid = ? and queue = 2"
-            " and id != ?", card.fid, card.id)
+        dues = self._siblingDues(card)
         if not dues or idealDue not in dues:
             return idealIvl
         else:
@@ -564,6 +760,143 @@ queue = 2 %s and due <= :lim order by %s limit %d""" % (
                         break
             return idealIvl + fudge
 
+    def _siblingDues(self, card):
+        "Due dates of CARD's siblings in the review queue."
+        if card.fid not in self._sibDues:
+            self._sibDues[card.fid] = dict(self.deck.db.all(
+                "select id, due from cards where fid = ? and queue = 2",
+                card.fid))
+        return [due for (id, due) in self._sibDues[card.fid].items()
+                if id != card.id]
+
+    def _loadSiblings(self, cids):
+        "Preload sibling due dates for the facts of the queued CIDS."
+        if not cids:
+            return
+        for (id, fid, queue, due) in self.deck.db.execute("""
+select id, fid, queue, due from cards where fid in
+(select fid from cards where id in %s)""" % self.deck.db.ids2str(cids)):
+            sibs = self._sibDues.setdefault(fid, {})
+            if queue == 2:
+                sibs[id] = due
+
+    # Prefetching
+    ##########################################################################
+    # If prefetchSize is set, the next cards in each queue are loaded and
+    # rendered ahead of time, and the next review batch is fetched once the
+    # review queue drops to prefetchSize cards, so getCard() doesn't have to
+    # wait for either. In concurrent mode this is done by a background thread
+    # after each getCard(); otherwise call prefetch() when idle, such as while
+    # the question is shown. Prefetched cards are checked against the DB
+    # before they're used.
+
+    def prefetch(self):
+        "Load the upcoming cards, and the next review batch if needed."
+        if not self.prefetchSize:
+            return
+        self._runPrefetch(*self._prefetchWork())
+
+    def _startPrefetch(self):
+        if self._prefetchThread and self._prefetchThread.isAlive():
+            return
+        work = self._prefetchWork()
+        if not work[1] and work[3] is None:
+            return
+        # latex lookups need this, and the thread can't use the main DB
+        self.deck.media.names()
+        self._prefetchThread = threading.Thread(
+            target=self._runPrefetch, args=work)
+        self._prefetchThread.daemon = True
+        self._prefetchThread.start()
+
+    def waitPrefetch(self):
+        "Wait for the background prefetch to finish."
+        if self._prefetchThread:
+            self._prefetchThread.join()
+            self._prefetchThread = None
+
+    def _prefetchWork(self):
+        "Return what needs fetching. Called from the main thread."
+        upcoming = self._upcoming(self.prefetchSize)
+        with self._prefetchLock:
+            # drop any that were skipped over
+            for id in self._prefetched.keys():
+                if id not in upcoming:
+                    del self._prefetched[id]
+            ids = [id for id in upcoming if id not in self._prefetched]
+            skip = None
+            if (self._revNext is None and
+                len(self.revQueue) <= self.prefetchSize and
+                self.revCount > len(self.revQueue)):
+                skip = list(self.revQueue)
+                self._answered = set()
+            return (self._prefetchGen, ids, self._revGen, skip)
+
+    def _runPrefetch(self, gen, ids, revGen, skip):
+        with self.deck.reader() as db:
+            cards = self._loadCards(db, ids)
+            if skip is not None:
+                # the card being shown will be answered before it's used
+                batch = self._revBatch(db, skip)
+        with self._prefetchLock:
+            if gen == self._prefetchGen:
+                self._prefetched.update(cards)
+            if skip is not None and revGen == self._revGen:
+                self._revNext = batch
+
+    def _upcoming(self, n):
+        "Ids of the next N cards in each queue."
+        return ([id for (due, id) in nsmallest(n, self.lrnQueue)] +
+                self.revQueue[-n:] +
+                [id for (id, due) in self.newQueue[-n:]])
+
+    _prefetchSQL = """
+select c.*, f.mid, f.gid, f.crt, f.mod, f.tags, f.flds, f.data, m.mod
+from cards c, facts f, models m where c.id %s and f.id = c.fid and m.id = f.mid"""
+
+    def _loadCards(self, db, ids):
+        """Return {id: (card, row)} for IDS, with their q/a rendered. Only DB
+is read from, and nothing is written, so this can run in another thread."""
+        if not ids:
+            return {}
+        groups = dict(db.all("select id, name from groups"))
+        mods = {}
+        ret = {}
+        for row in db.execute(self._prefetchSQL % ("in " + db.ids2str(ids))):
+            c = Card(self.deck)
+            c.load(row[:17])
+            mid = row[17]
+            if mid not in mods:
+                mods[mid] = (self.deck.modelCache.get(mid) or
+                             Model(self.deck, mid, db=db))
+            f = Fact(self.deck, id=c.fid, row=row[17:24], model=mods[mid])
+            m = f.model()
+            c._rd = [f, m]
+            # building latex images would write to the DB
+            with anki.latex.noBuild():
+                qa = self.deck._renderQA(m, groups.get(c.gid), [
+                    c.id, f.id, m.id, c.gid, c.ord, f.stringTags(),
+                    f.joinedFields()])
+            if "[latex]" not in qa['q'] + qa['a']:
+                # otherwise rendered when used
+                c._qa = qa
+            ret[c.id] = (c, tuple(row))
+        return ret
+
+    def _prefetchedCard(self, id):
+        "The prefetched card ID, if it hasn't changed since."
+        with self._prefetchLock:
+            (c, row) = self._prefetched.pop(id, (None, None))
+        if c and self.deck.db.first(self._prefetchSQL % "= ?", id) == row:
+            return c
+
+    def _clearPrefetch(self):
+        with self._prefetchLock:
+            self._prefetched = {}
+            self._prefetchGen += 1
+            self._revNext = None
+            self._revGen += 1
+
     # Leeches
     ##########################################################################
 
@@ -584,6 +917,9 @@ queue = 2 %s and due <= :lim order by %s limit %d""" % (
             if a == 0:
                 self.suspendCards([card.id])
                 card.queue = -1
+                # already recounted as suspended
+                card._orig = (card.gid, -1, card.due)
+                card._origAt = self._serial
             # notify UI
             runHook("leech", card)
 
@@ -620,7 +956,7 @@ queue = 2 %s and due <= :lim order by %s limit %d""" % (
     def _checkDay(self):
         # check if the day has rolled over
         if time.time() > self.dayCutoff:
-            self.updateCutoff()
+            self._updateCutoff()
             self.reset()
 
     # Deck finished state
@@ -725,38 +1061,47 @@ queue = 2 %s and due <= :lim order by %s limit %d""" % (
     def suspendCards(self, ids):
         "Suspend cards."
         self.removeFailed(ids)
+        self._uncount(ids)
         self.deck.db.execute(
             "update cards set queue = -1, mod = ? where id in "+
-            ids2str(ids), intTime())
+            self.deck.db.ids2str(ids), intTime())
+        self._count(ids)
 
     def unsuspendCards(self, ids):
         "Unsuspend cards."
+        self._uncount(ids)
         self.deck.db.execute(
             "update cards set queue = type, mod = ? "
-            "where queue = -1 and id in "+ ids2str(ids),
+            "where queue = -1 and id in "+ self.deck.db.ids2str(ids),
             intTime())
+        self._count(ids)
 
     def buryFact(self, fid):
         "Bury all cards for fact until next session."
         self.deck.setDirty()
-        self.removeFailed(
-            self.deck.db.list("select id from cards where fid = ?", fid))
+        ids = self.deck.db.list("select id from cards where fid = ?", fid)
+        self.removeFailed(ids)
+        self._uncount(ids)
         self.deck.db.execute("update cards set queue = -2 where fid = ?", fid)
+        self._count(ids)
 
     # Counts
     ##########################################################################
 
     def timeToday(self):
         "Time spent learning today, in seconds."
-        return self.deck.db.scalar(
-            "select sum(taken/1000.0) from revlog where time > ?*1000",
-            self.dayCutoff-86400) or 0
+        cutoff = (self.dayCutoff-86400)*1000
+        return (self.deck.db.scalar(
+            "select sum(taken/1000.0) from revlog where time > ?",
+            cutoff) or 0) + sum(
+            r[6]/1000.0 for r in self.deck._revlog if r[0] > cutoff)
 
     def repsToday(self):
         "Number of cards answered today."
+        cutoff = (self.dayCutoff-86400)*1000
         return self.deck.db.scalar(
-            "select count() from revlog where time > ?*1000",
-            self.dayCutoff-86400)
+            "select count() from revlog where time > ?", cutoff) + len(
+            [r for r in self.deck._revlog if r[0] > cutoff])
 
     # Dynamic indices
     ##########################################################################
@@ -785,8 +1130,11 @@ queue = 2 %s and due <= :lim order by %s limit %d""" % (
 
     def forgetCards(self, ids):
         "Put cards at the end of the new queue."
+        self._uncount(ids)
         self.deck.db.execute(
-            "update cards set type=0, queue=0, ivl=0 where id in "+ids2str(ids))
+            "update cards set type=0, queue=0, ivl=0 where id in "+
+            self.deck.db.ids2str(ids))
+        self._count(ids)
         pmax = self.deck.db.scalar("select max(due) from cards where type=0")
         self.sortCards(ids, start=pmax+1, shuffle=self.deck.randomNew())
 
@@ -798,15 +1146,17 @@ queue = 2 %s and due <= :lim order by %s limit %d""" % (
         for id in ids:
             r = random.randint(imin, imax)
             d.append(dict(id=id, due=r+t, ivl=max(1, r), mod=mod))
+        self._uncount(ids)
         self.deck.db.executemany(
             "update cards set type=2,queue=2,ivl=:ivl,due=:due where id=:id",
             d)
+        self._count(ids)
 
     # Repositioning new cards
     ##########################################################################
 
     def sortCards(self, cids, start=1, step=1, shuffle=False, shift=False):
-        scids = ids2str(cids)
+        scids = self.deck.db.ids2str(cids)
         now = intTime()
         fids = self.deck.db.list(
             ("select distinct fid from cards where type = 0 and id in %s "
@@ -832,6 +1182,7 @@ queue = 2 %s and due <= :lim order by %s limit %d""" % (
                 self.deck.db.execute("""
 update cards set mod=?, due=due+? where id not in %s
 and due >= ?""" % scids, now, shiftby, low)
+                self.invalidateCounts()
         # reorder cards
         d = []
         for id, fid in self.deck.db.execute(
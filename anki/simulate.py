@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""\
+Workload simulation
+==============================================================================
+
+Projects how many reviews will be done and how long they'll take over the
+coming days, by applying the scheduler's interval rules to all the cards due
+on a day at once. Answers are drawn at random, in the proportions found in the
+deck's review history. Sibling spacing, leeches and cramming are not modelled.
+
+Requires numpy.
+"""
+
+import numpy
+
+# used when there isn't enough history: (again, hard, good, easy)
+defaultYoung = (0.15, 0.1, 0.65, 0.1)
+defaultMature = (0.08, 0.07, 0.75, 0.1)
+# seconds per answer
+defaultTaken = 10.0
+# answers needed before the history is trusted
+minHistory = 100
+
+class Simulator(object):
+
+    def __init__(self, deck):
+        self.deck = deck
+        self.sched = deck.sched
+
+    def run(self, days=30, newPerDay=None, seed=None):
+        """Return [(reviews, learning, minutes)] for each of the next DAYS,
+starting today. NEWPERDAY overrides the deck's limit. Learning is the number of
+answers on new and relearning cards."""
+        self.sched._updateCutoff()
+        today = self.sched.today
+        end = today + days - 1
+        rand = numpy.random.RandomState(seed)
+        # new cards allowed each day
+        l = self.deck.qconf
+        if newPerDay is None:
+            newPerDay = l['newPerDay']
+            first = newPerDay
+            if l['newToday'][0] == today:
+                first = max(0, first - l['newToday'][1])
+        else:
+            first = newPerDay
+        limits = [first] + [newPerDay]*(days-1)
+        # cards due after the last day, or new cards that won't be reached,
+        # can't affect the result and aren't loaded
+        (gid, queue, due, ivl, factor) = self._cards(end, sum(limits))
+        conf = self._conf(gid)
+        (young, mature) = self._eases()
+        (revTaken, lrnTaken) = self._taken()
+        # the day each card will next be reviewed; overdue cards are shown
+        # today, and new cards once they've been learnt
+        rev = (queue == 2) | ((queue == 1) & (ivl > 0))
+        shown = numpy.where(rev, numpy.maximum(due, today), end+1)
+        # cards in learning are finished off today, then new cards by position
+        lrn = numpy.flatnonzero((queue == 1) & (ivl == 0))
+        new = numpy.concatenate((lrn, numpy.flatnonzero(queue == 0)))
+        limits[0] += len(lrn)
+        ret = []
+        for (day, lim) in zip(range(today, end+1), limits):
+            # new cards graduate to the review queue
+            (idx, new) = (new[:max(0, lim)], new[max(0, lim):])
+            lrnCnt = conf['newSteps'][idx].sum()
+            ivl[idx] = conf['gradIvl'][idx]
+            factor[idx] = conf['initialFactor'][idx]
+            due[idx] = shown[idx] = day + ivl[idx]
+            # then reviews
+            idx = numpy.flatnonzero(shown == day)
+            ease = self._answers(rand, ivl[idx] >= 21, young, mature)
+            late = day - due[idx]
+            (ivl[idx], factor[idx]) = self._nextIvls(
+                idx, ease, ivl[idx], factor[idx], late, conf)
+            due[idx] = shown[idx] = day + ivl[idx]
+            lrnCnt += conf['lapseSteps'][idx[ease == 1]].sum()
+            revCnt = len(idx)
+            secs = revCnt*revTaken + lrnCnt*lrnTaken
+            ret.append((revCnt, int(lrnCnt), secs / 60.0))
+        return ret
+
+    # Intervals
+    ######################################################################
+    # Vectorized _nextRevIvl(), _rescheduleRev() and _rescheduleLapse().
+
+    def _nextIvls(self, idx, ease, ivl, factor, late, conf):
+        fct = factor / 1000.0
+        interval = numpy.where(
+            ease == 2, (ivl + late // 4) * 1.2, numpy.where(
+                ease == 3, (ivl + late // 2) * fct,
+                (ivl + late) * fct * conf['ease4'][idx]))
+        passIvl = numpy.maximum(
+            ivl + numpy.where(ease == 4, 2, 1), interval.astype(numpy.int32))
+        lapseIvl = (ivl * conf['lapseMult'][idx]).astype(numpy.int32) + 1
+        newIvl = numpy.where(ease == 1, lapseIvl, passIvl)
+        adj = numpy.choose(ease - 1, (-200, -150, 0, 150))
+        newFactor = numpy.maximum(1300, factor + adj)
+        return (newIvl, newFactor)
+
+    def _answers(self, rand, isMature, young, mature):
+        "Return a random ease for each card, 1-4."
+        r = rand.random_sample(len(isMature))
+        return numpy.where(
+            isMature,
+            numpy.searchsorted(mature, r, side="right"),
+            numpy.searchsorted(young, r, side="right")) + 1
+
+    # Loading
+    ######################################################################
+
+    def _cards(self, end, newLimit):
+        """Return arrays of gid, queue, due, ivl and factor. Relearning cards
+have their review due date. New cards are in the order they'll be shown."""
+        lim = self.sched._groupLimit()
+        old = self._columns(
+            ("gid", "queue", "(case when queue = 1 then edue else due end)",
+             "ivl", "factor"), """
+from cards where (queue = 2 and due <= %d or queue = 1) %s""" % (end, lim))
+        new = self._columns(
+            ("gid", "queue", "due", "ivl", "factor"), """
+from cards where queue = 0 %s order by due limit %d""" % (lim, newLimit))
+        return [numpy.concatenate(c) for c in zip(old, new)]
+
+    def _columns(self, cols, sql):
+        "Return an int array for each of COLS, from 'select COLS SQL'."
+        # numpy parses one long string much faster than it converts rows of
+        # python ints
+        res = self.deck.db.first("select %s from (select %s %s)" % (
+            ", ".join("group_concat(c%d)" % n for n in range(len(cols))),
+            ", ".join("%s as c%d" % (c, n) for (n, c) in enumerate(cols)),
+            sql))
+        return [numpy.fromstring(c or "", dtype=numpy.int32, sep=",")
+                for c in res]
+
+    def _conf(self, gid):
+        "Return {key: array} of the group settings for each card."
+        gconfs = dict(self.deck.db.all("select id, gcid from groups"))
+        (gids, inv) = numpy.unique(gid, return_inverse=True)
+        keys = ('ease4', 'gradIvl', 'initialFactor', 'lapseMult',
+                'newSteps', 'lapseSteps')
+        rows = []
+        for g in gids:
+            c = self.deck.groupConf(gconfs.get(int(g), 1))
+            rows.append((
+                c['rev']['ease4'],
+                c['new']['ints'][0],
+                c['new']['initialFactor'],
+                c['lapse']['mult'],
+                len(c['new']['delays']),
+                len(c['lapse']['delays']) if c['lapse']['relearn'] else 0))
+        table = numpy.array(rows, dtype=numpy.float64).reshape(-1, len(keys))
+        conf = {}
+        for n, k in enumerate(keys):
+            col = table[:,n][inv]
+            if k not in ('ease4', 'lapseMult'):
+                col = col.astype(numpy.int32)
+            conf[k] = col
+        return conf
+
+    def _eases(self):
+        "Cumulative chance of again, hard and good, for young & mature cards."
+        ret = []
+        for (isMature, default) in ((0, defaultYoung), (1, defaultMature)):
+            cnts = self.deck.db.first("""
+select sum(ease1), sum(ease2), sum(ease3), sum(ease4) from revlog_daily
+where type = 1 and mature = ? %s""" % self.sched._groupLimit(), isMature)
+            if cnts[0] is None or sum(cnts) < minHistory:
+                cnts = default
+            p = numpy.array(cnts, dtype=numpy.float64)
+            ret.append(numpy.cumsum(p / p.sum())[:3])
+        return ret
+
+    def _taken(self):
+        "Average seconds for a review and a learning answer."
+        ret = []
+        for types in ("1", "0, 2"):
+            (cnt, secs) = self.deck.db.first("""
+select sum(cnt), sum(secs) from revlog_daily
+where type in (%s) %s""" % (types, self.sched._groupLimit()))
+            if not cnt or cnt < minHistory:
+                ret.append(defaultTaken)
+            else:
+                ret.append(secs / float(cnt))
+        return ret
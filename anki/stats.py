@@ -92,6 +92,7 @@ class DeckStats(object):
 
     def __init__(self, deck):
         self.deck = deck
+        self.db = deck.db
         self._stats = None
         self.type = 0
         self.width = 600
@@ -102,14 +103,19 @@ class DeckStats(object):
         # period-dependent graphs
         self.type = type
         self.selective = selective
-        txt = self.css
-        txt += self.dueGraph()
-        txt += self.repsGraph()
-        txt += self.ivlGraph()
-        # other graphs
-        txt += self.hourGraph()
-        txt += self.easeGraph()
-        txt += self.cardGraph()
+        with self.deck.reader() as db:
+            self.db = db
+            try:
+                txt = self.css
+                txt += self.dueGraph()
+                txt += self.repsGraph()
+                txt += self.ivlGraph()
+                # other graphs
+                txt += self.hourGraph()
+                txt += self.easeGraph()
+                txt += self.cardGraph()
+            finally:
+                self.db = self.deck.db
         return "<script>%s\n</script><center>%s</center>" % (anki.js.all, txt)
 
     css = """
@@ -174,7 +180,7 @@ table * { font-size: 14px; }
             lim += " and due-:today >= %d" % start
         if end is not None:
             lim += " and day < %d" % end
-        return self.deck.db.all("""
+        return self.db.all("""
 select (due-:today)/:chunk as day,
 sum(case when ivl < 21 then 1 else 0 end), -- yng
 sum(case when ivl >= 21 then 1 else 0 end) -- mtr
@@ -303,9 +309,8 @@ group by day order by day""" % (self._limit(), lim),
     def _done(self, num=7, chunk=1):
         lims = []
         if num is not None:
-            lims.append("time > %d" % (
-                (self.deck.sched.dayCutoff-(num*chunk*86400))*1000))
-        lim = self._revlogLimit()
+            lims.append("day > %d" % (self.deck.sched.today-num*chunk))
+        lim = self._dailyLimit()
         if lim:
             lims.append(lim)
         if lims:
@@ -316,23 +321,23 @@ group by day order by day""" % (self._limit(), lim),
             tf = 60.0 # minutes
         else:
             tf = 3600.0 # hours
-        return self.deck.db.all("""
+        return self.db.all("""
 select
-(cast((time/1000 - :cut) / 86400.0 as int))/:chunk as day,
-sum(case when type = 0 then 1 else 0 end), -- lrn count
-sum(case when type = 1 and lastIvl < 21 then 1 else 0 end), -- yng count
-sum(case when type = 1 and lastIvl >= 21 then 1 else 0 end), -- mtr count
-sum(case when type = 2 then 1 else 0 end), -- lapse count
-sum(case when type = 3 then 1 else 0 end), -- cram count
-sum(case when type = 0 then taken/1000 else 0 end)/:tf, -- lrn time
+(day - :today)/:chunk as period,
+sum(case when type = 0 then cnt else 0 end), -- lrn count
+sum(case when type = 1 and not mature then cnt else 0 end), -- yng count
+sum(case when type = 1 and mature then cnt else 0 end), -- mtr count
+sum(case when type = 2 then cnt else 0 end), -- lapse count
+sum(case when type = 3 then cnt else 0 end), -- cram count
+sum(case when type = 0 then secs else 0 end)/:tf, -- lrn time
 -- yng + mtr time
-sum(case when type = 1 and lastIvl < 21 then taken/1000 else 0 end)/:tf,
-sum(case when type = 1 and lastIvl >= 21 then taken/1000 else 0 end)/:tf,
-sum(case when type = 2 then taken/1000 else 0 end)/:tf, -- lapse time
-sum(case when type = 3 then taken/1000 else 0 end)/:tf -- cram time
-from revlog %s
-group by day order by day""" % lim,
-                            cut=self.deck.sched.dayCutoff,
+sum(case when type = 1 and not mature then secs else 0 end)/:tf,
+sum(case when type = 1 and mature then secs else 0 end)/:tf,
+sum(case when type = 2 then secs else 0 end)/:tf, -- lapse time
+sum(case when type = 3 then secs else 0 end)/:tf -- cram time
+from revlog_daily %s
+group by period order by period""" % lim,
+                            today=self.deck.sched.today,
                             tf=tf,
                             chunk=chunk)
 
@@ -340,22 +345,18 @@ group by day order by day""" % lim,
         lims = []
         num = self._periodDays()
         if num:
-            lims.append(
-                "time > %d" %
-                ((self.deck.sched.dayCutoff-(num*86400))*1000))
-        rlim = self._revlogLimit()
+            lims.append("day > %d" % (self.deck.sched.today-num))
+        rlim = self._dailyLimit()
         if rlim:
             lims.append(rlim)
         if lims:
             lim = "where " + " and ".join(lims)
         else:
             lim = ""
-        return self.deck.db.first("""
-select count(), abs(min(day)) from (select
-(cast((time/1000 - :cut) / 86400.0 as int)+1) as day
-from revlog %s
-group by day order by day)""" % lim,
-                                   cut=self.deck.sched.dayCutoff)
+        return self.db.first("""
+select count(), abs(min(day) - :today + 1) from (select day
+from revlog_daily %s
+group by day)""" % lim, today=self.deck.sched.today)
 
     # Intervals
     ######################################################################
@@ -390,12 +391,12 @@ group by day order by day)""" % lim,
             chunk = 7; lim = " and grp <= 52"
         else:
             chunk = 30; lim = ""
-        data = [self.deck.db.all("""
+        data = [self.db.all("""
 select ivl / :chunk as grp, count() from cards
 where queue = 2 %s %s
 group by grp
 order by grp""" % (self._limit(), lim), chunk=chunk)]
-        return data + list(self.deck.db.first("""
+        return data + list(self.db.first("""
 select count(), avg(ivl), max(ivl) from cards where queue = 2 %s""" %
                                          self._limit()))
 
@@ -455,17 +456,22 @@ select count(), avg(ivl), max(ivl) from cards where queue = 2 %s""" %
                 "</td></tr></table></center>")
 
     def _eases(self):
-        lim = self._revlogLimit()
+        lim = self._dailyLimit()
         if lim:
             lim = "where " + lim
-        return self.deck.db.all("""
+        ret = []
+        for row in self.db.all("""
 select (case
 when type in (0,2) then 0
-when lastIvl < 21 then 1
+when not mature then 1
 else 2 end) as thetype,
-ease, count() from revlog %s
-group by thetype, ease
-order by thetype, ease""" % lim)
+sum(ease1), sum(ease2), sum(ease3), sum(ease4) from revlog_daily %s
+group by thetype
+order by thetype""" % lim):
+            for ease in range(1, 5):
+                if row[ease]:
+                    ret.append((row[0], ease, row[ease]))
+        return ret
 
     # Hourly retention
     ######################################################################
@@ -509,19 +515,16 @@ order by thetype, ease""" % lim)
         return txt
 
     def _hourRet(self):
-        lim = self._revlogLimit()
+        lim = self._dailyLimit()
         if lim:
             lim = " and " + lim
-        sd = datetime.datetime.fromtimestamp(self.deck.crt)
-        return self.deck.db.all("""
+        return self.db.all("""
 select
-23 - ((cast((:cut - time/1000) / 3600.0 as int)) %% 24) as hour,
-sum(case when ease = 1 then 0 else 1 end) /
-cast(count() as float) * 100,
-count()
-from revlog where type = 1 %s
-group by hour having count() > 30 order by hour""" % lim,
-                            cut=self.deck.sched.dayCutoff-(sd.hour*3600))
+hour,
+(sum(cnt) - sum(ease1)) / cast(sum(cnt) as float) * 100,
+sum(cnt)
+from revlog_daily where type = 1 %s
+group by hour having sum(cnt) > 30 order by hour""" % lim)
 
     # Cards
     ######################################################################
@@ -538,7 +541,7 @@ group by hour having count() > 30 order by hour""" % lim,
             d.append(dict(data=div[c], label=t, color=col))
         # text data
         i = []
-        (c, f) = self.deck.db.first("""
+        (c, f) = self.db.first("""
 select count(id), count(distinct fid) from cards
 where 1 """ + self._limit())
         self._line(i, _("Total cards"), c)
@@ -548,7 +551,7 @@ where 1 """ + self._limit())
             self._line(i, _("Lowest ease factor"), "%d%%" % low)
             self._line(i, _("Average ease factor"), "%d%%" % avg)
             self._line(i, _("Highest ease factor"), "%d%%" % high)
-        min = self.deck.db.scalar(
+        min = self.db.scalar(
             "select min(crt) from cards where 1 " + self._limit())
         if min:
             self._line(i, _("First card created"), _("%s ago") % fmtTimeSpan(
@@ -575,7 +578,7 @@ when you answer "good" on a review.''')
         return "<table width=400>" + "".join(i) + "</table>"
 
     def _factors(self):
-        return self.deck.db.first("""
+        return self.db.first("""
 select
 min(factor) / 10.0,
 avg(factor) / 10.0,
@@ -583,7 +586,7 @@ max(factor) / 10.0
 from cards where queue = 2 %s""" % self._limit())
 
     def _cards(self):
-        return self.deck.db.first("""
+        return self.db.first("""
 select
 sum(case when queue=2 and ivl >= 21 then 1 else 0 end), -- mtr
 sum(case when queue=1 or (queue=2 and ivl < 21) then 1 else 0 end), -- yng/lrn
@@ -674,11 +677,10 @@ $(function () {
         else:
             return ""
 
-    def _revlogLimit(self):
+    def _dailyLimit(self):
         lim = self.deck.qconf['groups']
         if self.selective and lim:
-            return ("cid in (select id from cards where gid in %s)" %
-                    ids2str(lim))
+            return "gid in %s" % ids2str(lim)
         else:
             return ""
 
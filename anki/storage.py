@@ -2,19 +2,22 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-CURRENT_VERSION = 100
+CURRENT_VERSION = 105
 
 import os, time, simplejson, re, datetime
 from anki.lang import _
 from anki.utils import intTime
-from anki.db import DB
+from anki.db import DB, DBPool
 from anki.deck import _Deck
 from anki.stdmodels import BasicModel, ClozeModel
 from anki.errors import AnkiError
 from anki.hooks import runHook
 
-def Deck(path, queue=True, lock=True):
-    "Open a new or existing deck. Path must be unicode."
+def Deck(path, queue=True, lock=True, concurrent=False):
+    """Open a new or existing deck. Path must be unicode.
+If CONCURRENT, the deck uses WAL journaling and isn't kept locked between
+saves. Searches, stats and rendering then read from a pool of connections,
+so other threads can use them while the deck is being modified."""
     path = os.path.abspath(path)
     create = not os.path.exists(path)
     if create:
@@ -22,7 +25,11 @@ def Deck(path, queue=True, lock=True):
         for c in ("/", ":", "\\"):
             assert c not in base
     # connect
-    db = DB(path)
+    if concurrent:
+        # wait for other writers instead of failing at once
+        db = DB(path, timeout=5, shared=True)
+    else:
+        db = DB(path)
     if create:
         ver = _createDB(db)
     else:
@@ -38,7 +45,11 @@ def Deck(path, queue=True, lock=True):
         # default to basic
         deck.conf['currentModelId'] = 1
         deck.save()
-    if lock:
+    if concurrent:
+        deck.db.commit()
+        deck.db.execute("pragma journal_mode = wal")
+        deck.pool = DBPool(path)
+    elif lock:
         deck.lock()
     if not queue:
         return deck
@@ -109,6 +120,16 @@ create table if not exists fsums (
     csum            integer not null
 );
 
+create table if not exists words (
+    id              integer primary key,
+    word            text not null unique
+);
+
+create table if not exists fwords (
+    wid             integer not null,
+    fid             integer not null
+);
+
 create table if not exists models (
     id              integer primary key,
     crt             integer not null,
@@ -152,12 +173,45 @@ create table if not exists revlog (
     type            integer not null
 );
 
+create table if not exists revlog_daily (
+    day             integer not null,
+    gid             integer not null,
+    type            integer not null,
+    mature          integer not null,
+    hour            integer not null,
+    cnt             integer not null,
+    secs            integer not null,
+    ease1           integer not null,
+    ease2           integer not null,
+    ease3           integer not null,
+    ease4           integer not null,
+    primary key (day, gid, type, mature, hour)
+);
+
+create table if not exists media_refs (
+    fid             integer not null,
+    fname           text not null,
+    primary key (fid, fname)
+);
+
+create table if not exists media_files (
+    fname           text primary key,
+    size            integer not null,
+    mtime           integer not null,
+    csum            text not null
+);
+
 create table if not exists tags (
     id              integer primary key,
     mod             integer not null,
     name            text not null collate nocase unique
 );
 
+create table if not exists ftags (
+    tid             integer not null,
+    fid             integer not null
+);
+
 insert or ignore into deck
 values(1,0,0,0,%(v)s,0,'',0,'', '', '');
 """ % ({'v':CURRENT_VERSION}))
@@ -190,65 +244,127 @@ create index if not exists ix_revlog_cid on revlog (cid);
 -- field uniqueness check
 create index if not exists ix_fsums_fid on fsums (fid);
 create index if not exists ix_fsums_csum on fsums (csum);
+-- full text search
+create index if not exists ix_fwords_wid on fwords (wid, fid);
+create index if not exists ix_fwords_fid on fwords (fid);
+-- media check
+create index if not exists ix_media_refs_fname on media_refs (fname);
+-- media dedupe
+create index if not exists ix_media_files_csum on media_files (csum);
+-- tag searches
+create unique index if not exists ix_ftags_tid on ftags (tid, fid);
+create index if not exists ix_ftags_fid on ftags (fid);
 """)
 
 # 2.0 schema migration
 ######################################################################
-
-def _moveTable(db, table, cards=False):
+# The upgrade is split into steps which are committed as they finish, and
+# long steps are run in chunks and committed after each one. If the
+# upgrade is interrupted, the next open carries on where it left off.
+# Steps must be safe to repeat if they were interrupted before being marked
+# done, so old tables are only dropped once everything has been moved.
+
+# rows moved between commits
+upgradeChunk = 10000
+
+def _step(db, name, func):
+    "Run FUNC(db), unless step NAME was completed by an earlier attempt."
+    if db.scalar("select pos from upgrade where step = ?", name) == -1:
+        return
+    func(db)
+    db.execute("insert or replace into upgrade values (?, -1)", name)
+    db.commit()
+    runHook("upgradeProgress", name, 1, 1)
+
+def _chunkedStep(db, name, table, func):
+    """Call FUNC(db, lo, hi) for rowid ranges of TABLE, committing after each
+one and resuming after the last one committed."""
+    pos = db.scalar("select pos from upgrade where step = ?", name)
+    if pos == -1:
+        return
+    pos = pos or 0
+    high = db.scalar("select max(rowid) from %s" % table) or 0
+    while pos < high:
+        func(db, pos, pos+upgradeChunk)
+        pos = min(pos+upgradeChunk, high)
+        db.execute("insert or replace into upgrade values (?, ?)", name, pos)
+        db.commit()
+        runHook("upgradeProgress", name, pos, high)
+    db.execute("insert or replace into upgrade values (?, -1)", name)
+    db.commit()
+
+def _factStep(func):
+    "Return a _chunkedStep() function calling FUNC(fids) for each range."
+    def step(db, lo, hi):
+        fids = db.list("select id from facts where id > ? and id <= ?", lo, hi)
+        if fids:
+            func(fids)
+    return step
+
+def _eachFactChunk(db, func):
+    "Call FUNC(fids) for the facts a chunk at a time, without committing."
+    step = _factStep(func)
+    high = db.scalar("select max(id) from facts") or 0
+    for lo in xrange(0, high, upgradeChunk):
+        step(db, lo, lo+upgradeChunk)
+
+def _copyTable(db, table, cards=False):
+    "Copy TABLE to TABLE2, so it can be replaced by the new version."
     if cards:
         insExtra = " order by created"
     else:
         insExtra = ""
     sql = db.scalar(
         "select sql from sqlite_master where name = '%s'" % table)
-    sql = sql.replace("TABLE "+table, "temporary table %s2" % table)
+    sql = sql.replace("TABLE "+table, "table %s2" % table)
     if cards:
+        # the new order becomes the rowid
         sql = sql.replace("PRIMARY KEY (id),", "")
+    db.execute("drop table if exists %s2" % table)
     db.execute(sql)
     db.execute("insert into %s2 select * from %s%s" % (table, table, insExtra))
-    db.execute("drop table "+table)
-    _addSchema(db, False)
 
-def _insertWithIdChange(db, map, idx, table, numVals):
-    "Fetching and re-inserting is a lot faster than row by row updates."
-    data = []
-    for row in db.all("select * from %s" % table):
-        row = list(row)
-        try:
-            row[idx] = map[row[idx]]
-            data.append(row)
-        except:
-            # referenced non-existant object
-            pass
-    db.execute("delete from %s" % table)
-    db.executemany(
-        "insert into %s values (?%s)" % (table, ",?"*(numVals-1)),
-        data)
+def _replaceTable(db, table):
+    db.execute("drop table if exists "+table)
+    _addSchema(db, False)
 
 def _upgradeSchema(db):
     "Alter tables prior to ORM initialization."
     try:
-        ver = db.scalar("select ver from deck")
-    except:
+        # 1.x, or an upgrade that was interrupted before cleaning up
         ver = db.scalar("select version from decks")
+    except:
+        ver = db.scalar("select ver from deck")
     # latest 1.2 is 65
     if ver < 65:
         raise AnkiError("oldDeckVersion")
     if ver > 99:
         return ver
     runHook("1.x upgrade", db)
+    db.execute("""
+create table if not exists upgrade (step text primary key, pos integer)""")
 
     # cards
     ###########
-    # move into temp table
-    _moveTable(db, "cards", True)
-    # use the new order to rewrite card ids
-    cardmap = dict(db.all("select id, rowid from cards2"))
-    # move back, preserving new ids, and rewriting types
-    db.execute("""
-insert into cards select rowid, factId, 1, ordinal, cast(created as int),
-cast(modified as int),
+    def copyCards(db):
+        _copyTable(db, "cards", True)
+        db.execute("create index ix_cards2_id on cards2 (id)")
+    _step(db, "copyCards", copyCards)
+    # new fact ids are assigned in creation order
+    def factMap(db):
+        db.execute("drop table if exists factmap")
+        db.execute("""
+create table factmap (new integer primary key, old integer not null)""")
+        db.execute(
+            "insert into factmap (old) select id from facts order by created")
+        db.execute("create index ix_factmap_old on factmap (old)")
+    _step(db, "factMap", factMap)
+    _step(db, "newCards", lambda db: _replaceTable(db, "cards"))
+    # move back, using the new card and fact ids, and rewriting types. cards
+    # whose facts are missing are dropped.
+    _chunkedStep(db, "cards", "cards2", lambda db, lo, hi: db.execute("""
+insert or replace into cards select c.rowid, m.new, 1, ordinal,
+cast(created as int), cast(modified as int),
 (case relativeDelay
 when 0 then 1
 when 1 then 2
@@ -259,120 +375,97 @@ when 1 then 2
 when 2 then 0
 else type end),
 cast(due as int), cast(interval as int),
-cast(factor*1000 as int), reps, noCount, 0, 0, 0, "" from cards2
-order by created""")
-    db.execute("drop table cards2")
+cast(factor*1000 as int), reps, noCount, 0, 0, 0, "" from cards2 c, factmap m
+where c.rowid > ? and c.rowid <= ? and m.old = c.factId""", lo, hi))
 
     # tags
     ###########
-    _moveTable(db, "tags")
-    db.execute("insert or ignore into tags select id, ?, tag from tags2",
-               intTime())
-    db.execute("drop table tags2")
-    db.execute("drop table cardTags")
+    _step(db, "copyTags", lambda db: _copyTable(db, "tags"))
+    def tags(db):
+        _replaceTable(db, "tags")
+        db.execute("insert or ignore into tags select id, ?, tag from tags2",
+                   intTime())
+    _step(db, "tags", tags)
 
     # facts
     ###########
     # tags should have a leading and trailing space if not empty, and not
     # use commas
-    db.execute("""
+    _step(db, "factTags", lambda db: db.execute("""
 update facts set tags = (case
 when trim(tags) == "" then ""
 else " " || replace(replace(trim(tags), ",", " "), "  ", " ") || " "
 end)
-""")
-    # pull facts into memory, so we can merge them with fields efficiently
-    facts = db.all("""
-select id, modelId, 1, cast(created as int), cast(modified as int), tags
-from facts order by created""")
-    # build field hash
-    fields = {}
-    for (fid, ord, val) in db.execute(
-        "select factId, ordinal, value from fields order by factId, ordinal"):
-        if fid not in fields:
-            fields[fid] = []
-        fields[fid].append((ord, val))
-    # build insert data and transform ids, and minimize qt's
-    # bold/italics/underline cruft.
-    map = {}
-    data = []
+"""))
+    _step(db, "copyFacts", lambda db: _copyTable(db, "facts"))
+    _step(db, "newFacts", lambda db: _replaceTable(db, "facts"))
+    # merge in the fields, and minimize qt's bold/italics/underline cruft
     from anki.utils import minimizeHTML
-    for c, row in enumerate(facts):
-        oldid = row[0]
-        map[oldid] = c+1
-        row = list(row)
-        row[0] = c+1
-        row.append(minimizeHTML("\x1f".join([x[1] for x in sorted(fields[oldid])])))
-        data.append(row)
-    # use the new order to rewrite fact ids in cards table
-    _insertWithIdChange(db, map, 1, "cards", 17)
-    # and put the facts into the new table
-    db.execute("drop table facts")
-    _addSchema(db, False)
-    db.executemany("insert into facts values (?,?,?,?,?,?,?,'','')", data)
-    db.execute("drop table fields")
-
-    # media
-    ###########
-    db.execute("drop table media")
+    def facts(db, lo, hi):
+        fields = {}
+        for (fid, val) in db.execute("""
+select factId, value from fields where factId in
+(select old from factmap where new > ? and new <= ?)
+order by factId, ordinal, value""", lo, hi):
+            if fid not in fields:
+                fields[fid] = []
+            fields[fid].append(val)
+        data = []
+        for row in db.execute("""
+select m.new, f.modelId, 1, cast(f.created as int), cast(f.modified as int),
+f.tags, f.id from factmap m, facts2 f
+where m.new > ? and m.new <= ? and f.id = m.old""", lo, hi):
+            data.append(row[:6] + (
+                minimizeHTML("\x1f".join(fields.get(row[6], []))),))
+        db.executemany(
+            "insert or replace into facts values (?,?,?,?,?,?,?,'','')", data)
+    _chunkedStep(db, "facts", "factmap", facts)
 
     # models
     ###########
     import anki.models
-    _moveTable(db, "models")
-    db.execute("""
+    _step(db, "copyModels", lambda db: _copyTable(db, "models"))
+    def models(db):
+        _replaceTable(db, "models")
+        db.execute("""
 insert into models select id, cast(created as int), cast(modified as int),
 name, "{}", "{}", ?, "" from models2""", simplejson.dumps(
     anki.models.defaultConf))
-    db.execute("drop table models2")
+    _step(db, "models", models)
 
     # reviewHistory -> revlog
     ###########
-    # fetch the data so we can rewrite ids quickly
-    r = []
-    for row in db.execute("""
-select
-cast(time*1000 as int), cardId, ease,
-cast(nextInterval as int), cast(lastInterval as int),
-cast(nextFactor*1000 as int), cast(min(thinkingTime, 60)*1000 as int),
-yesCount from reviewHistory"""):
-        row = list(row)
-        # new card ids
-        try:
-            row[1] = cardmap[row[1]]
-        except:
-            # id doesn't exist
-            continue
-        # no ease 0 anymore
-        row[2] = row[2] or 1
-        # determine type, overwriting yesCount
-        newInt = row[3]
-        oldInt = row[4]
-        yesCnt = row[7]
-        # yesCnt included the current answer
-        if row[2] > 1:
-            yesCnt -= 1
-        if oldInt < 1:
-            # new or failed
-            if yesCnt:
-                # type=relrn
-                row[7] = 2
-            else:
-                # type=lrn
-                row[7] = 0
-        else:
-            # type=rev
-            row[7] = 1
-        r.append(row)
-    db.executemany(
-        "insert or ignore into revlog values (?,?,?,?,?,?,?,?)", r)
-    db.execute("drop table reviewHistory")
+    # card ids are rewritten with the cards2 table; ease 0 becomes 1, and
+    # yesCount is replaced by the type (yesCount included the current answer)
+    _chunkedStep(db, "revlog", "reviewHistory", lambda db, lo, hi: db.execute("""
+insert or ignore into revlog select
+cast(h.time*1000 as int), c.rowid,
+(case when h.ease then h.ease else 1 end),
+cast(h.nextInterval as int), cast(h.lastInterval as int),
+cast(h.nextFactor*1000 as int), cast(min(h.thinkingTime, 60)*1000 as int),
+(case
+when cast(h.lastInterval as int) >= 1 then 1
+when h.yesCount - (case when h.ease > 1 then 1 else 0 end) != 0 then 2
+else 0 end)
+from reviewHistory h, cards2 c
+where h.rowid > ? and h.rowid <= ? and c.id = h.cardId""", lo, hi))
 
     # longer migrations
     ###########
-    _migrateDeckTbl(db)
-    mods = _migrateFieldsTbl(db)
-    _migrateTemplatesTbl(db, mods)
+    _step(db, "deckTbl", _migrateDeckTbl)
+    def modelConf(db):
+        mods = _migrateFieldsTbl(db)
+        _migrateTemplatesTbl(db, mods)
+    _step(db, "modelConf", modelConf)
+
+    # old and working tables
+    ###########
+    def cleanup(db):
+        for t in ("cards2", "factmap", "tags2", "cardTags", "facts2",
+                  "fields", "media", "models2", "reviewHistory", "decks",
+                  "deckVars", "fieldModels", "cardModels"):
+            db.execute("drop table if exists %s" % t)
+    _step(db, "cleanup", cleanup)
 
     _updateIndices(db)
     return ver
@@ -418,9 +511,6 @@ insert or replace into deck select id, cast(created as int), :t,
                l=simplejson.dumps(qconf),
                c=simplejson.dumps(conf),
                d=simplejson.dumps(data))
-    # clean up
-    db.execute("drop table decks")
-    db.execute("drop table deckVars")
 
 def _migrateFieldsTbl(db):
     import anki.models
@@ -453,8 +543,6 @@ order by modelId, ordinal"""):
     for mid, fms in mods.items():
         db.execute("update models set flds = ? where id = ?",
                    simplejson.dumps(fms), mid)
-    # clean up
-    db.execute("drop table fieldModels")
     return mods
 
 def _migrateTemplatesTbl(db, fmods):
@@ -502,8 +590,6 @@ order by modelId, ordinal"""):
     for mid, tmpls in mods.items():
         db.execute("update models set tmpls = ? where id = ?",
                    simplejson.dumps(tmpls), mid)
-    # clean up
-    db.execute("drop table cardModels")
     return mods
 
 def _fixupModels(deck):
@@ -523,6 +609,37 @@ def _fixupModels(deck):
 def _postSchemaUpgrade(deck):
     "Handle the rest of the upgrade to 2.0."
     import anki.deck
+    db = deck.db
+    # ddl commits, so get it out of the way first
+    # remove old views
+    for v in ("failedCards", "revCardsOld", "revCardsNew",
+              "revCardsDue", "revCardsRandom", "acqCardsRandom",
+              "acqCardsOld", "acqCardsNew"):
+        db.execute("drop view if exists %s" % v)
+    # remove stats, as it's all in the revlog now
+    db.execute("drop table if exists stats")
+    # remove old deleted tables
+    for t in ("cards", "facts", "models", "media"):
+        db.execute("drop table if exists %sDeleted" % t)
+    # the rest isn't safe to repeat, so is committed in one go
+    if db.scalar("select pos from upgrade where step = 'post'") != -1:
+        _postSchemaData(deck)
+        db.execute("insert or replace into upgrade values ('post', -1)")
+        deck.save()
+    # the field cache and tag map are built a chunk of facts at a time, so
+    # they're not all held in memory
+    _chunkedStep(db, "fieldCache", "facts", _factStep(deck.updateFieldCache))
+    _chunkedStep(db, "tagMap", "facts", _factStep(deck.updateFactTags))
+    # optimize and finish
+    deck.sched.updateDynamicIndices()
+    db.execute("update deck set ver = ?", CURRENT_VERSION)
+    deck.save()
+    db.execute("drop table upgrade")
+    db.execute("vacuum")
+    db.execute("analyze")
+    deck.save()
+
+def _postSchemaData(deck):
     # adjust models
     _fixupModels(deck)
     # fix creation time
@@ -534,22 +651,10 @@ def _postSchemaUpgrade(deck):
     d -= datetime.timedelta(days=1+int((time.time()-deck.crt)/86400))
     deck.crt = int(time.mktime(d.timetuple()))
     deck.sched._updateCutoff()
-    # update uniq cache
-    deck.updateFieldCache(deck.db.list("select id from facts"))
-    # remove old views
-    for v in ("failedCards", "revCardsOld", "revCardsNew",
-              "revCardsDue", "revCardsRandom", "acqCardsRandom",
-              "acqCardsOld", "acqCardsNew"):
-        deck.db.execute("drop view if exists %s" % v)
-    # remove stats, as it's all in the revlog now
-    deck.db.execute("drop table if exists stats")
     # suspended cards don't use ranges anymore
     deck.db.execute("update cards set queue=-1 where queue between -3 and -1")
     deck.db.execute("update cards set queue=-2 where queue between 3 and 5")
     deck.db.execute("update cards set queue=-3 where queue between 6 and 8")
-    # remove old deleted tables
-    for t in ("cards", "facts", "models", "media"):
-        deck.db.execute("drop table if exists %sDeleted" % t)
     # rewrite due times for new cards
     deck.db.execute("""
 update cards set due = fid where type=0""")
@@ -568,15 +673,8 @@ update cards set due = cast(
     # update insertion id
     deck.conf['nextFid'] = deck.db.scalar("select max(id) from facts")+1
     deck.conf['nextCid'] = deck.db.scalar("select max(id) from cards")+1
-    deck.save()
-
-    # optimize and finish
-    deck.sched.updateDynamicIndices()
-    deck.db.commit()
-    deck.db.execute("vacuum")
-    deck.db.execute("analyze")
-    deck.db.execute("update deck set ver = ?", CURRENT_VERSION)
-    deck.save()
+    # and the daily review totals, now the creation time is settled
+    deck.rebuildDaily()
 
 # Post-init upgrade
 ######################################################################
@@ -586,4 +684,23 @@ def _upgradeDeck(deck, version):
     if version >= CURRENT_VERSION:
         return
     if version < 100:
+        # brings the deck up to the current version
         _postSchemaUpgrade(deck)
+        return
+    # add any new tables and indices
+    _addSchema(deck.db, False)
+    _updateIndices(deck.db)
+    if version < 101:
+        # build word index
+        _eachFactChunk(deck.db, deck.updateFieldCache)
+    if version < 102:
+        # build tag map
+        _eachFactChunk(deck.db, deck.updateFactTags)
+    if version < 103:
+        # daily review totals
+        deck.rebuildDaily()
+    if version < 104:
+        # media reference index
+        deck.media.rebuildRefs()
+    deck.db.execute("update deck set ver = ?", CURRENT_VERSION)
+    deck.save()
@@ -2,15 +2,16 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import zlib, re, urllib, urllib2, socket, simplejson, time, shutil
-import os, base64, httplib, sys, httplib, types
+import zlib, re, urllib, urllib2, socket, simplejson, time, shutil, struct, \
+    operator
+import os, base64, httplib, sys, httplib, types, itertools, tempfile
 from datetime import date
 import anki, anki.deck, anki.cards
 from anki.errors import *
 #from anki.models import Model, Field, Template
 #from anki.facts import Fact
 #from anki.cards import Card
-from anki.utils import ids2str, checksum
+from anki.utils import ids2str, checksum, intTime
 from anki.consts import *
 #from anki.media import mediaFiles
 from anki.lang import _
@@ -28,6 +29,17 @@ SYNC_HOST = os.environ.get("SYNC_HOST") or "dev.ankiweb.net"
 SYNC_PORT = int(os.environ.get("SYNC_PORT") or 80)
 SYNC_URL = "http://%s:%d/sync/" % (SYNC_HOST, SYNC_PORT)
 KEYS = ("models", "facts", "cards", "media")
+# tables whose changes are sent, in the order they're applied:
+# (key, select changes since lastSync, key column, mod column or None)
+CHANGES = (
+    ("models", "select * from models where mod > ?", "id", 2),
+    ("groups", "select * from groups where mod > ?", "id", 1),
+    ("gconf", "select * from gconf where mod > ?", "id", 1),
+    ("facts", "select * from facts where mod > ?", "id", 4),
+    ("cards", "select * from cards where mod > ?", "id", 5),
+    ("revlog", "select * from revlog where time > ?*1000", "time", None),
+    ("tags", "select * from tags where mod > ?", "id", None),
+    )
 
 ##########################################################################
 
@@ -38,6 +50,13 @@ class Syncer(object):
         self.diffs = {}
         self.timediff = 0
         self.fullThreshold = 5000
+        # rows per chunk when streaming changes
+        self.chunkSize = 1000
+        # send changes in the compact encoding; only enable if the other
+        # side understands it. Either encoding is accepted when receiving.
+        # Over HTTP it's enabled by the handshake if both sides support it.
+        self.compact = False
+        self.canCompact = True
 
     # Control
     ##########################################################################
@@ -168,22 +187,9 @@ class Syncer(object):
         # things to delete?
         if deletions:
             self.delete(deletions)
+        self.deck.flushRevlog()
         d = {}
-        cats = [
-            # cards
-            ("cards",
-             "select * from cards where mod > ?"),
-            # facts
-            ("facts",
-             "select * from facts where mod > ?"),
-            # the rest
-            ("models", "select * from models where mod > ?"),
-            ("revlog", "select * from revlog where time > ?*1000"),
-            ("tags", "select * from tags where mod > ?"),
-            ("gconf", "select * from gconf where mod > ?"),
-            ("groups", "select * from groups where mod > ?"),
-        ]
-        for (key, sql) in cats:
+        for (key, sql, col, modidx) in CHANGES:
             if self.fullThreshold:
                 sql += " limit %d" % self.fullThreshold
             ret = self.deck.db.all(sql, lastSync)
@@ -197,11 +203,182 @@ class Syncer(object):
             d['deletions'] = self.deletions(lastSync)
         return d
 
+    # Streaming changes
+    ##########################################################################
+    # Instead of one dict of everything that changed, changes can be sent as
+    # a stream of (key, data) chunks of up to chunkSize rows, which are
+    # compressed and applied one at a time. As nothing needs to be held in
+    # memory, there's no need to fall back to a full sync for large changes.
+    # The stream starts with the row counts and the deck row, then any
+    # deletions, then the changed rows of each table. The syncProgress hook
+    # is called with (key, done, total) as rows are sent and applied.
+
+    def syncChanges(self):
+        """Exchange changes since lastSync with the server as streams of
+chunks, then record the sync on both sides."""
+        lastSync = self.deck.lastSync
+        chunks = self.server.changeChunks(lastSync, self.deletions(lastSync))
+        if chunks is None:
+            raise Exception("full sync required")
+        applied = self.applyChunks(chunks, rewrite=True)
+        # the server already has what we got from it
+        self.server.applyChunks(self.changeChunks(lastSync, skip=applied))
+        self.deck.lastSync = self.server.finish()
+        self.deck.save()
+        self.deck.reset()
+
+    def finish(self):
+        "Record a finished sync and save. Return the new lastSync."
+        self.deck.lastSync = intTime()
+        self.deck.save()
+        return self.deck.lastSync
+
+    def changeChunks(self, lastSync, deletions=None, skip=None):
+        """Like changes(), but return an iterator of chunks. Rows in SKIP, as
+returned by applyChunks(), aren't sent if they haven't changed since, so the
+row counts are only an upper bound."""
+        self.deck.lastSync = lastSync
+        if self.deck.schemaChanged():
+            return None
+        if deletions:
+            self.delete(deletions)
+        self.deck.flushRevlog()
+        return self._changeChunks(lastSync, deletions, skip or {})
+
+    def _changeChunks(self, lastSync, deletions, skip):
+        counts = {}
+        for (key, sql, col, modidx) in CHANGES:
+            counts[key] = self.deck.db.scalar(
+                "select count() from (%s)" % sql, lastSync)
+        yield ("counts", counts)
+        yield ("deck", self.deck.db.first("select * from deck"))
+        if deletions:
+            yield ("deletions", self.deletions(lastSync))
+        for (key, sql, col, modidx) in CHANGES:
+            # fetched in key order, a chunk at a time
+            last = None
+            done = 0
+            while True:
+                if last is None:
+                    rows = self.deck.db.all(sql + " order by %s limit %d" % (
+                        col, self.chunkSize), lastSync)
+                else:
+                    rows = self.deck.db.all(
+                        sql + " and %s > ? order by %s limit %d" % (
+                            col, col, self.chunkSize), lastSync, last)
+                if not rows:
+                    break
+                last = rows[-1][0]
+                done += len(rows)
+                if key in skip:
+                    rows = [r for r in rows if not self._wasApplied(
+                        skip[key], key, r, modidx)]
+                runHook("syncProgress", key, done, counts[key])
+                if rows:
+                    yield (key, rows)
+
+    def applyChunks(self, chunks, rewrite=False):
+        """Merge CHUNKS from the other side's changeChunks(), committing after
+each. Rows are only applied if newer than the local copy. REWRITE is set by the
+client: local ids are first rewritten to not conflict with the server's, and
+rows the same age as the local copy are applied too, so the server's copy wins
+on both sides. Return the rows applied, as {table: {key: mod}}."""
+        mods = dict((c[0], c[3]) for c in CHANGES)
+        counts = {}
+        done = {}
+        applied = {}
+        for (key, data) in chunks:
+            if key == "counts":
+                counts = data
+                continue
+            elif key == "deck":
+                if rewrite:
+                    self.rewriteIds({'deck': data})
+            elif key == "deletions":
+                self.delete(data)
+            else:
+                done[key] = done.get(key, 0) + len(data)
+                if mods[key] is not None:
+                    data = self._newerRows(key, data, mods[key], rewrite)
+                getattr(self, 'update'+key.capitalize())(data)
+                keys = applied.setdefault(key, {})
+                for r in data:
+                    keys[self._rowKey(key, r)] = (
+                        r[mods[key]] if mods[key] is not None else None)
+                runHook("syncProgress", key, done[key], counts.get(key))
+            self.deck.db.commit()
+        return applied
+
+    def _rowKey(self, table, row):
+        # tag ids are local, so tags are matched by name
+        if table == "tags":
+            return row[2].lower()
+        return row[0]
+
+    def _wasApplied(self, applied, table, row, modidx):
+        "True if ROW is as applyChunks() left it."
+        key = self._rowKey(table, row)
+        if key not in applied:
+            return False
+        return modidx is None or applied[key] == row[modidx]
+
+    def _newerRows(self, table, rows, modidx, ties=False):
+        """The ROWS which are newer than, or missing from, the local TABLE. If
+TIES, rows the same age as the local copy are included."""
+        local = dict(self.deck.db.all(
+            "select id, mod from %s where id in %s" % (
+                table, self.deck.db.ids2str([r[0] for r in rows]))))
+        if ties:
+            return [r for r in rows if local.get(r[0], -1) <= r[modidx]]
+        return [r for r in rows if local.get(r[0], -1) < r[modidx]]
+
+    def stuffChunks(self, chunks):
+        """Yield compressed data for CHUNKS, flushed after each so the other
+side can apply a chunk as soon as it arrives."""
+        comp = zlib.compressobj()
+        for chunk in chunks:
+            if self.compact:
+                data = packChanges(dict([chunk]))
+                data = (data[:len(MAGIC)] + struct.pack("<I", len(data)) +
+                        data[len(MAGIC):])
+            else:
+                data = simplejson.dumps(chunk) + "\n"
+            yield comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH)
+        yield comp.flush()
+
+    def unstuffChunks(self, data):
+        "Yield the chunks in DATA, an iterator of stuffChunks() output."
+        decomp = zlib.decompressobj()
+        buf = ""
+        for d in data:
+            buf += decomp.decompress(d)
+            while buf:
+                if buf.startswith(MAGIC):
+                    # compact: magic, then the length of the whole chunk
+                    start = len(MAGIC) + 4
+                    if len(buf) < start:
+                        break
+                    size = struct.unpack("<I", buf[len(MAGIC):start])[0]
+                    if len(buf) < size + 4:
+                        break
+                    (chunk,) = unpackChanges(
+                        MAGIC + buf[start:size+4]).items()
+                    buf = buf[size+4:]
+                    yield chunk
+                else:
+                    idx = buf.find("\n")
+                    if idx == -1:
+                        break
+                    line = buf[:idx]
+                    buf = buf[idx+1:]
+                    yield simplejson.loads(unicode(line, "utf8"))
+
     # ID rewriting
     ##########################################################################
 
     def rewriteIds(self, remote):
         "Rewrite local IDs so they don't conflict with server version."
+        self.deck.flushRevlog()
         conf = simplejson.loads(remote['deck'][9])
         # cards
         id = self.deck.db.scalar(
@@ -217,6 +394,7 @@ class Syncer(object):
             self.deck.db.execute(
                 "update cards set id = id + ? where id in "+sids,
                 diff)
+            self.deck.sched.invalidateCounts()
         # facts
         id = self.deck.db.scalar(
             "select min(id) from facts where crt > ?", self.deck.lastSync)
@@ -228,6 +406,15 @@ class Syncer(object):
             self.deck.db.execute(
                 "update fsums set fid = fid + ? where fid in "+sids,
                 diff)
+            self.deck.db.execute(
+                "update fwords set fid = fid + ? where fid in "+sids,
+                diff)
+            self.deck.db.execute(
+                "update ftags set fid = fid + ? where fid in "+sids,
+                diff)
+            self.deck.db.execute(
+                "update media_refs set fid = fid + ? where fid in "+sids,
+                diff)
             self.deck.db.execute(
                 "update facts set id = id + ? where id in "+sids,
                 diff)
@@ -266,6 +453,7 @@ class Syncer(object):
             "insert or replace into facts values (?,?,?,?,?,?,?,?,?)", facts)
         # FIXME: this could be made faster
         self.deck.updateFieldCache(f[0] for f in facts)
+        self.deck.updateFactTags([f[0] for f in facts])
 
     # Cards
     ##########################################################################
@@ -276,10 +464,15 @@ class Syncer(object):
     def updateCards(self, cards):
         if not cards:
             return
+        # their reviews may need to be moved to another group
+        sids = self.deck.db.ids2str([c[0] for c in cards])
+        self.deck._updateDaily("r.cid in "+sids, -1)
         self.deck.db.executemany(
             "insert or replace into cards values "
             "(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
             cards)
+        self.deck._updateDaily("r.cid in "+sids)
+        self.deck.sched.invalidateCounts()
 
     # Models
     ##########################################################################
@@ -326,9 +519,17 @@ class Syncer(object):
     def updateRevlog(self, revlog):
         if not revlog:
             return
+        self.deck.flushRevlog()
+        # entries may replace existing ones
+        times = self.deck.db.ids2str([r[0] for r in revlog])
+        self.deck._updateDaily("r.time in "+times, -1)
         self.deck.db.executemany(
             "insert or replace into revlog values (?,?,?,?,?,?,?,?)",
             revlog)
+        self.deck._updateDaily("r.time in "+times)
+        # keep new local entries after the merged ones
+        self.deck._revlogTime = max(
+            self.deck._revlogTime, max(r[0] for r in revlog))
 
     # Tags
     ##########################################################################
@@ -336,9 +537,10 @@ class Syncer(object):
     def updateTags(self, tags):
         if not tags:
             return
+        # tag ids are local, as the fact->tag map refers to them
         self.deck.db.executemany(
-            "insert or replace into tags values (?,?,?)",
-            tags)
+            "insert or ignore into tags (mod, name) values (?,?)",
+            [t[1:] for t in tags])
 
     # Deck
     ##########################################################################
@@ -383,9 +585,14 @@ insert or replace into deckVars
         return self.deck.lastSync
 
     def unstuff(self, data):
-        return simplejson.loads(unicode(zlib.decompress(data), "utf8"))
+        data = zlib.decompress(data)
+        if data.startswith(MAGIC):
+            return unpackChanges(data)
+        return simplejson.loads(unicode(data, "utf8"))
 
     def stuff(self, data):
+        if self.compact and isinstance(data, dict):
+            return zlib.compress(packChanges(data))
         return zlib.compress(simplejson.dumps(data))
 
     # Full sync
@@ -394,6 +601,7 @@ insert or replace into deckVars
     def needFullSync(self, sums):
         if self.deck.lastSync <= 0:
             return True
+        self.deck.flushRevlog()
         for sum in sums:
             for l in sum.values():
                 if len(l) > 1000:
@@ -631,6 +839,98 @@ insert or replace into deckVars
 #         self.deck.updateCardTags(cardIds)
 #         self.rebuildPriorities(cardIds)
 
+# Compact encoding
+##########################################################################
+# Change sets are mostly integers, which JSON spells out digit by digit. In
+# the compact encoding each table's rows are stored by column: integer
+# columns are packed as little-endian binary, as differences from the
+# previous value where that's smaller (ids and times), in the narrowest
+# width that fits. Other columns, and anything else in the dict, are stored
+# as JSON. The result is:
+#   MAGIC, header length (uint32), JSON header, packed integer columns
+
+MAGIC = "\x00ankc1"
+# struct codes by width, and the range they hold
+_intCodes = (("b", 1 << 7), ("h", 1 << 15), ("i", 1 << 31), ("q", 1 << 63))
+
+def packChanges(data):
+    "Encode DATA, a dict of changes, in the compact encoding."
+    tables = {}
+    other = {}
+    blob = []
+    size = 0
+    for (key, val) in data.items():
+        if key not in _tableKeys or not isinstance(val, list):
+            other[key] = val
+            continue
+        cols = []
+        for col in zip(*val):
+            packed = _packInts(col)
+            if packed is None:
+                cols.append(("j", col))
+            else:
+                (code, base, buf) = packed
+                cols.append((code, base, size))
+                blob.append(buf)
+                size += len(buf)
+        tables[key] = (len(val), cols)
+    header = simplejson.dumps({'t': tables, 'o': other})
+    return MAGIC + struct.pack("<I", len(header)) + header + "".join(blob)
+
+def unpackChanges(data):
+    "Decode the output of packChanges()."
+    start = len(MAGIC) + 4
+    (hlen,) = struct.unpack("<I", data[len(MAGIC):start])
+    header = simplejson.loads(unicode(data[start:start+hlen], "utf8"))
+    blob = start + hlen
+    ret = header['o']
+    for (key, (n, cols)) in header['t'].items():
+        vals = []
+        for col in cols:
+            if col[0] == "j":
+                vals.append(col[1])
+                continue
+            (code, base, offset) = col
+            offset += blob
+            col = list(struct.unpack_from("<%d%s" % (n, code), data, offset))
+            if base is not None:
+                col[0] = base
+                for i in xrange(1, n):
+                    col[i] += col[i-1]
+            vals.append(col)
+        ret[key] = [list(r) for r in zip(*vals)] if vals else [[]] * n
+    return ret
+
+def _packInts(col):
+    """Return (code, base, packed) for integer column COL, or None. If BASE
+isn't None, the column was packed as differences, starting from BASE."""
+    try:
+        # a float or string anywhere makes the sum one too, or fail
+        if type(sum(col)) not in _intTypes:
+            return None
+    except TypeError:
+        return None
+    (code, base, vals) = (_intCode(min(col), max(col)), None, col)
+    if code not in ("b", "h") and len(col) > 1:
+        # ids and times are much smaller as differences
+        deltas = [0] + map(operator.sub, col[1:], col[:-1])
+        dcode = _intCode(min(deltas), max(deltas))
+        if dcode and (not code or
+                      struct.calcsize(dcode) < struct.calcsize(code)):
+            (code, base, vals) = (dcode, col[0], deltas)
+    if not code:
+        return None
+    return (code, base, struct.pack("<%d%s" % (len(vals), code), *vals))
+
+def _intCode(lo, hi):
+    "The narrowest struct code which holds LO to HI, or None."
+    for (code, lim) in _intCodes:
+        if -lim <= lo and hi < lim:
+            return code
+
+_tableKeys = set(c[0] for c in CHANGES)
+_intTypes = set((int, long))
+
 # Local syncing
 ##########################################################################
 
@@ -645,7 +945,7 @@ class SyncClient(Syncer):
 
 class HttpSyncServerProxy(SyncServer):
 
-    def __init__(self, user, passwd):
+    def __init__(self, user, passwd, url=None):
         SyncServer.__init__(self)
         self.decks = None
         self.deckName = None
@@ -653,6 +953,10 @@ class HttpSyncServerProxy(SyncServer):
         self.password = passwd
         self.protocolVersion = 5
         self.sourcesToCheck = []
+        self.url = url or SYNC_URL
+        # request and response bodies, for measuring syncs
+        self.bytesSent = 0
+        self.bytesReceived = 0
 
     def connect(self, clientVersion=""):
         "Check auth, protocol & grab deck list."
@@ -663,10 +967,13 @@ class HttpSyncServerProxy(SyncServer):
                             libanki=anki.version,
                             client=clientVersion,
                             sources=simplejson.dumps(self.sourcesToCheck),
-                            pversion=self.protocolVersion)
+                            pversion=self.protocolVersion,
+                            compact=int(self.canCompact))
             socket.setdefaulttimeout(None)
             if d['status'] != "OK":
                 raise SyncError(type="authFailed", status=d['status'])
+            # servers which don't know the compact encoding don't say so
+            self.compact = bool(self.canCompact and d.get('compact'))
             self.decks = d['decks']
             self.timestamp = d['timestamp']
             self.timediff = abs(self.timestamp - time.time())
@@ -706,9 +1013,40 @@ class HttpSyncServerProxy(SyncServer):
                            payload=self.stuff(payload))
 
     def finish(self):
-        assert self.runCmd("finish") == "OK"
+        return self.runCmd("finish")
+
+    def changeChunks(self, lastSync, deletions=None):
+        self.connect()
+        f = self._request("changeChunks", urllib.urlencode(self._fields(
+            lastSync=self.stuff(lastSync), deletions=self.stuff(deletions))))
+        chunks = self.unstuffChunks(self._readChunks(f))
+        first = chunks.next()
+        if first[0] == "fullSync":
+            return None
+        return itertools.chain([first], chunks)
+
+    def applyChunks(self, chunks):
+        self.connect()
+        # written into a temporary file first, since POST needs content-length
+        tmp = tempfile.TemporaryFile()
+        try:
+            for data in self.stuffChunks(chunks):
+                tmp.write(data)
+            size = tmp.tell()
+            tmp.seek(0)
+            f = self._request(
+                "applyChunks?" + urllib.urlencode(self._fields()), tmp, {
+                    'Content-type': 'application/octet-stream',
+                    'Content-length': str(size)})
+            assert self._reply(f) == "OK"
+        finally:
+            tmp.close()
 
     def runCmd(self, action, **args):
+        return self._reply(self._request(
+            action, urllib.urlencode(self._fields(**args))))
+
+    def _fields(self, **args):
         data = {"p": self.password,
                 "u": self.username,
                 "v": 2}
@@ -717,14 +1055,26 @@ class HttpSyncServerProxy(SyncServer):
         else:
             data['d'] = None
         data.update(args)
-        data = urllib.urlencode(data)
+        return data
+
+    def _request(self, action, data, headers={}):
+        "POST DATA, a string or file, to ACTION. Return the response."
+        if isinstance(data, str):
+            size = len(data)
+        else:
+            size = int(headers['Content-length'])
         try:
-            f = urllib2.urlopen(SYNC_URL + action, data)
+            f = urllib2.urlopen(
+                urllib2.Request(self.url + action, data, headers))
         except (urllib2.URLError, socket.error, socket.timeout,
                 httplib.BadStatusLine), e:
             raise SyncError(type="connectionError",
                             exc=`e`)
-        ret = f.read()
+        self.bytesSent += size
+        return f
+
+    def _reply(self, f):
+        ret = "".join(self._readChunks(f))
         if not ret:
             raise SyncError(type="noResponse")
         try:
@@ -733,6 +1083,15 @@ class HttpSyncServerProxy(SyncServer):
             raise SyncError(type="connectionError",
                             exc=`e`)
 
+    def _readChunks(self, f):
+        "Yield the body of response F as it arrives."
+        while 1:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            self.bytesReceived += len(data)
+            yield data
+
 # HTTP server: respond to proxy requests and return data
 ##########################################################################
 
@@ -754,12 +1113,30 @@ class HttpSyncServer(SyncServer):
         return self.stuff(SyncServer.genOneWayPayload(
             self, float(zlib.decompress(lastSync))))
 
-    def getDecks(self, libanki, client, sources, pversion):
-        return self.stuff({
+    def changeChunks(self, lastSync, deletions):
+        chunks = SyncServer.changeChunks(
+            self, self.unstuff(lastSync), self.unstuff(deletions))
+        # the client needs to do a full sync instead
+        return self.stuffChunks(chunks or [("fullSync", None)])
+
+    def applyChunks(self, data):
+        "Apply DATA, an iterator of the client's stuffChunks() output."
+        SyncServer.applyChunks(self, self.unstuffChunks(data))
+        return self.stuff("OK")
+
+    def finish(self):
+        return self.stuff(SyncServer.finish(self))
+
+    def getDecks(self, libanki, client, sources, pversion, compact=0):
+        "Clients which understand the compact encoding pass COMPACT=1."
+        self.compact = bool(self.canCompact and int(compact))
+        # always JSON, as the client doesn't know the outcome yet
+        return zlib.compress(simplejson.dumps({
             "status": "OK",
             "decks": self.decks,
             "timestamp": time.time(),
-            })
+            "compact": self.compact,
+            }))
 
     def createDeck(self, name):
         "Create a deck on the server. Not implemented."
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""\
+Sync benchmark
+==============================================================================
+
+Measures streaming syncs over HTTP against a LocalSyncServer. Two copies of
+a deck are synced, then each side edits a share of the facts (the
+divergence), adds as many new facts and reviews as many cards, and the client
+syncs with the server. For each sync the time taken, the bytes sent and
+received, the rows written on each side and the server's cpu time are
+reported. The decks are then checked to hold the same data:
+
+    python -m anki.syncbench [facts] [divergence ...]
+"""
+
+import os, sys, time, random, shutil, tempfile
+import anki
+from anki.utils import intTime
+from anki.sync import SyncClient, HttpSyncServerProxy
+from anki.syncserver import LocalSyncServer
+
+def makeDecks(dir, facts=1000, divergence=0.1, seed=0):
+    """Create a client and server deck in DIR with FACTS facts in common,
+which have each since changed by DIVERGENCE. Return their paths."""
+    rand = random.Random(seed)
+    client = os.path.join(dir, u"client.anki")
+    server = os.path.join(dir, u"server.anki")
+    deck = anki.Deck(client)
+    deck.syncName = u"bench"
+    _addFacts(deck, facts, u"base")
+    deck.lastSync = intTime()
+    deck.scm = 0
+    deck.close()
+    shutil.copy(client, server)
+    # changes need to be newer than the last sync
+    time.sleep(1)
+    n = int(facts * divergence)
+    for (path, tag) in ((client, u"client"), (server, u"server")):
+        deck = anki.Deck(path)
+        _diverge(deck, rand, n, tag)
+        deck.close()
+    return (client, server)
+
+def _addFacts(deck, n, tag):
+    facts = []
+    for i in range(n):
+        f = deck.newFact()
+        f['Front'] = u"%s front %d" % (tag, i)
+        f['Back'] = u"%s back %d" % (tag, i)
+        facts.append(f)
+    deck.addFacts(facts)
+
+def _diverge(deck, rand, n, tag):
+    "Edit N facts, add N facts and review N cards, chosen with RAND."
+    for fid in rand.sample(deck.db.list("select id from facts"), n):
+        f = deck.getFact(fid)
+        f['Back'] += u" (%s)" % tag
+        f.flush()
+    _addFacts(deck, n, tag)
+    now = time.time()
+    deck.sched.answerCards([
+        (cid, rand.randint(1, 4), rand.randint(2000, 20000), now)
+        for cid in rand.sample(deck.db.list("select id from cards"), n)])
+
+def sync(path, server, compact=False):
+    """Sync the deck at PATH with SERVER, a started LocalSyncServer, offering
+the compact encoding if COMPACT. Return {secs, sent, received, clientRows,
+serverRows, serverCpu, compact}, the last being the encoding used."""
+    deck = anki.Deck(path)
+    try:
+        proxy = HttpSyncServerProxy(u"", u"", url=server.url)
+        client = SyncClient(deck)
+        client.setServer(proxy)
+        proxy.canCompact = compact
+        before = proxy.runCmd("stats")
+        proxy.bytesSent = proxy.bytesReceived = 0
+        rows = deck.db.totalChanges()
+        t = time.time()
+        client.syncChanges()
+        ret = {'secs': time.time() - t,
+               'sent': proxy.bytesSent,
+               'received': proxy.bytesReceived,
+               'clientRows': deck.db.totalChanges() - rows}
+        after = proxy.runCmd("stats")
+        ret['serverRows'] = after['rows'] - before['rows']
+        ret['serverCpu'] = after['cpu'] - before['cpu']
+        ret['compact'] = proxy.compact
+        return ret
+    finally:
+        deck.close()
+
+def differences(path1, path2):
+    "Return the names of the synced tables which differ between two decks."
+    ret = []
+    decks = [anki.Deck(p, queue=False) for p in (path1, path2)]
+    try:
+        for table in ("models", "groups", "gconf", "facts", "cards",
+                      "revlog", "tags"):
+            # tag ids are local to each deck
+            cols = "mod, name" if table == "tags" else "*"
+            (a, b) = [d.db.all("select %s from %s order by 1, 2" % (
+                cols, table)) for d in decks]
+            if a != b:
+                ret.append(table)
+    finally:
+        for d in decks:
+            d.close(save=False)
+    return ret
+
+def benchmark(facts=1000, divergence=0.1, compact=False, process=True):
+    """Create decks with makeDecks() and return the results of syncing them.
+If PROCESS, the server is run in a child process, so its cpu time is only
+its own. Raises an exception if the decks differ after syncing."""
+    dir = tempfile.mkdtemp(prefix="anki-syncbench-")
+    try:
+        (client, path) = makeDecks(dir, facts, divergence)
+        server = LocalSyncServer(path)
+        server.start(process=process)
+        try:
+            ret = sync(client, server, compact)
+        finally:
+            server.stop()
+        diff = differences(client, path)
+        if diff:
+            raise Exception("decks differ after sync: %s" % ", ".join(diff))
+        return ret
+    finally:
+        shutil.rmtree(dir)
+
+def main():
+    facts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    divs = [float(d) for d in sys.argv[2:]] or [0.01, 0.1, 0.5]
+    print "%-6s %-8s %8s %10s %10s %8s %8s %8s" % (
+        "div", "encoding", "secs", "sent", "received", "crows", "srows",
+        "scpu")
+    for div in divs:
+        for compact in (False, True):
+            r = benchmark(facts, div, compact)
+            print "%-6s %-8s %8.3f %10d %10d %8d %8d %8.3f" % (
+                div, "compact" if r['compact'] else "json", r['secs'],
+                r['sent'], r['received'], r['clientRows'], r['serverRows'],
+                r['serverCpu'])
+
+if __name__ == "__main__":
+    main()
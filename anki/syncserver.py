@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""\
+Local sync server
+==============================================================================
+
+Serves a deck on localhost through HttpSyncServer, so syncing over HTTP can
+be tested and measured without the real server:
+
+    server = LocalSyncServer(path)
+    server.start()
+    proxy = HttpSyncServerProxy(user, passwd, url=server.url)
+    client = SyncClient(deck)
+    client.setServer(proxy)
+    client.syncChanges()
+    server.stop()
+
+Credentials are ignored. The deck is opened by the thread or process serving
+it, and closed when the server stops. The "stats" action returns the number
+of requests handled, and the cpu time taken and rows written handling them.
+
+To serve a deck until interrupted:
+
+    python -m anki.syncserver deck.anki [port]
+"""
+
+import os, sys, urlparse, threading, multiprocessing, BaseHTTPServer
+import anki
+from anki.sync import HttpSyncServer, CHUNK_SIZE
+
+# actions which can be requested, and the fields that aren't arguments
+ACTIONS = ("getDecks", "createDeck", "changeChunks", "applyChunks",
+           "finish", "stats")
+AUTH = ("u", "p", "v", "d")
+
+class LocalSyncServer(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, path, port=0, compact=True):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ("127.0.0.1", port), SyncRequestHandler)
+        self.deckPath = path
+        self.url = "http://127.0.0.1:%d/sync/" % self.server_port
+        self.syncer = HttpSyncServer()
+        # used if the client offers it too
+        self.syncer.canCompact = compact
+        self.stats = {'requests': 0, 'cpu': 0.0, 'rows': 0}
+        # seconds between checks for stop()
+        self.timeout = 0.1
+        self._stop = multiprocessing.Event()
+        self._worker = None
+
+    def serve(self):
+        "Open the deck and handle requests until stop() is called."
+        deck = anki.Deck(self.deckPath)
+        self.syncer.deck = deck
+        try:
+            while not self._stop.is_set():
+                self.handle_request()
+        finally:
+            self.syncer.deck = None
+            deck.close()
+
+    def start(self, process=False):
+        """Serve in a background thread. If PROCESS, serve in a child process
+instead, so the cpu stat doesn't include the client's time."""
+        self._stop.clear()
+        if process:
+            self._worker = multiprocessing.Process(target=self.serve)
+        else:
+            self._worker = threading.Thread(target=self.serve)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self):
+        "Stop serving and close the deck. The server can't be restarted."
+        self._stop.set()
+        self._worker.join()
+        self._worker = None
+        self.server_close()
+
+    def dispatch(self, action, args, body):
+        """Return the reply to ACTION, a string or iterator of strings. BODY
+is an iterator of the raw request body, used by applyChunks."""
+        if action == "stats":
+            return self.syncer.stuff(self.stats)
+        deck = self.syncer.deck
+        self.syncer.decks = {deck.name(): [deck.mod, deck.lastSync]}
+        if action == "applyChunks":
+            args['data'] = body
+        return getattr(self.syncer, action)(**args)
+
+    def cpu(self):
+        "Seconds of cpu time used by this process."
+        t = os.times()
+        return t[0] + t[1]
+
+class SyncRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        db = server.syncer.deck.db
+        (cpu, rows) = (server.cpu(), db.totalChanges())
+        url = urlparse.urlparse(self.path)
+        action = url.path.split("/")[-1]
+        if action not in ACTIONS:
+            self.send_error(404)
+            return
+        args = dict(urlparse.parse_qsl(url.query, True))
+        body = self._body(int(self.headers.get("Content-length") or 0))
+        if (self.headers.get("Content-type") ==
+            "application/x-www-form-urlencoded"):
+            args.update(urlparse.parse_qsl("".join(body), True))
+            body = None
+        for key in AUTH:
+            args.pop(key, None)
+        try:
+            ret = server.dispatch(action, args, body)
+        except:
+            self.send_error(500)
+            raise
+        self.send_response(200)
+        self.send_header("Content-type", "application/octet-stream")
+        self.end_headers()
+        if isinstance(ret, str):
+            ret = [ret]
+        # streamed replies are generated as they're sent
+        for data in ret:
+            self.wfile.write(data)
+        if action != "stats":
+            server.stats['requests'] += 1
+            server.stats['cpu'] += server.cpu() - cpu
+            server.stats['rows'] += db.totalChanges() - rows
+
+    def _body(self, size):
+        "Yield the request body as it arrives."
+        while size > 0:
+            data = self.rfile.read(min(size, CHUNK_SIZE))
+            if not data:
+                break
+            size -= len(data)
+            yield data
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    if len(sys.argv) < 2:
+        print "usage: python -m anki.syncserver deck.anki [port]"
+        return 1
+    path = unicode(os.path.abspath(sys.argv[1]), sys.getfilesystemencoding())
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    server = LocalSyncServer(path, port)
+    print "Serving %s at %s" % (path, server.url)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    sys.exit(main())
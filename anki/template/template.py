@@ -34,6 +34,9 @@ def get_or_attr(obj, name, default=None):
             return default
 
 
+# compiled (section_re, tag_re) for each pair of delimiters
+_regexps = {}
+
 class Template(object):
     # The regular expression used to find a #section
     section_re = None
@@ -65,13 +68,16 @@ class Template(object):
 
     def compile_regexps(self):
         """Compiles our section and tag regular expressions."""
-        tags = { 'otag': re.escape(self.otag), 'ctag': re.escape(self.ctag) }
-
-        section = r"%(otag)s[\#|^]([^\}]*)%(ctag)s(.+?)%(otag)s/\1%(ctag)s"
-        self.section_re = re.compile(section % tags, re.M|re.S)
+        key = (self.otag, self.ctag)
+        if key not in _regexps:
+            tags = { 'otag': re.escape(self.otag),
+                     'ctag': re.escape(self.ctag) }
 
-        tag = r"%(otag)s(#|=|&|!|>|\{)?(.+?)\1?%(ctag)s+"
-        self.tag_re = re.compile(tag % tags)
+            section = r"%(otag)s[\#|^]([^\}]*)%(ctag)s(.+?)%(otag)s/\1%(ctag)s"
+            tag = r"%(otag)s(#|=|&|!|>|\{)?(.+?)\1?%(ctag)s+"
+            _regexps[key] = (re.compile(section % tags, re.M|re.S),
+                             re.compile(tag % tags))
+        self.section_re, self.tag_re = _regexps[key]
 
     def render_sections(self, template, context):
         """Expands sections."""
@@ -198,3 +204,283 @@ class Template(object):
         self.otag, self.ctag = tag_name.split(' ')
         self.compile_regexps()
         return ''
+
+
+class _Fallback(Exception):
+    pass
+
+
+class CompiledTemplate(object):
+    """A template parsed once into a tree, and rendered in a single pass.
+
+    Template expands sections and tags by searching and replacing until
+    nothing matches, so markup in the template or in field content can
+    interact in odd ways. Templates using anything beyond plain tags and
+    properly nested sections, and renders where field content could be
+    expanded again, are handed to Template so the output is always the
+    same.
+    """
+
+    # tags, with {{{triple}}} braces tried first
+    token_re = re.compile(r"(\{\{\{[^{}\n]+\}\}\}|\{\{[^{}\n]+\}\})")
+
+    def __init__(self, template):
+        self.template = template
+        self.tpl = Template(template)
+        try:
+            self.tree = self.parse(template)
+        except _Fallback:
+            self.tree = None
+
+    def parse(self, template):
+        """Returns a list of text, ('tag', type, name) and
+        ('section', inverted, name, cloze, children) nodes."""
+        root = []
+        # [(raw name, children)]
+        stack = [(None, root)]
+        tokens = self.token_re.split(template)
+        for token in tokens[1::2]:
+            if token.startswith("{{{") and token[1:-1] in tokens[1::2]:
+                # replacing {{x}} would change {{{x}}} too
+                raise _Fallback()
+        for c, token in enumerate(tokens):
+            nodes = stack[-1][1]
+            if not c % 2:
+                if "{" in token or "}" in token:
+                    raise _Fallback()
+                if token:
+                    nodes.append(token)
+                continue
+            if token.startswith("{{{"):
+                if token[3] in "#^|/=&>!{":
+                    raise _Fallback()
+            elif token[2] in "#^":
+                raw = token[3:-2]
+                if raw in [s[0] for s in stack]:
+                    raise _Fallback()
+                children = []
+                # cloze sections are true if the cloze exists
+                m = re.match("c[qa]:(\d+):(.+)", raw.strip())
+                if m:
+                    cloze = (re.compile(clozeReg%m.group(1)), m.group(2))
+                else:
+                    cloze = None
+                nodes.append(('section', token[2] == "^", raw.strip(), cloze,
+                              children))
+                stack.append((raw, children))
+                continue
+            elif token[2] == "/":
+                if token[3:-2] != stack[-1][0] or not nodes:
+                    raise _Fallback()
+                stack.pop()
+                continue
+            elif token[2] in "|=&>":
+                raise _Fallback()
+            match = self.tpl.tag_re.match(token)
+            if not match or match.end() != len(token):
+                raise _Fallback()
+            tag_type, tag_name = match.group(1, 2)
+            if tag_type is None and token[2] in "#=&!>{":
+                # in context the typed form might match further along
+                raise _Fallback()
+            nodes.append(('tag', tag_type, tag_name.strip()))
+        if len(stack) > 1:
+            raise _Fallback()
+        return root
+
+    def render(self, context=None):
+        context = context or {}
+        if self.tree is None:
+            return Template(self.template, context).render()
+        out = []
+        try:
+            self.render_nodes(self.tree, context, out, [False])
+        except _Fallback:
+            return Template(self.template, context).render()
+        except SyntaxError:
+            return u"{{invalid template}}"
+        result = "".join(out)
+        if "{{" in result:
+            return Template(self.template, context).render()
+        return result
+
+    def render_nodes(self, nodes, context, out, afterTag):
+        for node in nodes:
+            if not isinstance(node, tuple):
+                out.append(node)
+                afterTag[0] = False
+            elif node[0] == 'tag':
+                # a brace before the tag would change how it's matched
+                for prev in reversed(out):
+                    if prev:
+                        if prev.endswith("{"):
+                            raise _Fallback()
+                        break
+                txt = modifiers[node[1]](self.tpl, node[2], context)
+                # or after it, if an identical tag was replaced first
+                if afterTag[0] and txt.startswith("}"):
+                    raise _Fallback()
+                out.append(txt)
+                afterTag[0] = True
+            else:
+                (_, inverted, name, cloze, children) = node
+                if cloze:
+                    # get full field text
+                    txt = get_or_attr(context, cloze[1], None)
+                    m = cloze[0].search(txt)
+                    it = m.group(1) if m else None
+                else:
+                    it = get_or_attr(context, name, None)
+                if it and (hasattr(it, '__iter__') or hasattr(it, 'keys')):
+                    raise _Fallback()
+                if bool(it) != inverted:
+                    self.render_nodes(children, context, out, afterTag)
+
+    # Required fields
+    ##########################################################################
+    # Whether a card is empty is decided by comparing its rendering against
+    # one with all fields blank. Each part of the tree renders either the
+    # same text in both, or something longer when the fields are filled in,
+    # so the two differ exactly when some part's condition holds.
+
+    def requirements(self, fields):
+        """Return (cond, names), where cond holds when rendering with FIELDS
+        filled in differs from rendering them blank, and names are the
+        context keys it looks at. None if the template can't be analysed."""
+        if self.tree is None:
+            return None
+        self._names = set()
+        try:
+            cond = self._req(self.tree, fields)[0]
+        except _Fallback:
+            return None
+        return (cond, self._names)
+
+    def _req(self, nodes, fields):
+        "Return (differs, nonempty, blank output empty) for NODES."
+        diff = []
+        full = []
+        empty = True
+        for node in nodes:
+            if not isinstance(node, tuple):
+                full.append(True)
+                empty = False
+            elif node[0] == 'tag':
+                (_, type, name) = node
+                if type == '!':
+                    continue
+                if type is None and name.startswith("text:"):
+                    field = name[5:]
+                    cond = ('tag', type, name)
+                elif type is None and (name.startswith("cq:") or
+                                       name.startswith("ca:") or
+                                       name.startswith("cactx:")):
+                    m = re.match("c(.+):(\d+):(.+)", name)
+                    if not m:
+                        raise _Fallback()
+                    field = m.group(3)
+                    cond = ('cloze', re.compile(clozeReg%m.group(2)), field)
+                else:
+                    field = name
+                    cond = ('has', name)
+                self._names.add(field)
+                if field in fields:
+                    diff.append(cond)
+                    full.append(cond)
+                else:
+                    full.append(('tag', type, name))
+                    empty = False
+            else:
+                (_, inverted, name, cloze, children) = node
+                if cloze:
+                    field = cloze[1]
+                    cond = ('section', cloze[0], field)
+                    if field not in fields and field not in constants:
+                        # the field text would be None
+                        raise _Fallback()
+                else:
+                    field = name
+                    cond = ('has', name)
+                self._names.add(field)
+                (cdiff, cfull, cempty) = self._req(children, fields)
+                if inverted:
+                    cond = ('not', cond)
+                if field not in fields:
+                    diff.append(_all([cond, cdiff]))
+                    full.append(_all([cond, cfull]))
+                    empty = empty and cempty
+                elif not inverted:
+                    diff.append(_all([cond, cfull]))
+                    full.append(diff[-1])
+                elif cempty:
+                    diff.append(_all([cond, cdiff]))
+                    full.append(_all([cond, cfull]))
+                else:
+                    # filling the field in would remove text
+                    raise _Fallback()
+        return (_any(diff), _any(full), empty)
+
+    def satisfies(self, req, context):
+        """True if REQ from requirements() holds for CONTEXT. None if a field
+        has braces that rendering might expand, so only rendering can tell."""
+        (cond, names) = req
+        for name in names:
+            txt = get_or_attr(context, name, None)
+            if txt and ("{" in txt or "}" in txt):
+                txt = re.sub(clozeReg%"\d+",
+                             lambda m: m.group(1) + (m.group(3) or ""), txt)
+                if "{" in txt or "}" in txt:
+                    return None
+        return self._holds(cond, context)
+
+    def _holds(self, cond, context):
+        if cond is True or cond is False:
+            return cond
+        type = cond[0]
+        if type == 'any':
+            for c in cond[1]:
+                if self._holds(c, context):
+                    return True
+            return False
+        elif type == 'all':
+            for c in cond[1]:
+                if not self._holds(c, context):
+                    return False
+            return True
+        elif type == 'not':
+            return not self._holds(cond[1], context)
+        elif type == 'has':
+            return bool(get_or_attr(context, cond[1], None))
+        elif type == 'tag':
+            return bool(modifiers[cond[1]](self.tpl, cond[2], context))
+        txt = get_or_attr(context, cond[2], None)
+        if not txt:
+            return False
+        m = cond[1].search(txt)
+        if type == 'cloze':
+            return bool(m)
+        # a cloze section
+        return bool(m and m.group(1))
+
+# names _renderQA always sets, which are the same filled in or blank
+constants = ("Tags", "Model", "Group", "Template")
+
+def _any(conds):
+    conds = [c for c in conds if c is not False]
+    if True in conds:
+        return True
+    if not conds:
+        return False
+    if len(conds) == 1:
+        return conds[0]
+    return ('any', conds)
+
+def _all(conds):
+    conds = [c for c in conds if c is not True]
+    if False in conds:
+        return False
+    if not conds:
+        return True
+    if len(conds) == 1:
+        return conds[0]
+    return ('all', conds)
@@ -238,6 +238,20 @@ def splitFields(string):
 def checksum(data):
     return md5(data).hexdigest()
 
+def fileChecksum(path):
+    "Checksum of the file at PATH, read in chunks."
+    m = md5()
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            m.update(data)
+    finally:
+        f.close()
+    return m.hexdigest()
+
 def fieldChecksum(data):
     # 32 bit unsigned number from first 8 digits of md5 hash
     return int(checksum(data.encode("utf-8"))[:8], 16)
@@ -3,7 +3,7 @@
 import time
 from anki.db import DB
 from anki.consts import *
-from tests.shared import getEmptyDeck
+from tests.shared import assertException, getEmptyDeck
 
 def test_genCards():
     deck = getEmptyDeck()
@@ -56,6 +56,7 @@ def test_delete():
     cid = f.cards()[0].id
     deck.reset()
     deck.sched.answerCard(deck.sched.getCard(), 2)
+    deck.flushRevlog()
     assert deck.db.scalar("select count() from revlog") == 1
     deck.delCards([cid])
     assert deck.cardCount() == 0
@@ -88,3 +89,19 @@ def test_misc():
     assert c.fact().id == 1
     assert c.model().id == 1
     assert c.template()['ord'] == 0
+
+def test_slots():
+    d = getEmptyDeck()
+    f = d.newFact()
+    f['Front'] = u"1"
+    d.addFact(f)
+    c = f.cards()[0]
+    # only the known attributes can be set
+    assertException(AttributeError, lambda: setattr(c, "foo", 1))
+    assertException(AttributeError, lambda: setattr(f, "foo", 1))
+    # the undo journal keeps the card's columns
+    d.reset()
+    d.sched.answerCard(d.sched.getCard(), 3)
+    assert d._undo[2] == [c.row()]
+    d.undo()
+    assert d.getCard(c.id).row()[6:] == c.row()[6:]
@@ -1,9 +1,10 @@
 # coding: utf-8
 
-import os, re, datetime
+import os, re, datetime, tempfile
 from tests.shared import assertException, getEmptyDeck, testDir
 
 from anki import Deck
+from anki.errors import AnkiError
 
 newPath = None
 newMod = None
@@ -82,6 +83,38 @@ def test_factAddDelete():
     assert deck.cardCount() == 0
     assert deck.factCount() == 0
 
+def test_addFacts():
+    deck = getEmptyDeck()
+    m = deck.currentModel()
+    m.templates[1]['actv'] = True
+    m.flush()
+    facts = []
+    for i in range(5):
+        f = deck.newFact()
+        f['Front'] = u"f%d" % i; f['Back'] = u"b%d" % i
+        f.tags = [u"bulk", u"t%d" % (i % 2)]
+        facts.append(f)
+    # a fact without cards is skipped
+    facts[2]['Front'] = u""; facts[2]['Back'] = u""
+    assert deck.addFacts(facts) == 8
+    assert facts[2].id is None
+    assert deck.factCount() == 4
+    assert deck.cardCount() == 8
+    # the same as adding one at a time
+    f = deck.newFact()
+    f['Front'] = u"one"; f['Back'] = u"two"
+    deck.addFact(f)
+    assert f.id == facts[4].id + 1
+    assert [c.ord for c in facts[4].cards()] == [0, 1]
+    assert facts[4].cards()[1].id + 1 == f.cards()[0].id
+    assert deck.db.scalar("select count() from fsums") == 5
+    assert sorted(deck.tagList()) == [u"bulk", u"t0", u"t1"]
+    assert len(deck.findCards("tag:t0")) == 4
+    assert len(deck.findCards("f3")) == 2
+    assert re.sub("</?.+?>", "", facts[1].cards()[0].q()) == u"f1"
+    deck.reset()
+    assert deck.sched.counts() == (10, 0, 0)
+
 def test_fieldChecksum():
     deck = getEmptyDeck()
     f = deck.newFact()
@@ -129,6 +162,44 @@ def test_upgrade():
     # now's a good time to test the integrity check too
     deck.fixIntegrity()
 
+def test_upgradeResume():
+    import tempfile, shutil
+    import anki.storage
+    from anki.hooks import addHook, removeHook
+    src = os.path.join(testDir, "support", "anki12.anki")
+    (fd, dst) = tempfile.mkstemp(suffix=".anki")
+    shutil.copy(src, dst)
+    # stop partway through migrating the facts, and then through building
+    # the tag map
+    class Stop(Exception):
+        pass
+    stops = ["facts", "tagMap"]
+    def onProgress(step, pos, total):
+        if step == stops[0]:
+            stops.pop(0)
+            raise Stop()
+    old = anki.storage.upgradeChunk
+    anki.storage.upgradeChunk = 2
+    addHook("upgradeProgress", onProgress)
+    try:
+        assertException(Stop, lambda: Deck(dst))
+        assertException(Stop, lambda: Deck(dst))
+        stops.append(None)
+    finally:
+        removeHook("upgradeProgress", onProgress)
+        anki.storage.upgradeChunk = old
+    # opening again should carry on where it left off
+    deck = Deck(dst)
+    assert deck.sched.counts() == (3,2,1)
+    assert deck.factCount() == 4
+    assert not deck.db.scalar(
+        "select 1 from sqlite_master where name = 'upgrade'")
+    # the field cache and tag map cover every fact
+    assert not deck.db.scalar("select count() from facts where sfld = ''")
+    assert not deck._staleTagFids()
+    assert deck.db.scalar("select count(distinct fid) from fwords") == 4
+    deck.close()
+
 def test_groups():
     deck = getEmptyDeck()
     # we start with a standard group
@@ -189,3 +260,220 @@ def test_addDelTags():
     f.load()
     assert f.tags[0] == "aaa"
     assert len(f.tags) == 2
+
+def test_iterRenderQA():
+    deck = getEmptyDeck()
+    for i in range(5):
+        f = deck.newFact()
+        f['Front'] = u"q%d" % i; f['Back'] = u"a%d" % i
+        if i == 3:
+            f['Back'] += u" [$]x[/$]"
+        deck.addFact(f)
+    # latex output depends on whether it's installed
+    import anki.latex
+    anki.latex.build = False
+    try:
+        full = deck.renderQA(type="all")
+        assert len(full) == 5
+        # streamed in chunks
+        assert list(deck.iterRenderQA(chunk=2)) == full
+        # and rendered by worker processes
+        assert list(deck.iterRenderQA(chunk=2, procs=2)) == full
+        cid = full[1]['id']
+        assert [d['id'] for d in deck.iterRenderQA(
+            "and c.id = %d" % cid, procs=2)] == [cid]
+        # pools don't share state, so renders can be interleaved
+        other = getEmptyDeck()
+        f = other.newFact()
+        f['Front'] = u"other"; f['Back'] = u"deck"
+        other.addFact(f)
+        it = deck.iterRenderQA(chunk=1, procs=1)
+        res = [it.next()]
+        assert list(other.iterRenderQA(procs=1)) == other.renderQA(type="all")
+        assert res + list(it) == full
+        # workers are given plain data, so they needn't be forked
+        import multiprocessing, pickle
+        from anki.deck import _initRenderWorker, _renderChunk
+        args = []
+        old = multiprocessing.Pool
+        def Pool(procs, init, initargs):
+            args.append(pickle.loads(pickle.dumps(initargs, 2)))
+            return old(procs, init, initargs)
+        multiprocessing.Pool = Pool
+        try:
+            list(deck.iterRenderQA(procs=1))
+        finally:
+            multiprocessing.Pool = old
+        _initRenderWorker(*args[0])
+        assert _renderChunk(deck._qaData("order by c.id").fetchall()) == full
+    finally:
+        anki.latex.build = True
+
+def test_dbStats():
+    from anki.db import normalizeSQL
+    deck = getEmptyDeck()
+    db = deck.db
+    assert normalizeSQL("select id from cards  where id in (1, 2,3)\n"
+                        "and due > -5 and data = 'x'") == (
+        "select id from cards where id in (?) and due > ? and data = ?")
+    db.profile()
+    for i in range(10):
+        db.list("select id from cards where id in (%d, %d)" % (i, i+1))
+    db.scalar("select count() from cards")
+    st = db.queryStats()
+    assert len(st) == 2
+    assert sorted((r[1], r[0]) for r in st) == [
+        (1, "select count() from cards"),
+        (10, "select id from cards where id in (?)")]
+    db.profile(False)
+    assert not db.queryStats()
+    # slow query log
+    db.setSlowLimit(0.00000001)
+    db.scalar("select 1")
+    assert db.slowLog[-1][1] == "select 1"
+    db.setSlowLimit(None)
+    # capturing
+    with db.capture() as queries:
+        deck.cardCount()
+        db.execute("select ?", 5)
+    assert [q[:2] for q in queries] == [
+        ("select count() from cards", ()), ("select ?", (5,))]
+    assert not db._timed
+
+def test_concurrent():
+    import threading, sqlite3
+    (fd, path) = tempfile.mkstemp(suffix=".anki")
+    os.close(fd); os.unlink(path)
+    deck = Deck(path, concurrent=True)
+    assert deck.db.scalar("pragma journal_mode") == "wal"
+    f = deck.newFact()
+    f['Front'] = u"one"; f['Back'] = u"two"
+    deck.addFact(f)
+    # uncommitted changes are read from the writer
+    assert deck.db.pending()
+    assert len(deck.findCards("one")) == 1
+    deck.save()
+    assert not deck.db.pending()
+    # the deck isn't locked between saves, so others can read and write
+    other = sqlite3.connect(path, timeout=0)
+    assert other.execute("select count() from cards").fetchone()[0] == 1
+    other.execute("update deck set mod=mod")
+    other.commit()
+    other.close()
+    # searches and stats can run in other threads
+    res = []
+    def search():
+        res.append(deck.findCards("one"))
+        res.append(bool(deck.stats().report()))
+    threads = [threading.Thread(target=search) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(res) == sorted([[f.cards()[0].id], True]*4)
+    assert 1 <= len(deck.pool._all) <= 4
+    deck.close()
+    # and the deck is left as a single file
+    assert not os.path.exists(path + "-wal")
+    deck = Deck(path)
+    assert deck.db.scalar("pragma journal_mode") == "delete"
+    deck.close()
+
+def test_tempIds():
+    import anki.db
+    deck = getEmptyDeck()
+    for i in range(5):
+        f = deck.newFact()
+        f['Front'] = u"f%d" % i; f['Back'] = u"b"
+        deck.addFact(f)
+    cids = deck.db.list("select id from cards")
+    old = anki.db.IDLIMIT
+    anki.db.IDLIMIT = 2
+    try:
+        assert deck.db.ids2str(cids[:2]) == "(%d,%d)" % tuple(cids[:2])
+        with deck.db.capture() as queries:
+            assert len(deck.renderQA(cids)) == 5
+        assert [q for q in queries if "temp._ids where" in q[0]]
+        assert len(deck.findCards("b", full=True)) == 5
+        deck.sched.sortCards(cids, start=10)
+        assert deck.db.list("select due from cards order by id") == range(
+            10, 15)
+        # bulk operations don't spell out the ids, even when the counter
+        # cache is loaded
+        deck.reset()
+        deck.sched.counts()
+        fids = deck.db.list("select id from facts")
+        with deck.db.capture() as queries:
+            deck.sched.suspendCards(cids)
+            deck.sched.unsuspendCards(cids)
+            deck.sched.forgetCards(cids)
+            deck.setGroup(cids, deck.groupId(u"g"))
+            deck.addTags(fids, u"x")
+            deck.delCards(cids[4:])
+            deck.delFacts(fids[2:4])
+        lists = [q for q in queries if re.search(r"\(\d+(,\d+){2,}\)", q[0])]
+        assert not lists
+        deck.delCards(deck.db.list("select id from cards")[1:])
+        assert deck.cardCount() == 1
+        assert deck.factCount() == 1
+        assert deck.db.scalar("select count() from temp._ids")
+        # a list used after a commit cleared it raises rather than matching
+        # nothing
+        sids = deck.db.ids2str(deck.db.list("select id from cards") * 3)
+        deck.save()
+        assert not deck.db.scalar("select count() from temp._ids")
+        assertException(AnkiError, lambda: deck.db.list(
+            "select id from cards where id in "+sids))
+        # rendering selects its cards before the caller commits
+        for i in range(3):
+            f = deck.newFact()
+            f['Front'] = u"r%d" % i; f['Back'] = u"b"
+            deck.addFact(f)
+        cids = deck.db.list("select id from cards")
+        rendered = deck.iterRenderQA(
+            "and c.id in "+deck.db.ids2str(cids), chunk=1)
+        first = rendered.next()
+        deck.save()
+        assert [first['id']] + [d['id'] for d in rendered] == sorted(cids)
+    finally:
+        anki.db.IDLIMIT = old
+
+def test_bulkLoad():
+    deck = getEmptyDeck()
+    deck.currentModel().templates[1]['actv'] = True
+    deck.currentModel().flush()
+    for i in range(5):
+        f = deck.newFact()
+        f['Front'] = u"f%d" % i; f['Back'] = u"b%d" % i
+        deck.addFact(f)
+    cids = deck.db.list("select id from cards order by id desc")
+    fids = deck.db.list("select id from facts")
+    with deck.db.capture() as queries:
+        cards = deck.getCards(cids + [123])
+        facts = deck.getFacts(fids)
+    assert len(queries) == 2
+    assert [c.id for c in cards] == cids
+    assert [f['Front'] for f in facts] == [u"f%d" % i for i in range(5)]
+    # a fact's cards share it
+    with deck.db.capture() as queries:
+        cards = facts[0].cards()
+        assert [c.ord for c in cards] == [0, 1]
+        assert cards[0].fact() is facts[0]
+    assert len(queries) == 2
+    # with the identity map, loaded objects are reused
+    assert deck.getFact(fids[0]) is not deck.getFact(fids[0])
+    deck.useIdentityMap()
+    f = deck.getFact(fids[0])
+    with deck.db.capture() as queries:
+        assert deck.getFact(fids[0]) is f
+        assert deck.getFacts(fids)[0] is f
+    assert len(queries) == 1
+    c = deck.getCard(cids[0])
+    assert deck.getCards(cids)[0] is c
+    # but not once they're released, or after a reset
+    del f
+    assert ("f", fids[0]) not in deck._objs
+    deck.reset()
+    assert deck.getCard(cids[0]) is not c
+    deck.useIdentityMap(False)
+    assert deck.getCard(cids[0]) is not deck.getCard(cids[0])
@@ -113,6 +113,78 @@ def test_findCards():
     # searching for an invalid special tag should not error
     assert len(deck.findCards("is:invalid")) == 0
 
+def test_wordIndex():
+    deck = getEmptyDeck()
+    f = deck.newFact()
+    f['Front'] = u'concatenate <b>Dogs</b>'
+    f['Back'] = u'<img src="sheep.jpg">'
+    deck.addFact(f)
+    assert deck.db.scalar("select count() from fwords") == 7
+    # matches within words, html and phrases still work
+    assert len(deck.findCards("cat")) == 1
+    assert len(deck.findCards("dogs")) == 1
+    assert len(deck.findCards('"<b>dogs"')) == 1
+    assert len(deck.findCards("sheep.jpg")) == 1
+    assert len(deck.findCards("sheep.jpg", full=True)) == 0
+    assert len(deck.findCards("back:sheep")) == 1
+    assert len(deck.findCards("-cat")) == 0
+    # wildcards fall back to a scan
+    assert len(deck.findCards("con*ate")) == 1
+    # editing the fact updates the index
+    f['Front'] = u'horse'
+    f.flush()
+    assert len(deck.findCards("cat")) == 0
+    assert len(deck.findCards("horse")) == 1
+    # as does find & replace
+    deck.findReplace([f.id], "horse", "goat")
+    assert len(deck.findCards("horse")) == 0
+    assert len(deck.findCards("front:goat")) == 1
+    # and deletion
+    deck.delFacts([f.id])
+    assert deck.db.scalar("select count() from fwords") == 0
+
+def test_tagMap():
+    deck = getEmptyDeck()
+    f = deck.newFact()
+    f['Front'] = u'one'
+    f.tags = [u"lang::french", u"verb"]
+    deck.addFact(f)
+    f2 = deck.newFact()
+    f2['Front'] = u'two'
+    f2.tags = [u"lang"]
+    deck.addFact(f2)
+    f3 = deck.newFact()
+    f3['Front'] = u'three'
+    deck.addFact(f3)
+    assert deck.db.scalar("select count() from ftags") == 3
+    # tag lookups
+    assert sorted(deck.tagFids(u"lang")) == [f2.id]
+    assert sorted(deck.tagFids(u"LANG", children=True)) == sorted([f.id, f2.id])
+    assert len(deck.findCards("tag:lang*")) == 2
+    assert len(deck.findCards("tag:none")) == 1
+    assert len(deck.findCards("-tag:none")) == 2
+    # the map follows fact edits and bulk changes
+    f.tags.remove(u"verb")
+    f.flush()
+    assert not deck.findCards("tag:verb")
+    deck.addTags([f3.id], u"verb")
+    assert deck.tagFids(u"verb") == [f3.id]
+    assert not deck.findCards("tag:none")
+    deck.delTags([f3.id], u"verb")
+    assert not deck.tagFids(u"verb")
+    # and deletion
+    deck.delFacts([f.id])
+    assert not deck.db.scalar(
+        "select count() from ftags where fid = ?", f.id)
+    # the integrity check only reindexes facts whose map is wrong, and drops
+    # unused tags
+    deck.db.execute("update facts set tags = ' lang x ' where id = ?", f2.id)
+    assert deck._staleTagFids() == [f2.id]
+    deck.fixIntegrity()
+    assert deck.tagFids(u"x") == [f2.id]
+    assert not deck._staleTagFids()
+    assert deck.tagList() == [u"lang", u"x"]
+
 def test_findReplace():
     deck = getEmptyDeck()
     f = deck.newFact()
@@ -56,3 +56,52 @@ def test_latex():
     assert len(os.listdir(d.media.dir())) == 2
     assert stripHTML(f.cards()[0].q()) == "[latex]foo[/latex]"
     assert ".png" in oldcard.q()
+
+def test_buildAll():
+    import anki.latex, tempfile
+    # stand-ins for latex and dvipng which copy the source to the output
+    bin = tempfile.mkdtemp()
+    for (name, script) in (("latex", "cp tmp.tex tmp.dvi"),
+                           ("dvipng", "cp tmp.dvi tmp.png")):
+        path = os.path.join(bin, name)
+        open(path, "w").write("#!/bin/sh\n%s\n" % script)
+        os.chmod(path, 0755)
+    old = (anki.latex.latexCmd[0], anki.latex.latexDviPngCmd[0],
+           anki.latex.build)
+    anki.latex.latexCmd[0] = os.path.join(bin, "latex")
+    anki.latex.latexDviPngCmd[0] = os.path.join(bin, "dvipng")
+    try:
+        d = getEmptyDeck()
+        anki.latex.build = False
+        for i in range(4):
+            f = d.newFact()
+            f['Front'] = u"[latex]%d[/latex] [$]x[/$]" % i
+            d.addFact(f)
+        anki.latex.build = True
+        # the 5 snippets are built in parallel and recorded
+        assert anki.latex.buildAll(d, procs=2) == {}
+        pngs = [n for n in os.listdir(d.media.dir()) if n.endswith(".png")]
+        assert len(pngs) == 5
+        assert d.media.names() == set(pngs)
+        # with the model's header and footer
+        srcs = [open(os.path.join(d.media.dir(), n)).read() for n in pngs]
+        assert len([s for s in srcs if "\n$x$\n\\end{document}" in s]) == 1
+        # so rendering doesn't have to look for them
+        oldExists = os.path.exists
+        os.path.exists = None
+        try:
+            assert f.cards()[0].q().count("<img") == 2
+        finally:
+            os.path.exists = oldExists
+        assert anki.latex.buildAll(d) == {}
+        # failures are reported
+        anki.latex.latexCmd[0] = "nolatex"
+        f = d.newFact()
+        f['Front'] = u"[latex]bad[/latex]"
+        d.addFact(f)
+        errs = anki.latex.buildAll(d)
+        assert len(errs) == 1
+        assert "executing latex" in errs.values()[0]
+    finally:
+        (anki.latex.latexCmd[0], anki.latex.latexDviPngCmd[0],
+         anki.latex.build) = old
@@ -68,3 +68,104 @@ def test_rename():
     new = d.path.replace(".anki", "2.anki")
     d.rename(new)
 
+
+def test_refs():
+    d = getEmptyDeck()
+    refs = lambda: sorted(d.db.all("select * from media_refs"))
+    f = d.newFact()
+    f['Front'] = u"<IMG src='a.jpg'>[sound:b.mp3]"
+    f['Back'] = u"<img src='a.jpg'><img src='http://x.com/c.jpg'>"
+    d.addFact(f)
+    # the index is kept up to date as facts change
+    assert refs() == [(f.id, "a.jpg"), (f.id, "b.mp3")]
+    f['Front'] = u"[sound:d.mp3]"
+    f.flush()
+    assert refs() == [(f.id, "a.jpg"), (f.id, "d.mp3")]
+    d.findReplace([f.id], "d.mp3", "e.mp3")
+    assert refs() == [(f.id, "a.jpg"), (f.id, "e.mp3")]
+    m = d.currentModel()
+    m.delField(m.fields[1])
+    assert refs() == [(f.id, "e.mp3")]
+    # templates are included too
+    m.templates[0]['qfmt'] += "<img src='logo.png'>"
+    m.flush()
+    assert d.media.allMedia() == set(["e.mp3", "logo.png"])
+    # checking doesn't render the cards
+    d.media.dir(create=True)
+    open(os.path.join(d.media.dir(), "e.mp3"), "wb").write("test")
+    open(os.path.join(d.media.dir(), "old.jpg"), "wb").write("test")
+    d.reset()
+    with d.db.capture() as queries:
+        assert d.media.check(delete=True) == (["logo.png"], ["old.jpg"])
+    assert not [q for q in queries if "from cards" in q[0]]
+    assert os.listdir(d.media.dir()) == ["e.mp3"]
+    d.delFacts([f.id])
+    assert refs() == []
+    d.fixIntegrity()
+    assert refs() == []
+
+def test_fieldRefs():
+    d = getEmptyDeck()
+    m = d.currentModel()
+    m.templates[0]['qfmt'] += "<img src=\"{{Back}}\">"
+    m.templates[0]['afmt'] += "[sound:{{text:Back}}.mp3]"
+    m.flush()
+    f = d.newFact()
+    f['Front'] = u"a"
+    f['Back'] = u"pic.jpg"
+    d.addFact(f)
+    f = d.newFact()
+    f['Front'] = u"b"
+    d.addFact(f)
+    assert not d.media.templateRefs()[m.id]
+    assert d.media.allMedia() == set(["pic.jpg", "pic.jpg.mp3"])
+    # files used through fields aren't reported unused or deleted
+    d.media.dir(create=True)
+    open(os.path.join(d.media.dir(), "pic.jpg"), "wb").write("test")
+    assert d.media.check(delete=True) == (["pic.jpg.mp3"], [])
+    assert os.listdir(d.media.dir()) == ["pic.jpg"]
+
+def test_manifest():
+    import anki.media
+    d = getEmptyDeck()
+    dir = tempfile.mkdtemp(prefix="anki")
+    path = os.path.join(dir, "foo.jpg")
+    open(path, "w").write("hello")
+    assert d.media.addFile(path) == "foo.jpg"
+    # the same contents under another name are reused
+    path2 = os.path.join(dir, "bar.jpg")
+    open(path2, "w").write("hello")
+    assert d.media.addFile(path2) == "foo.jpg"
+    assert d.db.all("select fname, size, csum from media_files") == [
+        ("foo.jpg", 5, checksum("hello"))]
+    # scanning only rereads files that have changed
+    mdir = d.media.dir()
+    open(os.path.join(mdir, "new.jpg"), "w").write("new")
+    read = []
+    old = anki.media.fileChecksum
+    anki.media.fileChecksum = lambda p: read.append(p) or old(p)
+    try:
+        assert d.media.scan() == (["new.jpg"], [])
+        assert read == [os.path.join(mdir, "new.jpg")]
+        assert d.media.scan() == ([], [])
+        open(os.path.join(mdir, "new.jpg"), "w").write("newer")
+        os.unlink(os.path.join(mdir, "foo.jpg"))
+        assert d.media.scan() == (["new.jpg"], ["foo.jpg"])
+        assert len(read) == 2
+    finally:
+        anki.media.fileChecksum = old
+    # a file that's gone isn't reused
+    assert d.media.addFile(path) == "foo.jpg"
+    assert os.path.exists(os.path.join(mdir, "foo.jpg"))
+    # files added behind the manifest's back are only looked for once
+    open(os.path.join(mdir, "extra.jpg"), "w").write("x")
+    exists = []
+    oldExists = os.path.exists
+    os.path.exists = lambda p: exists.append(p) or oldExists(p)
+    try:
+        assert d.media.have("extra.jpg")
+        assert d.media.have("extra.jpg")
+        assert not d.media.have("missing.jpg")
+    finally:
+        os.path.exists = oldExists
+    assert len(exists) == 2
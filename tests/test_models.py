@@ -224,3 +224,51 @@ def test_modelChange():
     assert f['Notes'] == "b2"
     assert len(f.cards()) == 2
     assert "b2" in f.cards()[0].a()
+
+def test_compiledTemplate():
+    from anki.template import Template, CompiledTemplate
+    ctx = {'Front': u'<span class="x">1</span>', 'Back': u'', 'Text':
+           u'<span class="y">{{c1::a}} {{c2::b::hint}}</span>'}
+    for t in (u"{{Front}} {{{Front}}} {{!note}} {{text:Front}}",
+              u"{{#Front}}y{{^Back}}z{{/Back}}{{/Front}}{{#Back}}x{{/Back}}",
+              u"{{cq:1:Text}}<hr>{{ca:2:Text}}{{#cq:3:Text}}3{{/cq:3:Text}}",
+              u"{{Missing}} {{/Front}}", u"{{=<% %>=}}<%Front%>",
+              # markup in fields is expanded again by the old renderer
+              u"{{Text}}"):
+        c = CompiledTemplate(t)
+        assert c.render(ctx) == Template(t, ctx).render()
+    assert CompiledTemplate(u"{{Front}}").tree
+    assert not CompiledTemplate(u"{{#Front}}unclosed").tree
+    # compiled forms are cached until the model is flushed
+    deck = getEmptyDeck()
+    m = deck.currentModel()
+    fmt = m.templates[0]['qfmt']
+    assert m.compiledTemplate(fmt) is m.compiledTemplate(fmt)
+    m.flush()
+    assert not m._compiled
+
+def test_requirements():
+    deck = getEmptyDeck()
+    m = deck.currentModel()
+    t = m.templates[0]
+    f = deck.newFact()
+    fmts = (u"{{Front}}", u"{{text:Back}}", u"{{Tags}}{{Back}}",
+            u"x{{#Back}}{{Front}}{{/Back}}", u"{{^Back}}{{Front}}{{/Back}}",
+            u"{{^Back}}none{{/Back}}", u"{{cloze:2:Front}}",
+            u"{{#cloze:1:Front}}1{{/cloze:1:Front}}")
+    vals = (u"", u"a", u"<br>", u"{{c1::a}}", u"{{c2::}}", u"{x}")
+    for fmt in fmts:
+        t['qfmt'] = fmt
+        for front in vals:
+            for back in vals:
+                f['Front'] = front; f['Back'] = back
+                data = [1, 1, m.id, 1, 0, "", f.joinedFields()]
+                blank = data[:6] + [u"\x1f"]
+                expected = (deck._renderQA(m, "", data)['q'] !=
+                            deck._renderQA(m, "", blank)['q'])
+                assert bool(deck.findTemplates(f)) == expected
+    # analysed once per format, unless it could remove text
+    fmt = u"{{Front}}"
+    assert m.requirements(fmt) is m.requirements(fmt)
+    assert m.requirements(u"{{^Back}}{{Front}}{{/Back}}")
+    assert m.requirements(u"{{^Back}}none{{/Back}}") is None
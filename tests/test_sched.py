@@ -1,6 +1,6 @@
 # coding: utf-8
 
-import time, copy
+import time, copy, random
 from tests.shared import assertException, getEmptyDeck
 from anki.stdmodels import BasicModel
 from anki.utils import stripHTML, intTime
@@ -115,6 +115,7 @@ def test_learn():
     assert c.grade == 1
     assert c.cycles == 2
     # check log is accurate
+    d.flushRevlog()
     log = d.db.first("select * from revlog order by time desc")
     assert log[2] == 2
     assert log[3] == -180
@@ -183,7 +184,6 @@ def test_reviews():
     c.due = d.sched.today - 8
     c.factor = 2500
     c.reps = 3
-    c.streak = 2
     c.lapses = 1
     c.ivl = 100
     c.startTimer()
@@ -340,7 +340,7 @@ def test_misc():
     assert d.sched.repsToday() == 0
     c.timerStarted = time.time() - 10
     d.sched.answerCard(c, 2)
-    assert d.sched.timeToday() > 0
+    assert d.sched.timeToday() == sum(r[6] for r in d._revlog)/1000.0
     assert d.sched.repsToday() == 1
 
 def test_suspend():
@@ -514,14 +514,23 @@ def test_adjIvl():
     d.addFact(f)
     assert d.cardCount() == 4
     d.reset()
+    # sibling positions are preloaded with the queue
+    assert d.sched._sibDues == {f.id: {}}
     # immediately remove first; it should get ideal ivl
     c = d.sched.getCard()
     d.sched.answerCard(c, 3)
     assert c.ivl == 7
+    # and updated as cards are answered
+    assert d.sched._sibDues == {f.id: {c.id: c.due}}
     # with the default settings, second card should be -1
     c = d.sched.getCard()
-    d.sched.answerCard(c, 3)
+    with d.db.capture() as queries:
+        d.sched.answerCard(c, 3)
     assert c.ivl == 6
+    # without reading siblings or the card back from the DB
+    assert not [q for q in queries if q[0].startswith("select")
+                and "from cards" in q[0]]
+    assert d.sched._sibDues[f.id][c.id] == c.due
     # and third +1
     c = d.sched.getCard()
     d.sched.answerCard(c, 3)
@@ -632,6 +641,172 @@ def test_counts2():
     d.sched.answerCard(c, 1)
     assert d.sched.counts() == (0, 1, 0)
 
+def test_countCache():
+    d = getEmptyDeck()
+    for i in range(4):
+        f = d.newFact()
+        f['Front'] = u"one"; f['Back'] = u"two"
+        d.addFact(f)
+    d.reset()
+    assert d.sched.counts() == (4, 0, 0)
+    def check():
+        # the cache should match a freshly built one
+        cnts = copy.deepcopy(d.sched._groupCnts())
+        lrn = dict(d.sched._lrnCnts)
+        d.sched.invalidateCounts()
+        fresh = dict((k, v) for (k, v) in d.sched._groupCnts().items() if v[0])
+        assert dict((k, v) for (k, v) in cnts.items() if v[0]) == fresh
+        assert lrn == d.sched._lrnCnts
+    cids = d.db.list("select id from cards order by id")
+    # answering
+    c = d.sched.getCard()
+    d.sched.answerCard(c, 1)
+    check()
+    # cards are uncounted as loaded, without reading them back
+    c2 = d.sched.getCard()
+    with d.db.capture() as queries:
+        d.sched.answerCard(c2, 2)
+    assert not [q for q in queries if "queue, due from cards" in q[0]]
+    check()
+    d.undo()
+    check()
+    # rescheduling, suspending and burying
+    d.sched.reschedCards(cids[1:2], 0, 0)
+    check()
+    d.sched.suspendCards([cids[1], c.id])
+    check()
+    d.sched.unsuspendCards([cids[1]])
+    check()
+    d.sched.buryFact(d.getCard(cids[2]).fid)
+    check()
+    d.sched.forgetCards(cids[1:2])
+    check()
+    # groups and deletion
+    d.setGroup(cids[:2], d.groupId("new group"))
+    check()
+    d.delCards(cids[3:])
+    check()
+    # counts come from the cache
+    d.reset()
+    assert d.sched.counts() == (1, 0, 0)
+    assert d.sched.allCounts() == (1, 0, 0)
+    # and can be rebuilt after external changes
+    d.db.execute("update cards set queue = 0, type = 0")
+    d.sched.invalidateCounts()
+    d.reset()
+    assert d.sched.counts() == (3, 0, 0)
+
+def test_countStale():
+    d = getEmptyDeck()
+    for i in range(3):
+        f = d.newFact()
+        f['Front'] = u"one"; f['Back'] = u"two"
+        d.addFact(f)
+    d.reset()
+    cids = d.db.list("select id from cards order by id")
+    def check():
+        cnts = copy.deepcopy(d.sched._groupCnts())
+        d.sched.invalidateCounts()
+        fresh = d.sched._groupCnts()
+        assert dict((k, v) for (k, v) in cnts.items() if v[0]) == dict(
+            (k, v) for (k, v) in fresh.items() if v[0])
+    d.sched._groupCnts()
+    # cards changed by bulk operations after they were loaded
+    (c1, c2) = (d.getCard(cids[0]), d.getCard(cids[1]))
+    d.sched.suspendCards([c1.id])
+    gid = d.groupId("new group")
+    d.setGroup([c2.id], gid)
+    c1.flush()
+    c2.flush()
+    check()
+    # or through another object
+    c3 = d.getCard(cids[2])
+    other = d.getCard(cids[2])
+    other.queue = -1
+    other.flush()
+    c3.due = 5
+    c3.flush()
+    check()
+    # unchanged cards are still uncounted without reading them back
+    c = d.getCard(cids[2])
+    with d.db.capture() as queries:
+        c.flush()
+    assert not [q for q in queries if "queue, due from cards" in q[0]]
+    check()
+
+def test_revlogBuffer():
+    d = getEmptyDeck()
+    for i in range(3):
+        f = d.newFact()
+        f['Front'] = u"one"; f['Back'] = u"two"
+        d.addFact(f)
+    d.reset()
+    for i in range(3):
+        d.sched.answerCard(d.sched.getCard(), 2)
+    # entries are buffered with unique, increasing times
+    assert not d.db.scalar("select count() from revlog")
+    times = [r[0] for r in d._revlog]
+    assert times == sorted(set(times))
+    # but included in today's totals
+    assert d.sched.repsToday() == 3
+    assert d.sched.timeToday() == sum(r[6] for r in d._revlog)/1000.0
+    # undo removes the buffered entry
+    d.undo()
+    assert d.sched.repsToday() == 2
+    # saving writes them out
+    d.save()
+    assert not d._revlog
+    assert d.db.scalar("select count() from revlog") == 2
+    assert d.sched.repsToday() == 2
+    # as does filling the buffer
+    d.revlogLimit = 1
+    d.sched.answerCard(d.sched.getCard(), 2)
+    assert d.db.scalar("select count() from revlog") == 3
+
+def test_answerCards():
+    decks = []
+    for i in range(2):
+        d = getEmptyDeck()
+        for j in range(3):
+            f = d.newFact()
+            f['Front'] = u"one"; f['Back'] = u"two"
+            d.addFact(f)
+        d.reset()
+        decks.append(d)
+    cids = decks[0].db.list("select id from cards order by id")
+    answers = [(cids[0], 2), (cids[1], 3), (cids[0], 1), (cids[2], 2),
+               (cids[0], 2), (cids[0], 3), (cids[2], 1)]
+    # answer one at a time in the first deck
+    d = decks[0]
+    random.seed(1)
+    for (cid, ease) in answers:
+        c = d.getCard(cid)
+        c.startTimer()
+        d.sched.answerCard(c, ease)
+    # and as a batch in the second
+    d2 = decks[1]
+    random.seed(1)
+    d2.sched.answerCards([(cid, ease, 1000, time.time())
+                          for (cid, ease) in answers])
+    # unknown cards are rejected before anything is answered
+    from anki.errors import AnkiError
+    reps = d2.sched.reps
+    assertException(AnkiError, lambda: d2.sched.answerCards(
+        [(cids[1], 3, 1000, time.time()), (12345, 3, 1000, time.time())]))
+    assert d2.sched.reps == reps
+    # learning due times may differ by the time taken to run the test
+    sql = "select type, queue, ivl, factor, reps, lapses, grade, cycles, edue, "
+    sql += "(case when queue = 1 then 0 else due end) from cards order by id"
+    assert d.db.all(sql) == d2.db.all(sql)
+    # the log is written out
+    assert d2.db.scalar("select count() from revlog") == len(answers)
+    assert d2.db.list("select taken from revlog") == [1000]*len(answers)
+    # and the counts kept in step
+    d.reset(); d2.reset()
+    assert d.sched.counts() == d2.sched.counts()
+    d2.sched.invalidateCounts(); d2.reset()
+    assert d.sched.counts() == d2.sched.counts()
+
 def test_timing():
     d = getEmptyDeck()
     # add a few review cards, due today
@@ -806,3 +981,131 @@ def test_eta():
     d.sched.answerCard(c, 1)
     time.sleep(0.1)
     d.sched.answerCard(c, 1)
+
+def test_simulate():
+    try:
+        import numpy
+    except ImportError:
+        from nose.plugins.skip import SkipTest
+        raise SkipTest("numpy not installed")
+    d = getEmptyDeck()
+    assert d.sched.simulate(5) == [(0, 0, 0.0)]*5
+    for i in range(30):
+        f = d.newFact()
+        f['Front'] = u"f%d" % i
+        d.addFact(f)
+    # make one a review card due today
+    c = f.cards()[0]
+    c.type = c.queue = 2; c.ivl = 10; c.factor = 2500; c.due = d.sched.today
+    c.flush()
+    d.qconf['newPerDay'] = 10
+    res = d.sched.simulate(10, seed=1)
+    assert len(res) == 10
+    # the review and 10 new cards today, with 2 learning steps each
+    assert res[0][0] == 1
+    assert res[0][1] >= 20
+    # which graduate with a 1 day interval
+    assert res[1][0] in (10, 11)
+    assert sum(r[1] for r in res) >= 29*2
+    # raising the limit brings the reviews forward
+    more = d.sched.simulate(10, newPerDay=30, seed=1)
+    assert more[0][1] >= 29*2
+    assert more[1][0] >= 29
+    # same seed, same result
+    assert d.sched.simulate(10, seed=1) == res
+
+def test_prefetch():
+    d = getEmptyDeck()
+    for i in range(20):
+        f = d.newFact()
+        f['Front'] = u"f%d" % i
+        d.addFact(f)
+    d.db.execute("update cards set type=2, queue=2, ivl=10, factor=2500, due=?",
+                 d.sched.today)
+    d.sched.invalidateCounts()
+    d.sched.queueLimit = 5
+    d.sched.prefetchSize = 2
+    d.reset()
+    seen = []
+    while True:
+        c = d.sched.getCard()
+        if not c:
+            break
+        seen.append(c.id)
+        # as the ui would while the question is shown
+        d.sched.prefetch()
+        d.sched.answerCard(c, 3)
+    # each card was shown once, though the queue was refilled ahead
+    assert len(seen) == 20
+    assert len(set(seen)) == 20
+    # prefetched cards are already loaded and rendered
+    d.db.execute("update cards set due=?", d.sched.today)
+    d.sched.invalidateCounts()
+    d.reset()
+    d.sched.prefetch()
+    with d.db.capture() as queries:
+        c = d.sched.getCard()
+        c.q()
+    assert not [q for q in queries if "from cards where id" in q[0]]
+    # but changes made since are noticed
+    d.sched.prefetch()
+    id = d.sched.revQueue[-1]
+    f = d.getCard(id).fact()
+    f['Front'] = u"changed"
+    f.flush()
+    c = d.sched.getCard()
+    assert c.id == id
+    assert "changed" in c.q()
+
+def test_prefetchConcurrent():
+    import os, tempfile
+    from anki import Deck
+    (fd, path) = tempfile.mkstemp(suffix=".anki")
+    os.close(fd); os.unlink(path)
+    d = Deck(path, concurrent=True)
+    for i in range(20):
+        f = d.newFact()
+        f['Front'] = u"f%d" % i
+        d.addFact(f)
+    d.db.execute("update cards set type=2, queue=2, ivl=10, factor=2500, due=?",
+                 d.sched.today)
+    d.save()
+    d.sched.invalidateCounts()
+    d.sched.queueLimit = 5
+    d.sched.prefetchSize = 2
+    d.reset()
+    seen = []
+    while True:
+        c = d.sched.getCard()
+        if not c:
+            break
+        seen.append(c.id)
+        d.sched.answerCard(c, 3)
+        d.save()
+    assert sorted(seen) == sorted(set(seen))
+    assert len(seen) == 20
+    d.close()
+
+def test_prefetchReadOnly():
+    import os, tempfile
+    from anki import Deck
+    (fd, path) = tempfile.mkstemp(suffix=".anki")
+    os.close(fd); os.unlink(path)
+    d = Deck(path, concurrent=True)
+    for txt in (u"plain", u"[$]x^2[/$]"):
+        f = d.newFact()
+        f['Front'] = txt
+        d.addFact(f)
+    d.save()
+    cids = d.db.list("select id from cards order by id")
+    # models aren't loaded through the main connection, and latex isn't built
+    d.modelCache = {}
+    d.media.names()
+    with d.db.capture() as queries:
+        with d.pool.reader() as db:
+            cards = d.sched._loadCards(db, cids)
+    assert not queries
+    assert cards[cids[0]][0]._qa
+    assert cards[cids[1]][0]._qa is None
+    assert not d.db.scalar("select count() from media_files")
+    d.close()
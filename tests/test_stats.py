@@ -20,6 +20,40 @@ def test_stats():
     d.sched.answerCard(c, 2)
     assert d.cardStats(c)
 
+def test_daily():
+    d = getEmptyDeck()
+    f = d.newFact()
+    f['Front'] = u"one"; f['Back'] = u"two"
+    d.addFact(f)
+    g = d.groupId("new group")
+    d.reset()
+    c = d.sched.getCard()
+    for ease in (1, 3, 4):
+        d.sched.answerCard(c, ease)
+    d.flushRevlog()
+    daily = lambda: sorted(d.db.all("select * from revlog_daily"))
+    assert d.db.scalar("select sum(cnt) from revlog_daily") == 3
+    assert d.db.scalar("select sum(ease1) from revlog_daily") == 1
+    # moving cards moves their totals
+    cids = [c.id for c in f.cards()]
+    d.setGroup(cids, g)
+    assert d.db.list("select distinct gid from revlog_daily") == [g]
+    before = daily()
+    d.rebuildDaily()
+    assert daily() == before
+    # as does changing a card's group directly, which needs no extra queries
+    c = d.getCard(cids[0])
+    c.gid = 1
+    with d.db.capture() as queries:
+        c.flush()
+    assert d.db.list("select distinct gid from revlog_daily") == [1]
+    assert len([q for q in queries if q[0].startswith("select")]) == 0
+    c.flush()
+    assert d.db.list("select distinct gid from revlog_daily") == [1]
+    # and they're removed with the card
+    d.delCards(cids)
+    assert not daily()
+
 def test_graphs_empty():
     d = getEmptyDeck()
     assert d.stats().report()
@@ -106,6 +106,172 @@ def test_changes():
     #client.process(loc, rem)
 
 
+@nose.with_setup(setup_local, teardown)
+def test_streaming():
+    from anki.hooks import addHook, removeHook
+    deck2.scm = 0
+    lastSync = deck1.lastSync
+    # too many changes for changes()
+    client.fullThreshold = server.fullThreshold = 1
+    assert not server.changes(lastSync)
+    client.chunkSize = server.chunkSize = 1
+    progress = []
+    def onProgress(key, done, total):
+        progress.append((key, done, total))
+    addHook("syncProgress", onProgress)
+    try:
+        # the server's changes are sent to the client, a row at a time
+        dels = client.deletions(lastSync)
+        data = list(server.stuffChunks(server.changeChunks(lastSync, dels)))
+        assert len(data) > 5
+        client.applyChunks(client.unstuffChunks(iter(data)), rewrite=True)
+        assert ("facts", 1, 1) in progress
+        # and the client's to the server
+        server.applyChunks(client.unstuffChunks(
+            client.stuffChunks(client.changeChunks(lastSync))))
+    finally:
+        removeHook("syncProgress", onProgress)
+    for d in (deck1, deck2):
+        assert sorted(d.db.list("select sfld from facts")) == [
+            "bar", "foo", "qux"]
+        assert d.db.scalar("select count() from cards") == 3
+        assert d.db.scalar("select count() from revlog") == 1
+        assert not d.db.pending()
+    # rows sent back unchanged aren't applied again
+    sql = "select mod from facts where mod > ? order by id"
+    assert deck1.db.list(sql, lastSync) == deck2.db.list(sql, lastSync)
+
+def test_compact():
+    import simplejson, struct
+    from anki.sync import Syncer, packChanges
+    s = Syncer()
+    d = {'cards': [[1000+i, i % 3, -i, 2**40 + i*7, None if i == 5 else i,
+                    u"t\xe9xt", 1.5] for i in range(200)],
+         'revlog': [], 'tags': [[1, 2**63-1], [2, -2**63]],
+         'deck': [1, u"x"], 'deletions': [[1], []]}
+    js = s.stuff(d)
+    s.compact = True
+    data = s.stuff(d)
+    assert len(data) < len(js)
+    # either encoding is accepted
+    assert s.unstuff(data) == s.unstuff(js) == simplejson.loads(
+        simplejson.dumps(d))
+    # ints are packed in the narrowest width, with times as differences
+    data = packChanges({'revlog': [[10**12 + i*1000, i] for i in range(5)]})
+    assert data.endswith(struct.pack("<5h", 0, *[1000]*4) + "\0\1\2\3\4")
+
+@nose.with_setup(setup_local, teardown)
+def test_streamingCompact():
+    deck2.scm = 0
+    lastSync = deck1.lastSync
+    client.compact = server.compact = True
+    client.chunkSize = server.chunkSize = 1
+    data = list(server.stuffChunks(server.changeChunks(
+        lastSync, client.deletions(lastSync))))
+    # chunks may be split anywhere in transit
+    data = "".join(data)
+    data = [data[i:i+7] for i in range(0, len(data), 7)]
+    client.applyChunks(client.unstuffChunks(iter(data)), rewrite=True)
+    server.applyChunks(client.unstuffChunks(
+        client.stuffChunks(client.changeChunks(lastSync))))
+    for d in (deck1, deck2):
+        assert sorted(d.db.list("select sfld from facts")) == [
+            "bar", "foo", "qux"]
+        assert d.db.scalar("select count() from revlog") == 1
+
+@nose.with_setup(setup_local, teardown)
+def test_streamingTies():
+    deck2.scm = 0
+    lastSync = deck1.lastSync
+    # the same fact and card edited on both sides in the same second
+    for (d, txt) in ((deck1, u"client"), (deck2, u"server")):
+        d.db.execute("update facts set mod = ?, flds = ? where id = 1",
+                     lastSync + 1, u"foo\x1f" + txt)
+        d.db.execute("update cards set mod = ?, ivl = ? where id = 1",
+                     lastSync + 1, len(txt))
+    client.applyChunks(server.changeChunks(
+        lastSync, client.deletions(lastSync)), rewrite=True)
+    server.applyChunks(client.changeChunks(lastSync))
+    # the server's copy wins on both sides
+    for table in ("facts", "cards", "revlog"):
+        sql = "select * from %s order by 1" % table
+        assert deck1.db.all(sql) == deck2.db.all(sql)
+    assert deck1.db.scalar("select flds from facts where id = 1") == \
+        u"foo\x1fserver"
+
+@nose.with_setup(setup_local, teardown)
+def test_syncChanges():
+    deck2.scm = 0
+    sent = []
+    apply = server.applyChunks
+    def record(chunks):
+        chunks = list(chunks)
+        sent.extend(chunks)
+        return apply(chunks)
+    server.applyChunks = record
+    client.syncChanges()
+    for d in (deck1, deck2):
+        assert sorted(d.db.list("select sfld from facts")) == [
+            "bar", "foo", "qux"]
+        assert d.db.scalar("select count() from revlog") == 1
+    # rows received from the server aren't sent back to it
+    sent = dict((k, v) for (k, v) in sent if k not in ("counts", "deck"))
+    assert [f[7] for f in sent['facts']] == ["bar"]
+    assert len(sent['cards']) == 1
+    assert "revlog" not in sent
+    assert deck1.lastSync == deck2.lastSync
+
+def test_negotiate():
+    import simplejson, zlib
+    srv = HttpSyncServer()
+    def connect(offer):
+        # the handshake reply is always JSON
+        return simplejson.loads(zlib.decompress(srv.getDecks(
+            "", "", "[]", "5", **offer)))['compact']
+    assert connect({'compact': "1"}) and srv.compact
+    # clients which don't offer it, or servers which don't support it,
+    # fall back to JSON
+    assert not connect({}) and not srv.compact
+    srv.canCompact = False
+    assert not connect({'compact': "1"}) and not srv.compact
+
+@nose.with_setup(setup_local, teardown)
+def test_localServer():
+    from anki.syncserver import LocalSyncServer
+    path = deck2.path
+    deck2.close()
+    srv = LocalSyncServer(path)
+    srv.start()
+    try:
+        proxy = HttpSyncServerProxy(u"", u"", url=srv.url)
+        client.setServer(proxy)
+        client.syncChanges()
+        stats = proxy.runCmd("stats")
+    finally:
+        srv.stop()
+    assert stats['requests'] == 4
+    assert stats['rows'] > 0
+    assert proxy.bytesSent and proxy.bytesReceived
+    # the compact encoding was agreed on when connecting
+    assert proxy.compact
+    d2 = Deck(path)
+    for d in (deck1, d2):
+        assert sorted(d.db.list("select sfld from facts")) == [
+            "bar", "foo", "qux"]
+        assert d.db.scalar("select count() from revlog") == 1
+    assert deck1.lastSync == d2.lastSync
+    d2.close()
+
+def test_syncBench():
+    from anki.syncbench import benchmark
+    # which also checks the decks match afterwards
+    r = benchmark(facts=50, divergence=0.2, process=False)
+    assert r['sent'] and r['received']
+    assert r['clientRows'] and r['serverRows']
+    assert not r['compact']
+    assert benchmark(facts=20, divergence=0.2, compact=True,
+                     process=False)['compact']
+
 # @nose.with_setup(setup_local, teardown)
 # def test_localsync_deck():
 #     # deck two was modified last